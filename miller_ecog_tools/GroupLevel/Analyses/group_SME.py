@@ -11,6 +11,8 @@ import ipyvolume as ipv
 from scipy.stats import ttest_1samp
 from joblib import Parallel, delayed
 
+from miller_ecog_tools.Utils.par_dispatch import SharedArrays, chunk_slices
+
 
 class GroupSMEAnalysis(object):
     """
@@ -25,6 +27,9 @@ class GroupSMEAnalysis(object):
     def __init__(self, analysis_objects, res_key='ts'):
         self.analysis_objects = analysis_objects
 
+        # number of parallel workers to use for permutation tests
+        self.n_jobs = 12
+
         # make group level dataframe
         self.group_df = self.create_res_df(res_key)
 
@@ -195,7 +200,7 @@ class GroupSMEAnalysis(object):
         r_ts, r_ps = ttest_1samp(r_vert_vals, 0, axis=1, nan_policy='omit')
 
         # not let's compute our significance thresholds via non-parametric permutation procedure
-        sig_thresh = self.compute_permute_dist_par(l_vert_vals, r_vert_vals, n_perms=n_perms)
+        sig_thresh = self.compute_permute_dist_par(l_vert_vals, r_vert_vals, n_perms=n_perms, n_jobs=self.n_jobs)
 
         # define colormap range
         if clim is None:
@@ -286,7 +291,7 @@ class GroupSMEAnalysis(object):
         return l_vert_mean, r_vert_mean
 
     @staticmethod
-    def compute_permute_dist_par(l_vert_vals, r_vert_vals, n_perms=100):
+    def compute_permute_dist_par(l_vert_vals, r_vert_vals, n_perms=100, n_jobs=12):
         """
         Parameters
         ----------
@@ -296,14 +301,25 @@ class GroupSMEAnalysis(object):
             vertices x subject array of vals for the right hemisphere
         n_perms: int
             number of permutations to do. Diminishing returns after 100 or so..
+        n_jobs: int
+            number of parallel workers
 
         Returns
         -------
         Two element list for lower and upper sig. thresholds, based on 2.5 and 97.5th percentiles of permuted data
         """
-        f = _par_compute_single_perm
-        res = Parallel(n_jobs=12, verbose=5)(delayed(f)(x[0], x[1]) for x in [[l_vert_vals, r_vert_vals]] * n_perms)
-        return np.nanpercentile(np.concatenate(res), [2.5, 97.5])
+
+        # each permutation gets its own seed, so the workers do not share a random state
+        seeds = np.random.randint(np.iinfo(np.int32).max, size=n_perms)
+
+        # the vertex values are shared with the workers once, and each permutation writes a row of the output
+        with SharedArrays() as shared:
+            l_shared = shared.share(l_vert_vals)
+            r_shared = shared.share(r_vert_vals)
+            res = shared.empty((n_perms, l_vert_vals.shape[0] + r_vert_vals.shape[0]))
+            Parallel(n_jobs=n_jobs, verbose=5)(delayed(_par_compute_perms)(l_shared, r_shared, res, perm_chunk, seeds)
+                                               for perm_chunk in chunk_slices(n_perms, n_jobs))
+            return np.nanpercentile(res, [2.5, 97.5])
 
     @staticmethod
     def load_brain_mesh(subj='average', datadir='/data/eeg/freesurfer/subjects/{}/surf'):
@@ -342,6 +358,15 @@ class GroupSMEAnalysis(object):
         return np.power(2, range(int(np.log2(2 ** (int(freqs[-1]) - 1).bit_length())) + 1))
 
 
+def _par_compute_perms(l_vert_vals, r_vert_vals, res, perm_chunk, seeds):
+    """
+    Computes the permutations in perm_chunk, writing each into its row of res.
+    """
+    for perm in range(perm_chunk.start, perm_chunk.stop):
+        np.random.seed(seeds[perm])
+        res[perm] = _par_compute_single_perm(l_vert_vals, r_vert_vals)
+
+
 def _par_compute_single_perm(l_vert_vals, r_vert_vals):
     """
     Compute a single permutation of our procedure to find brain activation significance thresholds.
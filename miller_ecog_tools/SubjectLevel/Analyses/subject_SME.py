@@ -10,8 +10,11 @@ import pandas as pd
 import seaborn as sns
 from copy import deepcopy
 from mpl_toolkits.axes_grid1 import make_axes_locatable
-from scipy.stats import sem, ttest_ind
+from scipy.stats import sem
 
+from miller_ecog_tools.Utils import ecog_helpers
+from miller_ecog_tools.Utils import cluster_perm
+from miller_ecog_tools.Utils import session_norm
 from miller_ecog_tools.SubjectLevel.subject_analysis import SubjectAnalysisBase
 from miller_ecog_tools.SubjectLevel.subject_ram_power_data import SubjectRamPowerData
 
@@ -35,6 +38,29 @@ class SubjectSMEAnalysis(SubjectAnalysisBase, SubjectRamPowerData):
         # recall_filter_func to be a function that takes in events and returns bool of recalled items
         self.recall_filter_func = None
 
+        # If True, use a standard independent samples t-test. If False, use Welch's t-test
+        self.equal_var = True
+
+        # whether to do a cluster-based permutation test over frequency (and time, if present). Clusters are formed from
+        # t-statistics with p < cluster_p_thresh
+        self.do_cluster_perm_test = False
+        self.n_perms = 1000
+        self.cluster_p_thresh = 0.05
+        self.perm_batch_size = 100
+        self.perm_seed = None
+
+        # if given, electrodes closer than this (mm) will also be considered neighbors when forming clusters. Electrode
+        # locations are taken from the elec_info columns starting with elec_pos_column
+        self.cluster_elec_dist = None
+        self.elec_pos_column = 'ind.'
+
+        # If False, power will not be computed and saved for the whole subject. Instead, power will be computed one
+        # channel at a time and each channel will be reduced to its SME statistics before moving on to the next. Use
+        # this for high resolution time-frequency settings where the full power array won't fit in memory. Plotting
+        # methods that use .subject_data and the cluster permutation test are not available when this is False, and
+        # neither is .mono_avg_ref, since average referencing needs all channels at once.
+        self.cache_power = True
+
     def _generate_res_save_path(self):
         self.res_save_dir = os.path.join(os.path.split(self.save_dir)[0], self.__class__.__name__+'_res')
 
@@ -43,6 +69,10 @@ class SubjectSMEAnalysis(SubjectAnalysisBase, SubjectRamPowerData):
         Performs the subsequent memory analysis by comparing the distribution of remembered and not remembered items
         at each electrode and frequency using a two sample ttest.
         """
+        if not self.cache_power:
+            self._analysis_by_channel()
+            return
+
         if self.subject_data is None:
             print('%s: compute or load data first with .load_data()!' % self.subject)
 
@@ -55,18 +85,18 @@ class SubjectSMEAnalysis(SubjectAnalysisBase, SubjectRamPowerData):
         z_data = self.zscore_data()
 
         # for every frequency, electrode, timebin, subtract mean recalled from mean non-recalled zpower
-        # also run ttest at each frequency and electrode comparing remembered and not remembered events
-        # if there are 4 dimensions (ie., we have timebin data) then run the stats for each time bin seperately to
-        # minimize memory usage
-        if z_data.ndim == 4:
-            delta_z = [np.nanmean(x.T[recalled], axis=0) - np.nanmean(x.T[~recalled], axis=0) for x in z_data.T]
-            delta_z = np.stack(delta_z, -1)
-            ttest_results = [ttest_ind(x.T[recalled], x.T[~recalled], axis=0) for x in z_data.T]
-            ts = np.stack([x.statistic for x in ttest_results], -1)
-            ps = np.stack([x.pvalue for x in ttest_results], -1)
-        else:
-            delta_z = np.nanmean(z_data[recalled], axis=0) - np.nanmean(z_data[~recalled], axis=0)
-            ts, ps, = ttest_ind(z_data[recalled], z_data[~recalled])
+        # also run ttest at each frequency and electrode comparing remembered and not remembered events. This is done
+        # in one pass over the events, so works for data with or without timebins without any extra copies of the data
+        delta_z, ts, ps = ecog_helpers.compute_sme_stats(z_data, recalled, equal_var=self.equal_var)
+
+        # correct for multiple comparisons with a cluster-based permutation test
+        if self.do_cluster_perm_test:
+            elec_xyz = self._get_elec_xyz() if self.cluster_elec_dist is not None else None
+            cluster_res = cluster_perm.cluster_perm_test(z_data, recalled, n_perms=self.n_perms,
+                                                         p_thresh=self.cluster_p_thresh, equal_var=self.equal_var,
+                                                         elec_xyz=elec_xyz, max_elec_dist=self.cluster_elec_dist,
+                                                         batch_size=self.perm_batch_size, seed=self.perm_seed)
+            self.res.update(cluster_res)
 
         # also do this by session
         # sessions = self.subject_data.event.data['session']
@@ -87,6 +117,47 @@ class SubjectSMEAnalysis(SubjectAnalysisBase, SubjectRamPowerData):
         self.res['ps'] = ps
         self.res['recalled'] = recalled
 
+    def _analysis_by_channel(self):
+        """
+        Streaming version of .analysis(). Power is computed for one channel at a time, zscored by session, and reduced
+        to recalled vs not recalled statistics, so only a single channel of power is ever in memory.
+        """
+
+        # Get recalled or not labels
+        if self.recall_filter_func is None:
+            print('%s SME: please provide a .recall_filter_func function.' % self.subject)
+            return
+
+        # power computed one channel at a time can't be average referenced
+        if self.mono_avg_ref:
+            print('%s SME: .mono_avg_ref requires .cache_power to be True.' % self.subject)
+            return
+
+        if self.do_cluster_perm_test:
+            print('%s SME: cluster permutation test requires .cache_power to be True, skipping.' % self.subject)
+
+        recalled = None
+        delta_z, ts, ps = [], [], []
+        for chan_pow in self.iter_power_by_channel():
+            if recalled is None:
+                recalled = self.recall_filter_func(chan_pow)
+
+            # zscore this channel by session and compare recalled and not recalled items
+            # this channel's power isn't needed after this, so zscore it in place
+            chan_z = ecog_helpers.zscore_by_session(chan_pow, in_place=True)
+            chan_delta_z, chan_ts, chan_ps = ecog_helpers.compute_sme_stats(chan_z, recalled, equal_var=self.equal_var)
+            delta_z.append(chan_delta_z)
+            ts.append(chan_ts)
+            ps.append(chan_ps)
+
+        # stack the channels. The stats are frequency x channel (x time)
+        self.res['zs'] = np.concatenate(delta_z, axis=1)
+        self.res['ts'] = np.concatenate(ts, axis=1)
+        self.res['ps'] = np.concatenate(ps, axis=1)
+        self.res['p_recall'] = np.mean(recalled)
+        self.res['recalled'] = recalled
+        self.res['channel'] = self.elec_info['label'].values
+
     def plot_timecourse(self, elec_label='', region_column='', loc_tag_column='',
                         freq_bins=[[1, 4], [4, 10], [10, 14], [16, 26], [28, 44], [46, 100]]):
 
@@ -307,15 +378,28 @@ class SubjectSMEAnalysis(SubjectAnalysisBase, SubjectRamPowerData):
         """
         Normalize the power spectra by session.
         """
-        uniq_sessions = np.unique(self.subject_data.event.data['session'])
-        for sess in uniq_sessions:
-            sess_event_mask = (self.subject_data.event.data['session'] == sess)
-            m = np.mean(X[sess_event_mask], axis=1)
-            m = np.mean(m, axis=0)
-            s = np.std(X[sess_event_mask], axis=1)
-            s = np.mean(s, axis=0)
-            X[sess_event_mask] = (X[sess_event_mask] - m) / s
-        return X
+        X = np.asarray(X)
+        sessions = self.subject_data.event.data['session']
+        return session_norm.apply_session_stats(X, sessions, session_norm.spectrum_stats(X, sessions), in_place=True)
+
+    @property
+    def cache_power(self):
+        return self._cache_power
+
+    @cache_power.setter
+    def cache_power(self, x):
+        self._cache_power = x
+
+        # no need to load or compute the full power array if we are not caching it
+        self.ana_requires_data = x
+
+    def _get_elec_xyz(self):
+        if '{}{}'.format(self.elec_pos_column, 'x') in self.elec_info:
+            xyz = self.elec_info[['{}{}'.format(self.elec_pos_column, coord) for coord in ['x', 'y', 'z']]].values
+        else:
+            print('{}: {} column not in elec_locs, defaulting to x, y, and z.'.format(self.subject, self.elec_pos_column))
+            xyz = self.elec_info[[coord for coord in ['x', 'y', 'z']]].values
+        return xyz.astype(float)
 
     def compute_pow_two_series(self):
         """
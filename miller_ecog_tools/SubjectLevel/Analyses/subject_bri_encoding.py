@@ -13,7 +13,6 @@ from tqdm import tqdm
 from joblib import Parallel, delayed
 from scipy import signal
 from scipy.stats import zscore, ttest_ind, sem
-from scipy.signal import hilbert
 from ptsa.data.timeseries import TimeSeries
 from ptsa.data.filters import MorletWaveletFilter
 from mpl_toolkits.axes_grid1 import make_axes_locatable
@@ -21,6 +20,8 @@ from mpl_toolkits.axes_grid1 import make_axes_locatable
 from miller_ecog_tools.SubjectLevel.subject_analysis import SubjectAnalysisBase
 from miller_ecog_tools.SubjectLevel.subject_BRI_data import SubjectBRIData
 from miller_ecog_tools.Utils import neurtex_bri_helpers as bri
+from miller_ecog_tools.Utils import spike_binning
+from miller_ecog_tools.Utils import filter_bank
 
 # figure out the number of cores available for a parallel pool. Will use half
 import multiprocessing
@@ -133,12 +134,13 @@ class SubjectBRIEncodingAnalysis(SubjectAnalysisBase, SubjectBRIData):
                         self.res[channel_grp.name]['firing_rates'][clust_str] = {}
 
                         # compute number of spikes at each timepoint and the time in samples when each occurred
-                        spike_counts, spike_rel_times = self._create_spiking_counts(cluster_grp, events,
-                                                                                    eeg_channel.shape[1])
+                        spike_counts, spike_bins, spike_events = self._create_spiking_counts(cluster_grp, events,
+                                                                                             eeg_channel.shape[1])
 
                         # compute the phase of each spike at each frequency using the already computed phase data
                         # for this channel. Perform rayleigh test and other stats at each frequency
-                        correct_phases, incorrect_phases = _compute_spike_phase_by_freq(spike_rel_times,
+                        correct_phases, incorrect_phases = _compute_spike_phase_by_freq(spike_bins,
+                                                                                spike_events,
                                                                                 self.phase_bin_start,
                                                                                 self.phase_bin_stop,
                                                                                 phase_data,
@@ -164,7 +166,8 @@ class SubjectBRIEncodingAnalysis(SubjectAnalysisBase, SubjectBRIData):
 
                         # also compute novel and repeated phases for each band in hilbert phases
                         if self.hilbert_bands is not None:
-                            correct_phases_hilbert, incorrect_phases_hilbert = _compute_spike_phase_by_freq(spike_rel_times,
+                            correct_phases_hilbert, incorrect_phases_hilbert = _compute_spike_phase_by_freq(spike_bins,
+                                                                                                    spike_events,
                                                                                                     self.phase_bin_start,
                                                                                                     self.phase_bin_stop,
                                                                                                     phase_data_hilbert,
@@ -201,28 +204,16 @@ class SubjectBRIEncodingAnalysis(SubjectAnalysisBase, SubjectBRIData):
                         self.res[channel_grp.name]['firing_rates'][clust_str]['zdata_ps'] = spike_res_zs[5]
 
     def _create_spiking_counts(self, cluster_grp, events, n):
-        spike_counts = []
-        spike_ts = []
+        # load the spike times of every event for this cluster at once
+        spike_times, offsets = bri.load_event_spike_times(cluster_grp, events.index.values)
 
-        # loop over each event
-        for index, e in events.iterrows():
-            # load the spike times for this cluster
-            spike_times = np.array(cluster_grp[str(index)])
-
-            # interpolate the timestamps for this event
-            start = e.stTime + self.start_ms * 1000
-            stop = e.stTime + self.stop_ms * 1000
-            timestamps = np.linspace(start, stop, n, endpoint=True)
-
-            # find the closest timestamp to each spike (technically, the closest timestamp following a spike, but I
-            # think this level of accuracy is fine). This is the searchsorted command. Then count the number of spikes
-            # that occurred at each timepoint with histogram
-            spike_bins = np.searchsorted(timestamps, spike_times)
-            bin_counts, _ = np.histogram(spike_bins, np.arange(len(timestamps) + 1))
-            spike_counts.append(bin_counts)
-            spike_ts.append(spike_bins)
-
-        return np.stack(spike_counts, 0), spike_ts
+        # bin the spikes of all events on a grid of n timestamps spanning each event, careful to convert ms to
+        # microseconds. Each spike is assigned to the closest timestamp following it
+        spike_counts, spike_bins = spike_binning.bin_event_spikes(spike_times, offsets,
+                                                                  events.stTime.values + self.start_ms * 1000,
+                                                                  events.stTime.values + self.stop_ms * 1000, n)
+        spike_events = np.repeat(np.arange(len(offsets) - 1), np.diff(offsets))
+        return spike_counts, spike_bins, spike_events
 
     def _create_eeg_timeseries(self, grp, events):
         data = np.array(grp['ev_eeg'])
@@ -459,26 +450,9 @@ class SubjectBRIEncodingAnalysis(SubjectAnalysisBase, SubjectBRIData):
 
 def compute_hilbert_at_single_band(eeg, freq_band, buffer_len):
 
-    # band pass eeg
-    # makes sure to pass in a list not an array because wtf PTSA
-    band_eeg = bri.band_pass_eeg(eeg, freq_band.tolist() if isinstance(freq_band, np.ndarray) else freq_band).squeeze()
-
-    # run hilbert to get the complexed valued result
-    complex_hilbert_res = hilbert(band_eeg.data, N=band_eeg.shape[-1], axis=-1)
-
-    # get phase at each timepoint
-    phase_data = band_eeg.copy()
-    phase_data.data = np.angle(complex_hilbert_res)
-    phase_data = phase_data.remove_buffer(buffer_len)
-    phase_data.coords['frequency'] = np.mean(freq_band)
-
-    # and power
-    power_data = band_eeg.copy()
-    power_data.data = np.abs(complex_hilbert_res) ** 2
-    power_data = power_data.remove_buffer(buffer_len)
-    power_data.coords['frequency'] = np.mean(freq_band)
-
-    return power_data, phase_data
+    # band pass and hilbert transform in the frequency domain, with the buffer removed
+    power_data, phase_data = filter_bank.hilbert_filter_bank(eeg.squeeze(), [freq_band], buffer_len)
+    return power_data[0], phase_data[0]
 
 
 def compute_wavelet_at_single_freq(eeg, freq, buffer_len):
@@ -496,13 +470,13 @@ def compute_wavelet_at_single_freq(eeg, freq, buffer_len):
     return data.squeeze()
 
 
-def _compute_spike_phase_by_freq(spike_rel_times, phase_bin_start, phase_bin_stop, phase_data, events):
+def _compute_spike_phase_by_freq(spike_bins, spike_events, phase_bin_start, phase_bin_stop, phase_data, events):
 
     # only will count samples the occurred within window defined by phase_bin_start and _stop
-    valid_samps = np.where((phase_data.time > phase_bin_start) & (phase_data.time < phase_bin_stop))[0]
+    valid_samps = (phase_data.time.values > phase_bin_start) & (phase_data.time.values < phase_bin_stop)
 
     # only include novel items that were repeated
-    good_events = events[events['isFirst'] & events['isPaired']].index.values
+    good_events = (events['isFirst'] & events['isPaired']).values
 
     # create an array indicating if the encoding item was correctly retrieved
     novel_items = events['isFirst'].values
@@ -517,29 +491,17 @@ def _compute_spike_phase_by_freq(spike_rel_times, phase_bin_start, phase_bin_sto
             correct[e] = hits[retr_item_ind]
     events['correct'] = correct
 
-    # will grow as we iterate over spikes in each condition.
-    correct_phases = []
-    incorrect_phases = []
-    for (index, e), spikes, phase_data_event in zip(events.iterrows(), spike_rel_times, phase_data):
-        if index in good_events:
-            is_correct = e.correct
-            if len(spikes) > 0:
-                valid_spikes = spikes[np.in1d(spikes, valid_samps)]
-                if len(valid_spikes) > 0:
-                    if is_correct:
-                        correct_phases.append(phase_data_event[valid_spikes].data)
-                    else:
-                        incorrect_phases.append(phase_data_event[valid_spikes].data)
+    # phase of every spike at every frequency, along with the event of each spike
+    phases, phase_events = spike_binning.event_spike_phases(spike_bins, spike_events, phase_data, valid_samps,
+                                                            good_events)
 
     # will be number of spikes x frequencies
-    if len(correct_phases) > 0:
-        correct_phases = np.vstack(correct_phases)
-    else:
-        correct_phases = np.array(correct_phases)
-    if len(incorrect_phases) > 0:
-        incorrect_phases = np.vstack(incorrect_phases)
-    else:
-        incorrect_phases = np.array(incorrect_phases)
+    correct_phases = phases[correct[phase_events]]
+    incorrect_phases = phases[~correct[phase_events]]
+    if len(correct_phases) == 0:
+        correct_phases = np.array([])
+    if len(incorrect_phases) == 0:
+        incorrect_phases = np.array([])
 
     return correct_phases, incorrect_phases
 
@@ -14,7 +14,6 @@ from tqdm import tqdm
 from joblib import Parallel, delayed
 from scipy import signal
 from scipy.stats import zscore, ttest_ind, sem
-from scipy.signal import hilbert
 from ptsa.data.timeseries import TimeSeries
 from ptsa.data.filters import MorletWaveletFilter
 from mpl_toolkits.axes_grid1 import make_axes_locatable
@@ -22,6 +21,8 @@ from mpl_toolkits.axes_grid1 import make_axes_locatable
 from miller_ecog_tools.SubjectLevel.subject_analysis import SubjectAnalysisBase
 from miller_ecog_tools.SubjectLevel.subject_BRI_data import SubjectBRIData
 from miller_ecog_tools.Utils import neurtex_bri_helpers as bri
+from miller_ecog_tools.Utils import spike_binning
+from miller_ecog_tools.Utils import filter_bank
 
 # figure out the number of cores available for a parallel pool. Will use half
 import multiprocessing
@@ -163,8 +164,8 @@ class SubjectNoveltyAnalysis(SubjectAnalysisBase, SubjectBRIData):
                     res_cluster_grp = res_channel_grp.create_group(clust_str)
 
                     # find number of spikes at each timepoint and the time in samples when each occurred
-                    spike_counts, spike_rel_times = self._create_spiking_counts(cluster_grp, events,
-                                                                                eeg_channel.shape[1])
+                    spike_counts, spike_bins, spike_events = self._create_spiking_counts(cluster_grp, events,
+                                                                                         eeg_channel.shape[1])
 
                     # smooth the spike train. Also remove the buffer
                     kern_width_samples = int(eeg_channel.samplerate.data / (1000 / self.kern_width))
@@ -180,14 +181,16 @@ class SubjectNoveltyAnalysis(SubjectAnalysisBase, SubjectBRIData):
 
                     # get the phases at which the spikes occurred and bin into novel and repeated items
                     # 1. for each freq in power_freqs
-                    spike_phases = _compute_spike_phase_by_freq(np.array(spike_rel_times),
+                    spike_phases = _compute_spike_phase_by_freq(spike_bins,
+                                                                spike_events,
                                                                 self.phase_bin_start,
                                                                 self.phase_bin_stop,
                                                                 phase_data,
                                                                 events)
 
                     # 2: for each hilbert band
-                    spike_phases_hilbert = _compute_spike_phase_by_freq(np.array(spike_rel_times),
+                    spike_phases_hilbert = _compute_spike_phase_by_freq(spike_bins,
+                                                                        spike_events,
                                                                         self.phase_bin_start,
                                                                         self.phase_bin_stop,
                                                                         phase_data_hilbert,
@@ -217,7 +220,7 @@ class SubjectNoveltyAnalysis(SubjectAnalysisBase, SubjectBRIData):
                             event_filter_grp = res_cluster_grp.create_group(this_event_cond+phase_data_list[1])
                             event_filter_grp.create_dataset('events_to_keep', data=events_to_keep)
 
-                            do_compute_mem_effects = run_phase_stats(phase_data_list[0], events, events_to_keep,
+                            do_compute_mem_effects = run_phase_stats(*phase_data_list[0], events, events_to_keep,
                                                                      event_filter_grp)
 
                             # also compute the power effects for these filtered event conditions
@@ -325,28 +328,16 @@ class SubjectNoveltyAnalysis(SubjectAnalysisBase, SubjectBRIData):
                rep_sem, novel_trial_means, rep_trial_means
 
     def _create_spiking_counts(self, cluster_grp, events, n):
-        spike_counts = []
-        spike_ts = []
+        # load the spike times of every event for this cluster at once
+        spike_times, offsets = bri.load_event_spike_times(cluster_grp, events.index.values)
 
-        # loop over each event
-        for index, e in events.iterrows():
-            # load the spike times for this cluster
-            spike_times = np.array(cluster_grp[str(index)])
-
-            # interpolate the timestamps for this event
-            start = e.stTime + self.start_ms * 1000
-            stop = e.stTime + self.stop_ms * 1000
-            timestamps = np.linspace(start, stop, n, endpoint=True)
-
-            # find the closest timestamp to each spike (technically, the closest timestamp following a spike, but I
-            # think this level of accuracy is fine). This is the searchsorted command. Then count the number of spikes
-            # that occurred at each timepoint with histogram
-            spike_bins = np.searchsorted(timestamps, spike_times)
-            bin_counts, _ = np.histogram(spike_bins, np.arange(len(timestamps) + 1))
-            spike_counts.append(bin_counts)
-            spike_ts.append(spike_bins)
-
-        return np.stack(spike_counts, 0), spike_ts
+        # bin the spikes of all events on a grid of n timestamps spanning each event, careful to convert ms to
+        # microseconds. Each spike is assigned to the closest timestamp following it
+        spike_counts, spike_bins = spike_binning.bin_event_spikes(spike_times, offsets,
+                                                                  events.stTime.values + self.start_ms * 1000,
+                                                                  events.stTime.values + self.stop_ms * 1000, n)
+        spike_events = np.repeat(np.arange(len(offsets) - 1), np.diff(offsets))
+        return spike_counts, spike_bins, spike_events
 
     def _create_eeg_timeseries(self, grp, events):
         data = np.array(grp['ev_eeg'])
@@ -583,26 +574,9 @@ class SubjectNoveltyAnalysis(SubjectAnalysisBase, SubjectBRIData):
 
 def compute_hilbert_at_single_band(eeg, freq_band, buffer_len):
 
-    # band pass eeg
-    # makes sure to pass in a list not an array because wtf PTSA
-    band_eeg = bri.band_pass_eeg(eeg, freq_band.tolist() if isinstance(freq_band, np.ndarray) else freq_band).squeeze()
-
-    # run hilbert to get the complexed valued result
-    complex_hilbert_res = hilbert(band_eeg.data, N=band_eeg.shape[-1], axis=-1)
-
-    # get phase at each timepoint
-    phase_data = band_eeg.copy()
-    phase_data.data = np.angle(complex_hilbert_res)
-    # phase_data = phase_data.remove_buffer(buffer_len)
-    phase_data.coords['frequency'] = np.mean(freq_band)
-
-    # and power
-    power_data = band_eeg.copy()
-    power_data.data = np.log10(np.abs(complex_hilbert_res) ** 2)
-    # power_data = power_data.remove_buffer(buffer_len)
-    power_data.coords['frequency'] = np.mean(freq_band)
-
-    return power_data, phase_data
+    # band pass and hilbert transform in the frequency domain. The buffer is kept
+    power_data, phase_data = filter_bank.hilbert_filter_bank(eeg.squeeze(), [freq_band], log_power=True)
+    return power_data[0], phase_data[0]
 
 
 def compute_wavelet_at_single_freq(eeg, freq, buffer_len):
@@ -620,62 +594,29 @@ def compute_wavelet_at_single_freq(eeg, freq, buffer_len):
     return data.squeeze()
 
 
-def _compute_spike_phase_by_freq(spike_rel_times, phase_bin_start, phase_bin_stop, phase_data, events):
+def _compute_spike_phase_by_freq(spike_bins, spike_events, phase_bin_start, phase_bin_stop, phase_data, events):
 
     # only will count samples the occurred within window defined by phase_bin_start and _stop
-    valid_samps = np.where((phase_data.time > phase_bin_start) & (phase_data.time < phase_bin_stop))[0]
+    valid_samps = (phase_data.time.values > phase_bin_start) & (phase_data.time.values < phase_bin_stop)
 
     # throw out novel items that were never repeated
-    good_events = events[~((events['isFirst']) & (events['lag'] == 0))].index.values
-
-    # will grow as we iterate over spikes in each condition.
-    phases = []
-    for (index, e), spikes, phase_data_event in zip(events.iterrows(), spike_rel_times, phase_data):
-        phases_event = []
-        if index in good_events:
-            if len(spikes) > 0:
-                valid_spikes = spikes[np.in1d(spikes, valid_samps)]
-                if len(valid_spikes) > 0:
-                    phases_event = phase_data_event[valid_spikes].data
-
-        phases.append(phases_event)
-
-    # will be number of spikes x frequencies
-    #     if len(novel_phases) > 0:
-    #         novel_phases = np.vstack(novel_phases)
-    #     else:
-    #         novel_phases = np.array(novel_phases)
-    #     if len(rep_phases) > 0:
-    #         rep_phases = np.vstack(rep_phases)
-    #     else:
-    #         rep_phases = np.array(rep_phases)
-
-    return np.array(phases)
-
-
-def run_phase_stats(spike_phases, events, events_to_keep, event_filter_grp):
-
-    novel_phases = np.array([])
-    rep_phases = np.array([])
-
-    # get the novel and repeated spike phases for this event condition. Some events have no
-    # spikes, so filter those out
-    spike_phase_cond = spike_phases[events_to_keep]
-    if np.any(events[events_to_keep].isFirst):
-        novel_phases = spike_phase_cond[events[events_to_keep].isFirst]
-        novel_phases = novel_phases[np.array([len(x) > 0 for x in novel_phases])]
+    good_events = ~((events['isFirst']) & (events['lag'] == 0)).values
+
+    # will be number of spikes x frequencies, along with the event of each spike
+    return spike_binning.event_spike_phases(spike_bins, spike_events, phase_data, valid_samps, good_events)
+
+
+def run_phase_stats(spike_phases, spike_phase_events, events, events_to_keep, event_filter_grp):
+
+    # get the novel and repeated spike phases for this event condition
+    is_novel = events.isFirst.values
+    novel_phases = spike_phases[(events_to_keep & is_novel)[spike_phase_events]]
     if novel_phases.shape[0] == 0:
         novel_phases = []
-    else:
-        novel_phases = np.vstack(novel_phases)
 
-    if np.any(~events[events_to_keep].isFirst):
-        rep_phases = spike_phase_cond[~events[events_to_keep].isFirst]
-        rep_phases = rep_phases[np.array([len(x) > 0 for x in rep_phases])]
+    rep_phases = spike_phases[(events_to_keep & ~is_novel)[spike_phase_events]]
     if rep_phases.shape[0] == 0:
         rep_phases = []
-    else:
-        rep_phases = np.vstack(rep_phases)
 
     if (len(novel_phases) > 0) & (len(rep_phases) > 0):
         p_novel, z_novel, p_rep, z_rep, ww_pvals, ww_fstat, med_pvals, med_stat, p_kuiper, \
@@ -11,7 +11,6 @@ import h5py
 from tqdm import tqdm
 from joblib import Parallel, delayed
 from collections import Counter
-from scipy.signal import hilbert
 from scipy.stats import sem, zscore
 from ptsa.data.timeseries import TimeSeries
 from ptsa.data.filters import MorletWaveletFilter
@@ -19,6 +18,8 @@ from ptsa.data.filters import MorletWaveletFilter
 from miller_ecog_tools.SubjectLevel.subject_analysis import SubjectAnalysisBase
 from miller_ecog_tools.SubjectLevel.subject_BRI_data import SubjectBRIData
 from miller_ecog_tools.Utils import neurtex_bri_helpers as bri
+from miller_ecog_tools.Utils import spike_binning
+from miller_ecog_tools.Utils import filter_bank
 
 # figure out the number of cores available for a parallel pool. Will use half
 import multiprocessing
@@ -175,12 +176,13 @@ class SubjectBRINoveltySpikePhaseWithShuffleAnalysis(SubjectAnalysisBase, Subjec
                             res_cluster_grp = res_channel_grp[clust_str]
 
                         # find number of spikes at each timepoint and the time in samples when each occurred
-                        spike_counts, spike_rel_times = self._create_spiking_counts(cluster_grp, events[events_to_keep],
-                                                                                    eeg_channel.shape[1])
+                        spike_counts, spike_bins, spike_events = self._create_spiking_counts(cluster_grp,
+                                                                                             events[events_to_keep],
+                                                                                             eeg_channel.shape[1])
 
                         # compute spike triggered average of eeg
                         if ~self.skip_sta_stats and ~self.do_wavelets:
-                            _sta_by_event_cond(spike_rel_times, self.phase_bin_start, self.phase_bin_stop,
+                            _sta_by_event_cond(spike_bins, spike_events, self.phase_bin_start, self.phase_bin_stop,
                                                self.sta_buffer, eeg_channel, band_pass_eeg, events[events_to_keep],
                                                res_cluster_grp)
 
@@ -200,7 +202,8 @@ class SubjectBRINoveltySpikePhaseWithShuffleAnalysis(SubjectAnalysisBase, Subjec
                             phase_stats, phase_stats_percentiles, orig_pvals, novel_phases, rep_phases, \
                                 mean_shuf_novel_phases, mean_shuf_rep_phases = \
                                 run_phase_stats_with_shuffle(events[events_to_keep],
-                                                             spike_rel_times,
+                                                             spike_bins,
+                                                             spike_events,
                                                              phase_data,
                                                              self.phase_bin_start,
                                                              self.phase_bin_stop,
@@ -266,28 +269,16 @@ class SubjectBRINoveltySpikePhaseWithShuffleAnalysis(SubjectAnalysisBase, Subjec
             return correct
 
     def _create_spiking_counts(self, cluster_grp, events, n):
-        spike_counts = []
-        spike_ts = []
+        # load the spike times of every event for this cluster at once
+        spike_times, offsets = bri.load_event_spike_times(cluster_grp, events.index.values)
 
-        # loop over each event
-        for index, e in events.iterrows():
-            # load the spike times for this cluster
-            spike_times = np.array(cluster_grp[str(index)])
-
-            # interpolate the timestamps for this event
-            start = e.stTime + self.start_ms * 1000
-            stop = e.stTime + self.stop_ms * 1000
-            timestamps = np.linspace(start, stop, n, endpoint=True)
-
-            # find the closest timestamp to each spike (technically, the closest timestamp following a spike, but I
-            # think this level of accuracy is fine). This is the searchsorted command. Then count the number of spikes
-            # that occurred at each timepoint with histogram
-            spike_bins = np.searchsorted(timestamps, spike_times)
-            bin_counts, _ = np.histogram(spike_bins, np.arange(len(timestamps) + 1))
-            spike_counts.append(bin_counts)
-            spike_ts.append(spike_bins)
-
-        return np.stack(spike_counts, 0), np.array(spike_ts)
+        # bin the spikes of all events on a grid of n timestamps spanning each event, careful to convert ms to
+        # microseconds. Each spike is assigned to the closest timestamp following it
+        spike_counts, spike_bins = spike_binning.bin_event_spikes(spike_times, offsets,
+                                                                  events.stTime.values + self.start_ms * 1000,
+                                                                  events.stTime.values + self.stop_ms * 1000, n)
+        spike_events = np.repeat(np.arange(len(offsets) - 1), np.diff(offsets))
+        return spike_counts, spike_bins, spike_events
 
     def _create_eeg_timeseries(self, grp, events):
         data = np.array(grp['ev_eeg'])
@@ -313,27 +304,10 @@ class SubjectBRINoveltySpikePhaseWithShuffleAnalysis(SubjectAnalysisBase, Subjec
 
 def compute_hilbert_at_single_band(eeg, freq_band, buffer_len):
 
-    # band pass eeg
-    # makes sure to pass in a list not an array because wtf PTSA
-    band_eeg = bri.band_pass_eeg(eeg, freq_band.tolist() if isinstance(freq_band, np.ndarray) else freq_band).squeeze()
-    band_eeg.coords['frequency'] = np.mean(freq_band)
-
-    # run hilbert to get the complexed valued result
-    complex_hilbert_res = hilbert(band_eeg.data, N=band_eeg.shape[-1], axis=-1)
-
-    # get phase at each timepoint
-    phase_data = band_eeg.copy()
-    phase_data.data = np.angle(complex_hilbert_res)
-    # phase_data = phase_data.remove_buffer(buffer_len)
-    # phase_data.coords['frequency'] = np.mean(freq_band)
-
-    # and power
-    power_data = band_eeg.copy()
-    power_data.data = np.log10(np.abs(complex_hilbert_res) ** 2)
-    # power_data = power_data.remove_buffer(buffer_len)
-    # power_data.coords['frequency'] = np.mean(freq_band)
-
-    return phase_data, power_data, band_eeg
+    # band pass and hilbert transform in the frequency domain. The buffer is kept
+    power_data, phase_data, band_eeg = filter_bank.hilbert_filter_bank(eeg.squeeze(), [freq_band], log_power=True,
+                                                                       return_band_eeg=True)
+    return phase_data[0], power_data[0], band_eeg[0]
 
 
 def compute_wavelet_at_single_freq(eeg, freq, buffer_len):
@@ -388,32 +362,27 @@ def _power_fr_by_event_cond(spike_counts, power_data_hilbert, bins, events, h_fi
         return pow_novel, pow_rep, fr_novel, fr_rep
 
 
-def _sta_by_event_cond(spike_rel_times, phase_bin_start, phase_bin_stop, sta_buffer, eeg, filtered_eeg, events,
-                       h_file=None):
+def _sta_by_event_cond(spike_bins, spike_events, phase_bin_start, phase_bin_stop, sta_buffer, eeg, filtered_eeg,
+                       events, h_file=None):
     valid_samps = np.where((eeg.time > phase_bin_start) & (eeg.time < phase_bin_stop))[0]
     nsamples = int(np.ceil(float(eeg['samplerate']) * sta_buffer))
 
     # throw out novel items that were never repeated
-    good_events = events[~((events['isFirst']) & (events['lag'] == 0))].index.values
-
-    # loop over each event
-    stas = []
-    stas_filt = []
-    is_novel = []
-    for (index, e), spikes, eeg_data_event, eeg_filt_data_event in zip(events.iterrows(), spike_rel_times, eeg, filtered_eeg):
-        if index in good_events:
-            if len(spikes) > 0:
-                valid_spikes = spikes[np.in1d(spikes, valid_samps)]
-                if len(valid_spikes) > 0:
-                    for this_spike in valid_spikes:
-                        stas.append(eeg_data_event[this_spike - nsamples:this_spike + nsamples].data)
-                        stas_filt.append(eeg_filt_data_event[this_spike - nsamples:this_spike + nsamples].data)
-                        is_novel.append(e.isFirst)
-    is_novel = np.array(is_novel)
+    good_events = ~((events['isFirst']) & (events['lag'] == 0)).values
+
+    # the spikes of the good events within the valid samples, skipping any whose window runs off the end of the event
+    keep = np.isin(spike_bins, valid_samps) & good_events[spike_events]
+    keep &= (spike_bins >= nsamples) & (spike_bins + nsamples <= eeg.shape[1])
+    sta_events = spike_events[keep]
+    is_novel = events['isFirst'].values[sta_events].astype(bool)
+
+    # eeg in a window around every spike, for all spikes at once
+    sta_inds = spike_bins[keep][:, np.newaxis] + np.arange(-nsamples, nsamples)
+    stas = np.asarray(eeg)[sta_events[:, np.newaxis], sta_inds]
+    stas_filt = np.asarray(filtered_eeg)[sta_events[:, np.newaxis], sta_inds]
 
     # sta by condition for raw eeg
     if len(stas) > 0:
-        stas = np.stack(stas)
         novel_sta_mean = stas[is_novel].mean(axis=0)
         novel_sta_sem = sem(stas[is_novel], axis=0)
         rep_sta_mean = stas[~is_novel].mean(axis=0)
@@ -421,7 +390,6 @@ def _sta_by_event_cond(spike_rel_times, phase_bin_start, phase_bin_stop, sta_buf
         sta_time = np.linspace(-sta_buffer, sta_buffer, novel_sta_mean.shape[0])
 
         # sta by condition for filtered eeg
-        stas_filt = np.stack(stas_filt)
         novel_sta_filt_mean = stas_filt[is_novel].mean(axis=0)
         novel_sta_filt_sem = sem(stas_filt[is_novel], axis=0)
         rep_sta_filt_mean = stas_filt[~is_novel].mean(axis=0)
@@ -454,7 +422,16 @@ def add_to_hd5f_file(h_file, data_name, data):
 
 def compute_phase(eeg, freqs, buffer_len, parallel=None, do_wavelets=False):
 
-    f = compute_wavelet_at_single_freq if do_wavelets else compute_hilbert_at_single_band
+    # all hilbert bands come from a single transform of the eeg
+    if not do_wavelets:
+        power_data, phase_data, band_eeg_data = filter_bank.hilbert_filter_bank(eeg.squeeze(), freqs, log_power=True,
+                                                                                return_band_eeg=True)
+        phase_data = phase_data.transpose('event', 'time', 'frequency')
+        power_data = power_data.transpose('event', 'time', 'frequency')
+        band_eeg_data = band_eeg_data.transpose('event', 'time', 'frequency')
+        return phase_data, power_data, band_eeg_data
+
+    f = compute_wavelet_at_single_freq
     if parallel is None:
         phase_data = []
         power_data = []
@@ -472,90 +449,68 @@ def compute_phase(eeg, freqs, buffer_len, parallel=None, do_wavelets=False):
 
     phase_data = xarray.concat(phase_data, dim='frequency').transpose('event', 'time', 'frequency')
     power_data = xarray.concat(power_data, dim='frequency').transpose('event', 'time', 'frequency')
-
-    if not do_wavelets:
-        band_eeg_data = xarray.concat(band_eeg_data, dim='frequency').transpose('event', 'time', 'frequency')
-
     return phase_data, power_data, band_eeg_data
 
 
-def _compute_spike_phase_by_freq(spike_rel_times, phase_bin_start, phase_bin_stop, phase_data, events):
+def _compute_spike_phase_by_freq(spike_bins, spike_events, phase_bin_start, phase_bin_stop, phase_data, events):
 
     # only will count samples the occurred within window defined by phase_bin_start and _stop
-    valid_samps = np.where((phase_data.time > phase_bin_start) & (phase_data.time < phase_bin_stop))[0]
+    valid_samps = (phase_data.time.values > phase_bin_start) & (phase_data.time.values < phase_bin_stop)
 
     # throw out novel items that were never repeated
-    good_events = events[~((events['isFirst']) & (events['lag'] == 0))].index.values
+    good_events = ~((events['isFirst']) & (events['lag'] == 0)).values
 
-    # will grow as we iterate over spikes in each condition.
-    phases = []
-    for (index, e), spikes, phase_data_event in zip(events.iterrows(), spike_rel_times, phase_data):
-        phases_event = []
-        if index in good_events:
-            if len(spikes) > 0:
-                valid_spikes = spikes[np.in1d(spikes, valid_samps)]
-                if len(valid_spikes) > 0:
-                    phases_event = phase_data_event[valid_spikes].data
+    # will be number of spikes x frequencies, along with the event of each spike
+    return spike_binning.event_spike_phases(spike_bins, spike_events, phase_data, valid_samps, good_events)
 
-        phases.append(phases_event)
 
-    return np.array(phases)
+def _bin_phases_into_cond(spike_phases, spike_phase_events, events):
 
-
-def _bin_phases_into_cond(spike_phases, events):
-
-    # get the novel and repeated spike phases for this event condition. Some events have no
-    # spikes, so filter those out
-    novel_phases = spike_phases[events.isFirst]
-    novel_phases = novel_phases[np.array([len(x) > 0 for x in novel_phases])]
+    # get the novel and repeated spike phases for this event condition
+    is_novel = events.isFirst.values[spike_phase_events]
+    novel_phases = spike_phases[is_novel]
     if novel_phases.shape[0] == 0:
         novel_phases = []
-    else:
-        novel_phases = np.vstack(novel_phases)
 
-    rep_phases = spike_phases[~events.isFirst]
-    rep_phases = rep_phases[np.array([len(x) > 0 for x in rep_phases])]
+    rep_phases = spike_phases[~is_novel]
     if rep_phases.shape[0] == 0:
         rep_phases = []
-    else:
-        rep_phases = np.vstack(rep_phases)
 
     return novel_phases, rep_phases
 
 
-def compute_phase_stats_with_shuffle(events, spike_rel_times, phase_data_hilbert, phase_bin_start,
+def compute_phase_stats_with_shuffle(events, spike_bins, spike_events, phase_data_hilbert, phase_bin_start,
                                      phase_bin_stop, do_permute=False, shuffle_type=1):
 
-    spike_rel_times_tmp = spike_rel_times.copy()
     e_tmp = events.copy()
 
     if do_permute:
 
         if shuffle_type == 1:
 
-            # permute the novel
+            # permute the spikes of the novel events
+            source_events = np.arange(events.shape[0])
             novel_events = np.where(events.isFirst.values)[0]
-            perm_novel_events = np.random.permutation(novel_events)
-            spike_rel_times_tmp[novel_events] = spike_rel_times_tmp[perm_novel_events]
+            source_events[novel_events] = np.random.permutation(novel_events)
 
             # and repeated separately
             rep_events = np.where(~events.isFirst.values)[0]
-            perm_rep_events = np.random.permutation(rep_events)
-            spike_rel_times_tmp[rep_events] = spike_rel_times_tmp[perm_rep_events]
+            source_events[rep_events] = np.random.permutation(rep_events)
+            spike_bins, spike_events = spike_binning.reassign_event_spikes(spike_bins, spike_events, source_events)
 
         else:
 
             e_tmp['isFirst'] = np.random.permutation(e_tmp.isFirst)
 
     # get the phases at which the spikes occurred and bin into novel and repeated items for each hilbert band
-    spike_phases_hilbert = _compute_spike_phase_by_freq(spike_rel_times_tmp,
-                                                        phase_bin_start,
-                                                        phase_bin_stop,
-                                                        phase_data_hilbert,
-                                                        events)
+    spike_phases_hilbert, spike_phase_events = _compute_spike_phase_by_freq(spike_bins, spike_events,
+                                                                            phase_bin_start,
+                                                                            phase_bin_stop,
+                                                                            phase_data_hilbert,
+                                                                            events)
 
     # bin into repeated and novel phases
-    novel_phases, rep_phases = _bin_phases_into_cond(spike_phases_hilbert, e_tmp)
+    novel_phases, rep_phases = _bin_phases_into_cond(spike_phases_hilbert, spike_phase_events, e_tmp)
 
     if (len(novel_phases) > 0) & (len(rep_phases) > 0):
 
@@ -604,11 +559,12 @@ def compute_phase_stats_with_shuffle(events, spike_rel_times, phase_data_hilbert
                 np.array([np.nan] * phase_data_hilbert.shape[2])), novel_phases, rep_phases
 
 
-def run_phase_stats_with_shuffle(events, spike_rel_times, phase_data_hilbert, phase_bin_start,
+def run_phase_stats_with_shuffle(events, spike_bins, spike_events, phase_data_hilbert, phase_bin_start,
                                  phase_bin_stop, parallel=None, num_perms=100, shuffle_type=1):
 
     # first, get the stats on the non-permuted data
-    stats_real, pvals_real, novel_phases, rep_phases = compute_phase_stats_with_shuffle(events, spike_rel_times,
+    stats_real, pvals_real, novel_phases, rep_phases = compute_phase_stats_with_shuffle(events, spike_bins,
+                                                                                        spike_events,
                                                                                         phase_data_hilbert,
                                                                                         phase_bin_start,
                                                                                         phase_bin_stop,
@@ -619,12 +575,12 @@ def run_phase_stats_with_shuffle(events, spike_rel_times, phase_data_hilbert, ph
     if ~np.any(np.isnan(stats_real)):
 
         if isinstance(parallel, Parallel):
-            shuff_res = parallel((delayed(f)(events, spike_rel_times, phase_data_hilbert, phase_bin_start,
+            shuff_res = parallel((delayed(f)(events, spike_bins, spike_events, phase_data_hilbert, phase_bin_start,
                                              phase_bin_stop, True, shuffle_type) for _ in range(num_perms)))
         else:
             shuff_res = []
             for _ in range(num_perms):
-                shuff_res.append(f(events, spike_rel_times, phase_data_hilbert, phase_bin_start,
+                shuff_res.append(f(events, spike_bins, spike_events, phase_data_hilbert, phase_bin_start,
                                    phase_bin_stop, do_permute=True))
         shuff_res = [x[0] for x in shuff_res]
         mean_shuf_novel_phases = np.array([pycircstat.mean(x[2], axis=0) for x in shuff_res])
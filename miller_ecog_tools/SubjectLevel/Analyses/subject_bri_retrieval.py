@@ -7,13 +7,11 @@ import matplotlib as mpl
 import matplotlib.pyplot as plt
 import numpy as np
 import pandas as pd
-import xarray
 
 from tqdm import tqdm
 from joblib import Parallel, delayed
 from scipy import signal
 from scipy.stats import zscore, ttest_ind, sem
-from scipy.signal import hilbert
 from ptsa.data.timeseries import TimeSeries
 from ptsa.data.filters import MorletWaveletFilter
 from mpl_toolkits.axes_grid1 import make_axes_locatable
@@ -21,6 +19,8 @@ from mpl_toolkits.axes_grid1 import make_axes_locatable
 from miller_ecog_tools.SubjectLevel.subject_analysis import SubjectAnalysisBase
 from miller_ecog_tools.SubjectLevel.subject_BRI_data import SubjectBRIData
 from miller_ecog_tools.Utils import neurtex_bri_helpers as bri
+from miller_ecog_tools.Utils import spike_binning
+from miller_ecog_tools.Utils import filter_bank
 
 # figure out the number of cores available for a parallel pool. Will use half
 import multiprocessing
@@ -108,10 +108,9 @@ class SubjectBRIRetrievalAnalysis(SubjectAnalysisBase, SubjectBRIData):
                     # samples = int(np.ceil(float(eeg_channel['samplerate']) * self.buffer))
 
                     # next, compute phase as a function of time for each event and each hilbert band
-                    power_phase_data = [compute_hilbert_at_single_band(eeg_channel, freq, self.buffer)
-                                        for freq in self.hilbert_bands]
-                    phase_data = xarray.concat([x[1] for x in power_phase_data],
-                                               dim='frequency').transpose('event', 'time', 'frequency')
+                    _, phase_data = filter_bank.hilbert_filter_bank(eeg_channel.squeeze(), self.hilbert_bands,
+                                                                    self.buffer)
+                    phase_data = phase_data.transpose('event', 'time', 'frequency')
 
                     # also store region and hemisphere for easy reference
                     self.res[channel_grp.name]['region'] = eeg_channel.event.data['region'][0]
@@ -123,12 +122,13 @@ class SubjectBRIRetrievalAnalysis(SubjectAnalysisBase, SubjectBRIData):
                         self.res[channel_grp.name]['spiking'][clust_str] = {}
 
                         # compute number of spikes at each timepoint and the time in samples when each occurred
-                        spike_counts, spike_rel_times = self._create_spiking_counts(cluster_grp, events,
-                                                                                    eeg_channel.shape[1])
+                        spike_counts, spike_bins, spike_events = self._create_spiking_counts(cluster_grp, events,
+                                                                                             eeg_channel.shape[1])
 
                         # 3. compute the phase of each spike at each frequency using the already computed phase data
                         # for this channel.
-                        spike_phase_df = self._compute_spike_phase_by_freq(spike_rel_times,
+                        spike_phase_df = self._compute_spike_phase_by_freq(spike_bins,
+                                                                           spike_events,
                                                                            self.phase_bin_start,
                                                                            self.phase_bin_stop,
                                                                            phase_data,
@@ -205,54 +205,35 @@ class SubjectBRIRetrievalAnalysis(SubjectAnalysisBase, SubjectBRIData):
         return pd.concat(lag_dfs)
 
     def _create_spiking_counts(self, cluster_grp, events, n):
-        spike_counts = []
-        spike_ts = []
+        # load the spike times of every event for this cluster at once
+        spike_times, offsets = bri.load_event_spike_times(cluster_grp, events.index.values)
 
-        # loop over each event
-        for index, e in events.iterrows():
-            # load the spike times for this cluster
-            spike_times = np.array(cluster_grp[str(index)])
+        # bin the spikes of all events on a grid of n timestamps spanning each event, careful to convert ms to
+        # microseconds. Each spike is assigned to the closest timestamp following it
+        spike_counts, spike_bins = spike_binning.bin_event_spikes(spike_times, offsets,
+                                                                  events.stTime.values + self.start_ms * 1000,
+                                                                  events.stTime.values + self.stop_ms * 1000, n)
+        spike_events = np.repeat(np.arange(len(offsets) - 1), np.diff(offsets))
+        return spike_counts, spike_bins, spike_events
 
-            # interpolate the timestamps for this event
-            start = e.stTime + self.start_ms * 1000
-            stop = e.stTime + self.stop_ms * 1000
-            timestamps = np.linspace(start, stop, n, endpoint=True)
+    def _compute_spike_phase_by_freq(self, spike_bins, spike_events, phase_bin_start, phase_bin_stop, phase_data,
+                                     events):
 
-            # find the closest timestamp to each spike (technically, the closest timestamp following a spike, but I
-            # think this level of accuracy is fine). This is the searchsorted command. Then count the number of spikes
-            # that occurred at each timepoint with histogram
-            spike_bins = np.searchsorted(timestamps, spike_times)
-            bin_counts, _ = np.histogram(spike_bins, np.arange(len(timestamps) + 1))
-            spike_counts.append(bin_counts)
-            spike_ts.append(spike_bins)
-
-        return np.stack(spike_counts, 0), spike_ts
+        # only will count samples the occurred within window defined by phase_bin_start and _stop
+        valid_samps = (phase_data.time.values > phase_bin_start) & (phase_data.time.values < phase_bin_stop)
 
-    def _compute_spike_phase_by_freq(self, spike_rel_times, phase_bin_start, phase_bin_stop, phase_data, events):
+        # phase of every spike at every frequency, along with the event of each spike
+        phases, phase_events = spike_binning.event_spike_phases(spike_bins, spike_events, phase_data, valid_samps)
 
-        # only will count samples the occurred within window defined by phase_bin_start and _stop
-        valid_samps = np.where((phase_data.time > phase_bin_start) & (phase_data.time < phase_bin_stop))[0]
-
-        # will grow as we iterate over spikes in each condition.
-        phase_lag_correct = []
-        for (index, e), spikes, phase_data_event in zip(events.iterrows(), spike_rel_times, phase_data):
-
-            is_novel_event = e.isFirst
-            event_lag = e.lag
-            is_correct_event = (e.oldKey & ~is_novel_event) | (~e.oldKey & is_novel_event)
-
-            if len(spikes) > 0:
-                valid_spikes = spikes[np.in1d(spikes, valid_samps)]
-                if len(valid_spikes) > 0:
-                    event_df = pd.DataFrame([*phase_data_event[valid_spikes].data.T,
-                                             [event_lag] * len(valid_spikes),
-                                             [is_correct_event] * len(valid_spikes),
-                                             [is_novel_event] * len(valid_spikes),
-                                             [index] * len(valid_spikes)]).T
-                    event_df.columns = [*np.array(['{}-{}'.format(*x) for x in self.hilbert_bands]),
-                                        'lag', 'correct', 'is_novel', 'event']
-                    phase_lag_correct.append(event_df)
-        return pd.concat(phase_lag_correct).reset_index(drop=True)
+        # label each spike with the lag, accuracy and novelty of its event
+        is_novel_event = events.isFirst.values
+        is_correct_event = (events.oldKey.values & ~is_novel_event) | (~events.oldKey.values & is_novel_event)
+        phase_lag_correct = pd.DataFrame(phases, columns=['{}-{}'.format(*x) for x in self.hilbert_bands])
+        phase_lag_correct['lag'] = events.lag.values[phase_events]
+        phase_lag_correct['correct'] = is_correct_event[phase_events]
+        phase_lag_correct['is_novel'] = is_novel_event[phase_events]
+        phase_lag_correct['event'] = events.index.values[phase_events]
+        return phase_lag_correct
 
     def _create_eeg_timeseries(self, grp, events):
         data = np.array(grp['ev_eeg'])
@@ -278,26 +259,10 @@ class SubjectBRIRetrievalAnalysis(SubjectAnalysisBase, SubjectBRIData):
 
 def compute_hilbert_at_single_band(eeg, freq_band, buffer_len):
 
-    # band pass eeg
-    # makes sure to pass in a list not an array because wtf PTSA
-    band_eeg = bri.band_pass_eeg(eeg, freq_band.tolist() if isinstance(freq_band, np.ndarray) else freq_band).squeeze()
-
-    # run hilbert to get the complexed valued result
-    complex_hilbert_res = hilbert(band_eeg.data, N=band_eeg.shape[-1], axis=-1)
-
-    # get phase at each timepoint
-    phase_data = band_eeg.copy()
-    phase_data.data = np.angle(complex_hilbert_res)
-    phase_data = phase_data.remove_buffer(buffer_len)
-    phase_data.coords['frequency'] = np.mean(freq_band)
-
-    # and power
-    power_data = band_eeg.copy()
-    power_data.data = np.abs(complex_hilbert_res) ** 2
-    power_data = power_data.remove_buffer(buffer_len)
-    power_data.coords['frequency'] = np.mean(freq_band)
+    # band pass and hilbert transform in the frequency domain, with the buffer removed
+    power_data, phase_data = filter_bank.hilbert_filter_bank(eeg.squeeze(), [freq_band], buffer_len)
+    return power_data[0], phase_data[0]
 
-    return power_data, phase_data
 
 def compute_phase_at_single_freq(eeg, freq, buffer_len):
 
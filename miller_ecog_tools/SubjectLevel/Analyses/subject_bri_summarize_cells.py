@@ -22,6 +22,7 @@ from mpl_toolkits.axes_grid1 import make_axes_locatable
 from miller_ecog_tools.SubjectLevel.subject_analysis import SubjectAnalysisBase
 from miller_ecog_tools.SubjectLevel.subject_BRI_data import SubjectBRIData
 from miller_ecog_tools.Utils import neurtex_bri_helpers as bri
+from miller_ecog_tools.Utils import spike_binning
 
 # figure out the number of cores available for a parallel pool. Will use half
 import multiprocessing
@@ -106,8 +107,8 @@ class SubjectBRISummarizeCellsAnalysis(SubjectAnalysisBase, SubjectBRIData):
                     clust_str = cluster_grp.name.split('/')[-1]
 
                     # first compute number of spikes at each timepoint and the time in samples when each occurred
-                    spike_counts, spike_rel_times = self._create_spiking_counts(cluster_grp, events,
-                                                                                eeg_channel.shape[1])
+                    spike_counts, spike_bins, spike_events = self._create_spiking_counts(cluster_grp, events,
+                                                                                         eeg_channel.shape[1])
 
                     # based on the spiking, compute firing rate and normalized firing rate for the default
                     # presentation interval
@@ -172,28 +173,16 @@ class SubjectBRISummarizeCellsAnalysis(SubjectAnalysisBase, SubjectBRIData):
         return df
 
     def _create_spiking_counts(self, cluster_grp, events, n):
-        spike_counts = []
-        spike_ts = []
-
-        # loop over each event
-        for index, e in events.iterrows():
-            # load the spike times for this cluster
-            spike_times = np.array(cluster_grp[str(index)])
-
-            # interpolate the timestamps for this event
-            start = e.stTime + self.start_ms * 1000
-            stop = e.stTime + self.stop_ms * 1000
-            timestamps = np.linspace(start, stop, n, endpoint=True)
-
-            # find the closest timestamp to each spike (technically, the closest timestamp following a spike, but I
-            # think this level of accuracy is fine). This is the searchsorted command. Then count the number of spikes
-            # that occurred at each timepoint with histogram
-            spike_bins = np.searchsorted(timestamps, spike_times)
-            bin_counts, _ = np.histogram(spike_bins, np.arange(len(timestamps) + 1))
-            spike_counts.append(bin_counts)
-            spike_ts.append(spike_bins)
-
-        return np.stack(spike_counts, 0), spike_ts
+        # load the spike times of every event for this cluster at once
+        spike_times, offsets = bri.load_event_spike_times(cluster_grp, events.index.values)
+
+        # bin the spikes of all events on a grid of n timestamps spanning each event, careful to convert ms to
+        # microseconds. Each spike is assigned to the closest timestamp following it
+        spike_counts, spike_bins = spike_binning.bin_event_spikes(spike_times, offsets,
+                                                                  events.stTime.values + self.start_ms * 1000,
+                                                                  events.stTime.values + self.stop_ms * 1000, n)
+        spike_events = np.repeat(np.arange(len(offsets) - 1), np.diff(offsets))
+        return spike_counts, spike_bins, spike_events
 
     def _create_eeg_timeseries(self, grp, events):
         data = np.array(grp['ev_eeg'])
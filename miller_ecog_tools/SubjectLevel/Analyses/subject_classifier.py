@@ -9,6 +9,8 @@ import numpy as np
 import pandas as pd
 import seaborn as sns
 from mpl_toolkits.axes_grid1 import make_axes_locatable
+from joblib import Parallel, delayed
+from scipy.special import expit
 from scipy.stats import zscore, zmap
 from sklearn.linear_model import LogisticRegression
 from sklearn.metrics import roc_auc_score, roc_curve
@@ -53,6 +55,15 @@ class SubjectClassifierAnalysis(SubjectAnalysisBase, SubjectRamPowerData):
         self.compute_null_dist = False
         self.num_iters = 100
 
+        # If the data have a time dimension (ie, .time_bins was set), these will classify each time bin seperately
+        # instead of flattening time into the feature vector. If temporal_generalization is also True, the classifier
+        # trained at each time bin will be tested on every other time bin, giving a train time x test time matrix
+        self.time_resolved = False
+        self.temporal_generalization = False
+
+        # number of parallel jobs to use when classifying time bins
+        self.n_jobs = 12
+
     def _generate_res_save_path(self):
         self.res_save_dir = os.path.join(os.path.split(self.save_dir)[0], self.__class__.__name__+'_res')
 
@@ -100,15 +111,23 @@ class SubjectClassifierAnalysis(SubjectAnalysisBase, SubjectRamPowerData):
             print('%s classifier: please provide a .recall_filter_func function.' % self.subject)
         y = self.recall_filter_func(self.subject_data)
 
-        # zscore the data by session, and reshape to obs x features
-        x = self.zscore_data().reshape(self.subject_data.shape[0], -1)
-
         # create the classifier
         classifier = LogisticRegression(C=self.C, penalty=self.norm, solver='liblinear')
 
         # compute the cross validatin folds
         cv_dict, is_multi_sess = self._make_cross_val_labels()
 
+        # classify each time bin seperately if desired
+        if self.time_resolved or self.temporal_generalization:
+            if self.subject_data.ndim != 4:
+                print('%s classifier: time resolved classification requires data with a time dimension.' % self.subject)
+                return
+            self._time_resolved_analysis(cv_dict, is_multi_sess, classifier, y)
+            return
+
+        # zscore the data by session, and reshape to obs x features
+        x = self.zscore_data().reshape(self.subject_data.shape[0], -1)
+
         # do the actual classification
         auc, probs = do_cv(cv_dict, is_multi_sess, classifier, x, y, permute=False)
 
@@ -132,6 +151,52 @@ class SubjectClassifierAnalysis(SubjectAnalysisBase, SubjectRamPowerData):
             self.res['auc_null'] = np.array(auc_null)
             self.res['p_val'] = np.mean(self.res['auc'] < auc_null)
 
+    def _time_resolved_analysis(self, cv_dict, is_multi_sess, classifier, y):
+        """
+        Classifies each time bin seperately. The data are zscored once and reshaped to events x features x time bins,
+        and then each training time bin is sent to a parallel pool. Within each job, the fold models are tested on all
+        requested test time bins at once.
+
+        Sets res['auc_by_time'] and res['probs_by_time'], and res['auc_gen'] if .temporal_generalization is True. If
+        .compute_null_dist is True, also sets res['auc_null_by_time'] (num_iters x time bins) and res['p_val_by_time'].
+        """
+
+        # zscore the data by session, and reshape to obs x features x time bins
+        x = self.zscore_data()
+        x = x.reshape(x.shape[0], -1, x.shape[-1])
+        num_bins = x.shape[-1]
+
+        # if computing the temporal generalization matrix, test every training bin on all the bins
+        test_bins = [np.arange(num_bins) if self.temporal_generalization else np.array([t]) for t in range(num_bins)]
+        res = Parallel(n_jobs=self.n_jobs, verbose=5)(delayed(do_cv_time_resolved)(cv_dict, is_multi_sess, classifier,
+                                                                                   x, y, t, test_bins[t])
+                                                      for t in range(num_bins))
+
+        # store the diagonal (train and test at the same time bin) in either case
+        if self.temporal_generalization:
+            auc_gen = np.stack([r[0] for r in res], 0)
+            self.res['auc_gen'] = auc_gen
+            self.res['auc_by_time'] = np.diag(auc_gen)
+            self.res['probs_by_time'] = np.stack([r[1][:, t] for t, r in enumerate(res)], -1)
+        else:
+            self.res['auc_by_time'] = np.concatenate([r[0] for r in res])
+            self.res['probs_by_time'] = np.concatenate([r[1] for r in res], -1)
+        self.res['time'] = self.subject_data.time.data
+        self.res['is_multi_sess'] = is_multi_sess
+        self.res['y'] = y
+
+        # compute null distribution of the AUC at each time bin if desired. Each permutation of the behavioral labels is
+        # shared by all the time bins. For temporal generalization, only the diagonal gets a null distribution
+        if self.compute_null_dist:
+            y_perms = [np.random.permutation(y) for _ in range(self.num_iters)]
+            res_null = Parallel(n_jobs=self.n_jobs, verbose=5)(delayed(do_cv_time_resolved)(cv_dict, is_multi_sess,
+                                                                                            classifier, x, y_perm, t,
+                                                                                            np.array([t]))
+                                                               for y_perm in y_perms for t in range(num_bins))
+            auc_null = np.array([r[0][0] for r in res_null]).reshape(self.num_iters, num_bins)
+            self.res['auc_null_by_time'] = auc_null
+            self.res['p_val_by_time'] = np.mean(self.res['auc_by_time'] < auc_null, axis=0)
+
     @staticmethod
     def do_fit_model(classifier, x_train, y_train):
         """
@@ -313,4 +378,46 @@ def do_cv(cv_dict, is_multi_sess, classifier, x, y, permute=False):
     # predictions of the within session CVs
     all_test_bool = np.any(np.stack([cv_dict[x]['test_bool'] for x in cv_dict]), axis=0)
     auc = fold_aucs.mean() if is_multi_sess else roc_auc_score(y[all_test_bool], probs[all_test_bool])
+    return auc, probs
+
+
+def do_cv_time_resolved(cv_dict, is_multi_sess, classifier, x, y, train_bin, test_bins):
+    """
+    Same as do_cv(), but for events x features x time bins data. The model for each fold is trained on a single time bin
+    and then tested on all of test_bins at once. Test data are scaled by the mean and sd of the training data at the
+    same time bin.
+
+    Returns AUC (num test bins) and class probabilities (num events x num test bins).
+    """
+
+    fold_aucs = np.empty(shape=(len(cv_dict), len(test_bins)), dtype=float)
+    probs = np.empty(shape=(y.shape[0], len(test_bins)), dtype=float)
+
+    for cv_num, cv in enumerate(cv_dict.keys()):
+        train_bool = cv_dict[cv]['train_bool']
+        test_bool = cv_dict[cv]['test_bool']
+
+        # mean and sd of training data at every test bin, so that we can scale all the test bins at once
+        x_train = x[train_bool][:, :, test_bins]
+        train_mean = x_train.mean(axis=0)
+        train_std = x_train.std(axis=0)
+
+        # fit on the training bin, which is zscored the same as do_cv()
+        classifier = SubjectClassifierAnalysis.do_fit_model(classifier, zscore(x[train_bool, :, train_bin], axis=0),
+                                                            y[train_bool])
+
+        # and predict the class probability for all the test bins with one matrix product
+        x_test = (x[test_bool][:, :, test_bins] - train_mean) / train_std
+        decision = np.einsum('eft,f->et', x_test, classifier.coef_[0]) + classifier.intercept_[0]
+        test_probs = expit(decision)
+        probs[test_bool] = test_probs
+
+        if is_multi_sess:
+            fold_aucs[cv_num] = [roc_auc_score(y[test_bool], p) for p in test_probs.T]
+
+    all_test_bool = np.any(np.stack([cv_dict[x]['test_bool'] for x in cv_dict]), axis=0)
+    if is_multi_sess:
+        auc = fold_aucs.mean(axis=0)
+    else:
+        auc = np.array([roc_auc_score(y[all_test_bool], p[all_test_bool]) for p in probs.T])
     return auc, probs
\ No newline at end of file
@@ -10,12 +10,15 @@ import seaborn as sns
 import numexpr as ne
 import statsmodels.api as sm
 from mpl_toolkits.axes_grid1 import make_axes_locatable
-from scipy.stats import sem, ttest_ind
+from scipy.stats import sem
 from joblib import Parallel, delayed
 from fooof import FOOOF
 
 from miller_ecog_tools.SubjectLevel.subject_analysis import SubjectAnalysisBase
 from miller_ecog_tools.SubjectLevel.subject_ram_power_data import SubjectRamPowerData
+from miller_ecog_tools.Utils import ecog_helpers, spec_param
+from miller_ecog_tools.Utils.par_dispatch import SharedArrays, chunk_slices
+from miller_ecog_tools.Utils.robust_reg import batch_robust_reg
 
 
 class SubjectFitSpectraAnalysis(SubjectAnalysisBase, SubjectRamPowerData):
@@ -48,6 +51,13 @@ class SubjectFitSpectraAnalysis(SubjectAnalysisBase, SubjectRamPowerData):
         # difference between the means of the conditions
         self.fooof_fit_each_event = False
 
+        # If True (and use_fooof is True), use the fast batched spectral parameterization in Utils.spec_param instead of
+        # the fooof package. This is fast enough to set fooof_fit_each_event to True.
+        self.fast_fooof = False
+
+        # number of parallel workers to use when fitting
+        self.n_jobs = 12
+
     def _generate_res_save_path(self):
         self.res_save_dir = os.path.join(os.path.split(self.save_dir)[0], self.__class__.__name__+'_res')
 
@@ -67,76 +77,61 @@ class SubjectFitSpectraAnalysis(SubjectAnalysisBase, SubjectRamPowerData):
         # p_spects = self.normalize_power_spectrum()
         p_spects = self.subject_data.data
 
-        # and fit each channel and event. This parallelizes over whatever the last dimension
-        # if number of dimensions is 4, then we have time bins. We want to parallelize over channels or time, depending
-        # on which dimension is bigger. This will also help with memory usage of the stats down below
-        is_swapped = False
-        if (p_spects.ndim == 4) and (p_spects.shape[3] < p_spects.shape[2]):
-            p_spects = p_spects.swapaxes(2, 3)
-            is_swapped = True
-
         # if we are using robust regression, add a constant column to the indep var
         if not self.use_fooof:
             f = robust_reg
             x = sm.tools.tools.add_constant(np.log10(self.freqs))
 
         # if fooof, our indep var is just the freqs with no constant.
-        # also, fooof wants the y vals not in log space, so undo if we have already logged the power values
+        # also, fooof wants the y vals not in log space, so undo if we have already logged the power values. The fast
+        # version works directly on log power
         else:
-            f = run_foof
             x = self.freqs
-            if self.log_power:
-                p_spects = self.subject_data.data
-                p_spects = ne.evaluate("10**p_spects")
+            if self.fast_fooof:
+                f = run_fast_foof
+                if not self.log_power:
+                    p_spects = np.log10(p_spects)
+            else:
+                f = run_foof
+                if self.log_power:
+                    p_spects = self.subject_data.data
+                    p_spects = ne.evaluate("10**p_spects")
 
             # only give fooof the mean of each condition.
             if not self.fooof_fit_each_event:
                 p_spects = np.stack([p_spects[recalled].mean(axis=0), p_spects[~recalled].mean(axis=0)], 0)
 
-        # run the fitting procedure
-        res = Parallel(n_jobs=12, verbose=5)(delayed(f)(x, y.T) for y in p_spects.T)
+        # run the fitting procedure on every spectrum. This parallelizes over chunks of spectra
+        slopes, offsets, resids = self.fit_all_spectra(f, x, p_spects)
 
         if (not self.use_fooof) or (self.use_fooof and self.fooof_fit_each_event):
 
-            # for every frequency, electrode, timebin, subtract mean recalled from mean non-recalled
-            delta_resid = [np.nanmean(x[2][recalled], axis=0) - np.nanmean(x[2][~recalled], axis=0) for x in res]
-            delta_resid = np.stack(delta_resid, -1)
-            delta_slopes = [np.nanmean(x[0][recalled], axis=0) - np.nanmean(x[0][~recalled], axis=0) for x in res]
-            delta_slopes = np.stack(delta_slopes, -1)
-            delta_offsets = [np.nanmean(x[1][recalled], axis=0) - np.nanmean(x[1][~recalled], axis=0) for x in res]
-            delta_offsets = np.stack(delta_offsets, -1)
-
-            # run ttest at each frequency and electrode comparing remembered and not remembered events on resids
-            ttest_resid = [ttest_ind(x[2][recalled], x[2][~recalled], axis=0) for x in res]
-            ts_resid = np.stack([x.statistic for x in ttest_resid], -1)
-            ps_resid = np.stack([x.pvalue for x in ttest_resid], -1)
+            # for every frequency, electrode, timebin, subtract mean recalled from mean non-recalled, and run ttest
+            # comparing remembered and not remembered events on resids
+            delta_resid, ts_resid, ps_resid = ecog_helpers.compute_sme_stats(resids, recalled)
 
             # also compare slopes
-            ttest_slopes = [ttest_ind(x[0][recalled], x[0][~recalled], axis=0) for x in res]
-            ts_slopes = np.stack([x.statistic for x in ttest_slopes], -1)
-            ps_slopes = np.stack([x.pvalue for x in ttest_slopes], -1)
+            delta_slopes, ts_slopes, ps_slopes = ecog_helpers.compute_sme_stats(slopes, recalled)
 
             # and offsets
-            ttest_slopes = [ttest_ind(x[1][recalled], x[1][~recalled], axis=0) for x in res]
-            ts_offsets = np.stack([x.statistic for x in ttest_slopes], -1)
-            ps_offsets = np.stack([x.pvalue for x in ttest_slopes], -1)
+            delta_offsets, ts_offsets, ps_offsets = ecog_helpers.compute_sme_stats(offsets, recalled)
 
-            self.res['ts_resid'] = ts_resid if not is_swapped else np.swapaxes(ts_resid, 1, 2)
-            self.res['ps_resid'] = ps_resid if not is_swapped else np.swapaxes(ps_resid, 1, 2)
-            self.res['ts_slopes'] = ts_slopes if not is_swapped else np.swapaxes(ts_slopes, 0, 1)
-            self.res['ps_slopes'] = ps_slopes if not is_swapped else np.swapaxes(ps_slopes, 0, 1)
-            self.res['ts_offsets'] = ts_offsets if not is_swapped else np.swapaxes(ts_offsets, 0, 1)
-            self.res['ps_offsets'] = ps_offsets if not is_swapped else np.swapaxes(ps_offsets, 0, 1)
+            self.res['ts_resid'] = ts_resid
+            self.res['ps_resid'] = ps_resid
+            self.res['ts_slopes'] = ts_slopes
+            self.res['ps_slopes'] = ps_slopes
+            self.res['ts_offsets'] = ts_offsets
+            self.res['ps_offsets'] = ps_offsets
 
         elif self.use_fooof and not self.fooof_fit_each_event:
-            delta_resid = np.stack([x[2][0] - x[2][1] for x in res], -1)
-            delta_slopes = np.stack([x[0][0] - x[0][1] for x in res], -1)
-            delta_offsets = np.stack([x[1][0] - x[1][1] for x in res], -1)
-
-        # store results. Swap the axes back if we swapped them
-        self.res['delta_resid'] = delta_resid if not is_swapped else np.swapaxes(delta_resid, 1, 2)
-        self.res['delta_slopes'] = delta_slopes if not is_swapped else np.swapaxes(delta_slopes, 1, 2)
-        self.res['delta_offsets'] = delta_offsets if not is_swapped else np.swapaxes(delta_offsets, 1, 2)
+            delta_resid = resids[0] - resids[1]
+            delta_slopes = slopes[0] - slopes[1]
+            delta_offsets = offsets[0] - offsets[1]
+
+        # store results
+        self.res['delta_resid'] = delta_resid
+        self.res['delta_slopes'] = delta_slopes
+        self.res['delta_offsets'] = delta_offsets
         self.res['p_recall'] = np.mean(recalled)
         self.res['recalled'] = recalled
 
@@ -306,6 +301,49 @@ class SubjectFitSpectraAnalysis(SubjectAnalysisBase, SubjectRamPowerData):
                 ax2.set_xticks([])
                 ax2.axis('off')
 
+    def fit_all_spectra(self, f, x, p_spects):
+        """
+        Fits every power spectrum in p_spects with f (robust_reg or run_foof), in parallel over chunks of spectra. The
+        power is put in shared memory once, and the workers write their fits directly into shared output arrays.
+
+        Parameters
+        ----------
+        f: function
+            robust_reg or run_foof
+        x: numpy.ndarray
+            Independent variable to pass to f
+        p_spects: numpy.ndarray
+            events x frequency x ... array of power spectra
+
+        Returns
+        -------
+        slopes: numpy.ndarray
+            events x ... array
+        offsets: numpy.ndarray
+            events x ... array
+        resids: numpy.ndarray
+            Same shape as p_spects
+        """
+
+        # all spectra as rows, frequency last
+        y = np.moveaxis(np.asarray(p_spects), 1, -1)
+        other_shape = y.shape[:-1]
+        y = y.reshape(-1, y.shape[-1])
+
+        with SharedArrays() as shared:
+            y_shared = shared.share(y)
+            slopes = shared.empty(y.shape[0])
+            offsets = shared.empty(y.shape[0])
+            resids = shared.empty(y.shape)
+            Parallel(n_jobs=self.n_jobs, verbose=5)(delayed(_fit_chunk)(f, x, y_shared, chunk, slopes, offsets, resids)
+                                                    for chunk in chunk_slices(y.shape[0], self.n_jobs * 4))
+
+            # copy out of shared memory before it goes away, and put frequency back as the second dimension
+            slopes = np.array(slopes).reshape(other_shape)
+            offsets = np.array(offsets).reshape(other_shape)
+            resids = np.moveaxis(np.array(resids).reshape(other_shape + (y.shape[-1],)), -1, 1)
+        return slopes, offsets, resids
+
     def compute_pow_two_series(self):
         """
         This convoluted line computes a series powers of two up to and including one power higher than the
@@ -314,6 +352,13 @@ class SubjectFitSpectraAnalysis(SubjectAnalysisBase, SubjectRamPowerData):
         return np.power(2, range(int(np.log2(2 ** (int(self.freqs[-1]) - 1).bit_length())) + 1))
 
 
+def _fit_chunk(f, x, y, chunk, slopes, offsets, resids):
+    """
+    Fits the spectra in rows chunk of y with f, writing the results into the shared output arrays.
+    """
+    slopes[chunk], offsets[chunk], resids[chunk] = f(x, y[chunk])
+
+
 def run_foof(x, y):
     """
     Fits the FOOOF (fitting oscillations & one over f) model.
@@ -350,34 +395,35 @@ def run_foof(x, y):
     return slopes, offsets, resids
 
 
+def run_fast_foof(x, y):
+    """
+    Fits the fast spectral parameterization (aperiodic + gaussian peaks) to every row of y (log power) at once.
+
+    Returns slopes (aperiodic exponents, num obs), offsets (num obs), and the peak fit power spectra (num obs x num
+    features), matching run_foof().
+    """
+    res = spec_param.fit_spectra(x, y, peak_width_limits=[1.0, 8.0], peak_threshold=0.5)
+    return res['exponents'].astype('float32'), res['offsets'].astype('float32'), res['peak_fit'].astype('float32')
+
+
 def robust_reg(x, y):
     """
-    Fits a robust regression, looping over each entry in y.
+    Fits a least squares line to each entry in y, all at once.
 
     Returns slopes (num obs), offsets (num obs), and residuals (num obs x num features)
     """
-    res_shape = (y.shape[0], y.shape[-1]) if y.ndim == 3 else y.shape[0]
-    slopes = np.full(res_shape, np.nan, dtype='float32')
-    offsets = np.full(res_shape, np.nan, dtype='float32')
-    resids = np.full(y.shape, np.nan, dtype='float32')
-
-    for i, this_event in enumerate(y):
-        if this_event.ndim == 2:
-            freq_dim = np.array([n == len(x) for n in this_event.shape])
-            freq_dim_num = np.where(freq_dim)[0][0]
-            if freq_dim_num == 0:
-                this_event = this_event.T
-            for j, this_event_sub in enumerate(this_event):
-                rlm = sm.robust.robust_linear_model.RLM(this_event_sub, x,
-                                                       M=sm.robust.norms.LeastSquares())
-                rlm_results = rlm.fit()
-                offsets[i,j] = rlm_results.params[0]
-                slopes[i,j] = rlm_results.params[1]
-                resids[i, :, j] = rlm_results.resid
-        else:
-            rlm = sm.robust.robust_linear_model.RLM(this_event, x, M=sm.robust.norms.LeastSquares())
-            rlm_results = rlm.fit()
-            offsets[i] = rlm_results.params[0]
-            slopes[i] = rlm_results.params[1]
-            resids[i] = rlm_results.resid
-    return slopes, offsets, resids
\ No newline at end of file
+    log_freqs = x[:, 1]
+
+    # fit every spectrum at once, with frequency as the last dimension
+    if y.ndim == 3:
+        y_flat = y.swapaxes(1, 2).reshape(-1, y.shape[1])
+    else:
+        y_flat = y
+    offsets, slopes, resids, _ = batch_robust_reg(y_flat, log_freqs, norm='ols')
+
+    if y.ndim == 3:
+        res_shape = (y.shape[0], y.shape[-1])
+        resids = resids.reshape(y.shape[0], y.shape[2], y.shape[1]).swapaxes(1, 2)
+        slopes = slopes.reshape(res_shape)
+        offsets = offsets.reshape(res_shape)
+    return slopes.astype('float32'), offsets.astype('float32'), resids.astype('float32')
@@ -2,8 +2,9 @@ import os
 import numpy as np
 import pandas as pd
 
-from tarjan import tarjan
-from scipy.spatial.distance import pdist, squareform
+from scipy import sparse
+from scipy.sparse.csgraph import connected_components
+from scipy.spatial import cKDTree
 
 # bunch of matplotlib stuff
 import matplotlib.pyplot as plt
@@ -75,7 +76,7 @@ class SubjectOscillationClusterAnalysis(SubjectAnalysisBase, SubjectRamPowerData
         3. Identifying at which each electrode has peaks over the 1/f background power
         4. Identifying clusters based on being spatially contiguous, as defined by spatial distance (.min_elec_dist),
            electrode type (.elec_types_allowed), hemisphere (.separate_hemis), and frequency contiguous
-           (.cluster_freq_range). This uses the "targan" algorithm.
+           (.cluster_freq_range). Clusters are connected components of a sparse graph of neighboring electrodes.
         """
 
         # make sure we have data
@@ -83,14 +84,9 @@ class SubjectOscillationClusterAnalysis(SubjectAnalysisBase, SubjectRamPowerData
             print('%s: compute or load data first with .load_data()!' % self.subject)
             return
 
-        # make distance matrix for all electrodes. If separating the hemispheres, move the hemispheres far apart
-        xyz = self._get_elec_xyz()
-        if self.separate_hemis:
-            xyz[xyz[:, 0] < 0, 0] -= 100000
-        elec_dists = squareform(pdist(xyz))
-
-        # figure out which pairs of electrodes are closer than the threshold
-        near_adj_matr = (elec_dists < self.min_elec_dist) & (elec_dists > 0.)
+        # sparse graph of the pairs of electrodes that are closer than the threshold. If separating the hemispheres,
+        # electrodes in different hemispheres are never neighbors
+        near_adj_matr = make_elec_neighbor_graph(self._get_elec_xyz(), self.min_elec_dist, self.separate_hemis)
 
         # if bipolar, we don't have the type info, so use all. Lame.
         if self.bipolar:
@@ -110,158 +106,192 @@ class SubjectOscillationClusterAnalysis(SubjectAnalysisBase, SubjectRamPowerData
         self.res['peaks'] = peaks
         self.res['clusters'] = self.find_clusters_from_peaks2(peaks, near_adj_matr, allowed_elecs)
 
-    def find_clusters_from_peaks(self, peaks, near_adj_matr, allowed_elecs):
+    def find_clusters_from_peaks(self, peaks, near_adj_matr, allowed_elecs, cluster_freq_range=None):
         """
-        Given a a frequency by channel array, use the tarjan algorithm to identify clusters of electrodes.
+        Given a a frequency by channel array, find connected components of neighboring electrodes with peaks in the
+        same frequency window to identify clusters of electrodes.
 
         Parameters
         ----------
         peaks: numpy.ndarray
             frequency x channel boolean array
-        near_adj_matr: numpy.ndarray
-            square boolean array indicating whether any two electrodes are considered to be near each other
+        near_adj_matr: scipy.sparse.csr_matrix
+            sparse square boolean array indicating whether any two electrodes are considered to be near each other, as
+            returned by make_elec_neighbor_graph()
         allowed_elecs: numpy.array
             boolean array the same length as the number of electrodes, indicating whether an electrode can be included
             or should be automatically excluded
+        cluster_freq_range: float
+            window size to find clusters (in Hz). Defaults to .cluster_freq_range
 
         Returns
         -------
         pandas.DataFrame with a row for each electrode and a olumn for each cluster, named cluster1, cluster2, ...
         The value indicates the frequency of the peak for that electrode. NaN means no peak/not in cluster.
         """
+        if cluster_freq_range is None:
+            cluster_freq_range = self.cluster_freq_range
 
         # compute frequency bins
         window_centers = np.arange(self.freqs[0], self.freqs[-1] + .001, 1)
-        windows = [(x - self.cluster_freq_range / 2., x + self.cluster_freq_range / 2.) for x in window_centers]
-        window_bins = np.stack([(self.freqs >= x[0]) & (self.freqs <= x[1]) for x in windows], axis=0)
+        window_bins = np.abs(self.freqs - window_centers[:, np.newaxis]) <= cluster_freq_range / 2.
 
         # make sure only electrodes of allowed types are included
+        peaks = peaks.copy()
         peaks[:, ~allowed_elecs] = False
 
-        # bin peaks, count them up, and find the peaks (of the peaks...)xw
-        binned_peaks = np.stack([np.any(peaks[x], axis=0) for x in window_bins], axis=0)
+        # bin peaks, count them up, and find the peaks (of the peaks...). Also compute the mean peak frequency of every
+        # electrode in every window
+        win_int = window_bins.astype(int)
+        n_peaks_in_win = win_int @ peaks.astype(int)
+        binned_peaks = n_peaks_in_win > 0
+        with np.errstate(divide='ignore', invalid='ignore'):
+            mean_freq_in_win = (win_int * self.freqs) @ peaks / n_peaks_in_win
         peak_freqs = my_local_max(binned_peaks.sum(axis=1))
 
         # for each peak frequency, identify clusters
+        near_coo = near_adj_matr.tocoo()
         cluster_count = 0
         df_list = []
         for this_peak_freq in peak_freqs:
-            near_this_peak_freq = near_adj_matr.copy()
-
-            # This is leaving in only electrodes with a peak at this freq?
-            near_this_peak_freq[~binned_peaks[this_peak_freq]] = False
-            near_this_peak_freq[:, ~binned_peaks[this_peak_freq]] = False
 
-            # use targan algorithm to find the clusters
-            graph = {}
-            for elec, row in enumerate(near_this_peak_freq):
-                graph[elec] = np.where(row)[0]
-            clusters = tarjan(graph)
+            # only leave in electrodes with a peak at this freq, and find the connected components
+            labels = _components_of_subgraph(near_coo, binned_peaks[this_peak_freq])
 
             # only keep clusters with enough electrodes
-            good_clusters = np.array([len(x) for x in clusters]) >= self.min_num_elecs
-            for good_cluster in np.where(good_clusters)[0]:
+            cluster_sizes = np.bincount(labels)
+            for good_cluster in np.where(cluster_sizes >= self.min_num_elecs)[0]:
                 cluster_count += 1
+                cluster_elecs = labels == good_cluster
 
-                # store all electrodes in the cluster
+                # store all electrodes in the cluster, with the mean frequency of each electrode's peaks
                 col_name = 'cluster{}'.format(cluster_count)
                 cluster_df = pd.DataFrame(data=np.full(shape=(peaks.shape[1]), fill_value=np.nan), columns=[col_name])
-
-                # find mean frequency of cluster, first taking the mean freq within each electrode and then across
-                mean_freqs = []
-                for elec in peaks[window_bins[this_peak_freq]][:, clusters[good_cluster]].T:
-                    mean_freqs.append(np.mean(self.freqs[window_bins[this_peak_freq]][elec]))
-                cluster_df.iloc[clusters[good_cluster], 0] = mean_freqs
+                cluster_df.iloc[cluster_elecs, 0] = mean_freq_in_win[this_peak_freq, cluster_elecs]
                 df_list.append(cluster_df)
 
-        # also add some useful info to the table. x,y,z and electrode name
-        df = None
-        if df_list:
-            df = pd.concat(df_list, axis='columns')
-            x, y, z = self._get_elec_xyz().T
-            df['x'] = x
-            df['y'] = y
-            df['z'] = z
-            df['label'] = self.elec_info['label']
-
         # return df with column for each cluster
-        return df
+        return self._make_cluster_df(df_list)
 
     def find_clusters_from_peaks2(self, peaks, near_adj_matr, allowed_elecs):
         """
         More advanced clustering algo from Honghui.
+
+        In each of up to 10 rounds, the frequency window with the most peaks is found, the largest connected component
+        of neighboring electrodes with a peak in that window is used as a seed, and the seed is grown by adding
+        electrodes that have more than one neighbor in the cluster and a peak near the median frequency of those
+        neighbors.
         """
 
         steplength = 5
         windowLength = 15
-        distance = 25
+        num_freqs = peaks.shape[0]
         CLUSTERS = []
-        # allowed_elecs = np.array([e in self.elec_types_allowed for e in self.e_type])
-        # xyz_tmp = np.stack(self.elec_xyz_avg[allowed_elecs])
-        # elec_dists = squareform(pdist(xyz_tmp))
-        # near_adj_matr = (elec_dists < 25) & (elec_dists > 0)
-        peaks[:, ~allowed_elecs] = False
-        peakid = peaks
-        # peak,peakid=par_find_peaks_by_ev(self.subject_data[:,:,allowed_elecs].mean(dim='events'))
-        windows = np.stack([[i, windowLength + i] for i in range(0, 201 - steplength, steplength)])
+        peakid = peaks.copy()
+        peakid[:, ~allowed_elecs] = False
+
+        # neighbors of each electrode, from the sparse graph
+        near_adj_matr = near_adj_matr.tocsr()
+        near_coo = near_adj_matr.tocoo()
+        neighbors = np.split(near_adj_matr.indices, near_adj_matr.indptr[1:-1])
+
+        windows = np.stack([[i, windowLength + i] for i in range(0, num_freqs + 1 - steplength, steplength)])
         for ire in range(10):
-            peak_counts = np.sum(peakid, axis=1)
-            window_counts = np.array([sum(peak_counts[w[0]:w[1]]) for w in windows])
+
+            # count the peaks in each window
+            cum_counts = np.concatenate([[0], np.cumsum(np.sum(peakid, axis=1))])
+            window_counts = cum_counts[np.minimum(windows[:, 1], num_freqs)] - cum_counts[windows[:, 0]]
             peak_window = np.argmax(window_counts)
-            near_this_ev = near_adj_matr.copy()
-            peak_within_window = np.any(peakid[windows[peak_window, 0]:windows[peak_window, 1]], axis=0)
-            near_this_ev[~peak_within_window, :] = False
-            near_this_ev[:, ~peak_within_window] = False
-            # use targan algorithm to find the clusters
-            graph = {}
-            for elec, row in enumerate(near_this_ev):
-                graph[elec] = np.where(row)[0]
-            groups = tarjan(graph)
-            # choose the connected componet with most electrodes as seed
-            clusterSeed = sorted(sorted(groups, key=lambda a: -len(a))[0])
-            # make it a dictionary
-            window_true = np.zeros((200), dtype=bool)
+            window_true = np.zeros(num_freqs, dtype=bool)
             window_true[windows[peak_window, 0]:windows[peak_window, 1]] = True
+
+            # choose the connected component with most electrodes as seed
+            labels = _components_of_subgraph(near_coo, np.any(peakid[window_true], axis=0))
+            clusterSeed = np.where(labels == np.argmax(np.bincount(labels)))[0]
+
+            # make it a dictionary
             cluster = {}
             if len(clusterSeed) > 1:
                 for i in clusterSeed:
-                    peak_freq = np.squeeze(np.where(np.logical_and(peakid[:, i], window_true))[0][0])
+                    peak_freq = np.where(peakid[:, i] & window_true)[0][0]
                     cluster[i] = peak_freq
                     peakid[peak_freq, i] = False
+
+            # grow the cluster until no more electrodes are added
             if len(cluster) > 1:
                 for ire2 in range(10):
-                    for i in range(len(near_adj_matr)):
+                    n_in_cluster = len(cluster)
+                    for i in range(len(neighbors)):
                         if i not in cluster:
-                            near_freqS = np.squeeze(list(cluster.values()))[near_adj_matr[i, list(cluster.keys())]]
+                            near_freqS = [cluster[j] for j in neighbors[i] if j in cluster]
                             if len(near_freqS) > 1:
-                                window_true = np.zeros((200), dtype=bool)
-                                window_true[windows[peak_window, 0]:windows[peak_window, 1]] = True
                                 near_freq = int(np.median(near_freqS))
                                 electrode_frequency = np.where(peakid[:, i])[0]
                                 if np.any(np.abs(electrode_frequency - near_freq) < 15):
-                                    peak_freq = np.array(min(electrode_frequency, key=lambda x: abs(x - near_freq)))
+                                    peak_freq = electrode_frequency[np.argmin(np.abs(electrode_frequency - near_freq))]
                                     cluster[i] = peak_freq
                                     peakid[peak_freq, i] = False
+                    if len(cluster) == n_in_cluster:
+                        break
                 CLUSTERS.append(cluster)
-        for i in CLUSTERS:
-            for j in i:
-                i[j] = self.freqs[i[j]]
-        res = {}
-        i = 0
-        while i < (len(CLUSTERS)):
-            if len(CLUSTERS[i]) > 3:
-                res[i] = CLUSTERS[i]
-            i += 1
-        cluster_count = 0
-        df_list = []
 
-        for i in res.keys():
-            cluster_count += 1
-            col_name = 'cluster{}'.format(cluster_count)
+        # keep clusters with more than three electrodes, and convert frequency indices to frequencies
+        df_list = []
+        for cluster in [x for x in CLUSTERS if len(x) > 3]:
+            col_name = 'cluster{}'.format(len(df_list) + 1)
             cluster_df = pd.DataFrame(data=np.full(shape=(peaks.shape[1]), fill_value=np.nan), columns=[col_name])
-            for j in res[i]:
-                cluster_df.iloc[j] = res[i][j]
+            cluster_df.iloc[list(cluster.keys()), 0] = self.freqs[list(cluster.values())]
             df_list.append(cluster_df)
+        return self._make_cluster_df(df_list)
+
+    def sweep_cluster_params(self, min_elec_dists, cluster_freq_ranges=None):
+        """
+        Computes clusters with find_clusters_from_peaks() for every combination of spatial distance and frequency
+        window size, reusing the peaks computed by .analysis() and a single spatial index of the electrodes.
+
+        Parameters
+        ----------
+        min_elec_dists: list
+            spatial distances considered near (mm)
+        cluster_freq_ranges: list
+            window sizes to find clusters (in Hz). Defaults to [.cluster_freq_range]
+
+        Returns
+        -------
+        dict
+            Keys are (min_elec_dist, cluster_freq_range) tuples, values are the cluster DataFrames
+        """
+        if 'peaks' not in self.res:
+            print('%s: run .analysis() first to find the peaks.' % self.subject)
+            return
+
+        if cluster_freq_ranges is None:
+            cluster_freq_ranges = [self.cluster_freq_range]
+
+        # if bipolar, we don't have the type info, so use all. Lame.
+        if self.bipolar:
+            allowed_elecs = np.ones(self.elec_info.shape[0]).astype(bool)
+        else:
+            allowed_elecs = np.array([e in self.elec_types_allowed for e in self.elec_info['type']])
+
+        # find all the pairs within the largest distance once, and then threshold them for each distance
+        xyz = self._get_elec_xyz()
+        pairs, pair_dists = _elec_pairs_within(xyz, np.max(min_elec_dists), self.separate_hemis)
+
+        res = {}
+        for min_elec_dist in min_elec_dists:
+            near_adj_matr = _pairs_to_graph(pairs[pair_dists < min_elec_dist], xyz.shape[0])
+            for cluster_freq_range in cluster_freq_ranges:
+                res[(min_elec_dist, cluster_freq_range)] = self.find_clusters_from_peaks(self.res['peaks'],
+                                                                                         near_adj_matr,
+                                                                                         allowed_elecs,
+                                                                                         cluster_freq_range)
+        return res
+
+    def _make_cluster_df(self, df_list):
+        """
+        Concatenates the cluster columns and also adds some useful info to the table. x,y,z and electrode name.
+        """
         df = None
         if df_list:
             df = pd.concat(df_list, axis='columns')
@@ -429,4 +459,59 @@ class SubjectOscillationClusterAnalysis(SubjectAnalysisBase, SubjectRamPowerData
                                                                             self.min_num_elecs,
                                                                             '_'.join(self.elec_types_allowed),
                                                                             self.separate_hemis,
-                                                                            self.cluster_freq_range)
\ No newline at end of file
+                                                                            self.cluster_freq_range)
+
+
+def _elec_pairs_within(xyz, max_dist, separate_hemis=True):
+    """
+    Uses a KD-tree to find all pairs of electrodes closer than max_dist (excluding electrodes at the same location).
+    Returns the pairs (num pairs x 2) and their distances.
+    """
+    pairs = cKDTree(xyz).query_pairs(max_dist, output_type='ndarray')
+    pair_dists = np.linalg.norm(xyz[pairs[:, 0]] - xyz[pairs[:, 1]], axis=1)
+    keep = (pair_dists < max_dist) & (pair_dists > 0.)
+
+    # If separating the hemispheres, don't connect electrodes on opposite sides
+    if separate_hemis:
+        keep &= (xyz[pairs[:, 0], 0] < 0) == (xyz[pairs[:, 1], 0] < 0)
+    return pairs[keep], pair_dists[keep]
+
+
+def _pairs_to_graph(pairs, num_elecs):
+    """
+    Symmetric sparse boolean adjacency matrix from a num pairs x 2 array of electrode pairs.
+    """
+    rows = np.concatenate([pairs[:, 0], pairs[:, 1]])
+    cols = np.concatenate([pairs[:, 1], pairs[:, 0]])
+    return sparse.csr_matrix((np.ones(len(rows), dtype=bool), (rows, cols)), shape=(num_elecs, num_elecs))
+
+
+def make_elec_neighbor_graph(xyz, min_elec_dist, separate_hemis=True):
+    """
+    Returns a sparse boolean adjacency matrix of the electrodes that are closer than min_elec_dist.
+
+    Parameters
+    ----------
+    xyz: numpy.ndarray
+        num electrodes x 3 array of electrode coordinates
+    min_elec_dist: float
+        spatial distance considered near (mm)
+    separate_hemis: bool
+        If True, electrodes in different hemispheres (based on the sign of x) are never neighbors
+
+    Returns
+    -------
+    scipy.sparse.csr_matrix
+    """
+    pairs, _ = _elec_pairs_within(xyz, min_elec_dist, separate_hemis)
+    return _pairs_to_graph(pairs, xyz.shape[0])
+
+
+def _components_of_subgraph(near_coo, nodes):
+    """
+    Connected components of the graph keeping only the edges between the electrodes in boolean array nodes. Electrodes
+    not in nodes are their own components. Labels are ordered by the lowest electrode index in each component.
+    """
+    keep = nodes[near_coo.row] & nodes[near_coo.col]
+    sub_graph = sparse.coo_matrix((near_coo.data[keep], (near_coo.row[keep], near_coo.col[keep])), shape=near_coo.shape)
+    return connected_components(sub_graph, directed=False)[1]
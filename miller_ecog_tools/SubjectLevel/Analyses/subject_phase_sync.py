@@ -8,16 +8,13 @@ import matplotlib.pyplot as plt
 import numpy as np
 import pandas as pd
 import seaborn as sns
-import pycircstat
 from mpl_toolkits.axes_grid1 import make_axes_locatable
 from scipy.stats import norm
-from scipy.signal import hilbert
 from itertools import combinations
-from joblib import Parallel, delayed
 from copy import deepcopy
 
 from ptsa.data.filters import MorletWaveletFilter
-from miller_ecog_tools.Utils import ecog_helpers
+from miller_ecog_tools.Utils import filter_bank
 from miller_ecog_tools.SubjectLevel.subject_analysis import SubjectAnalysisBase
 from miller_ecog_tools.SubjectLevel.subject_ram_eeg_data import SubjectRamEEGData
 
@@ -54,8 +51,14 @@ class SubjectPhaseSyncAnalysis(SubjectAnalysisBase, SubjectRamEEGData):
         self.do_perm_test = False
         self.n_perms = 500
 
+        # seed for the label permutations, for reproducible null distributions
+        self.perm_seed = None
+
         self.include_phase_diffs_in_res = True
 
+        # approximate memory limit, in megabytes, for the blocks of electrode pairs computed at once
+        self.max_batch_mb = 256.
+
     def _generate_res_save_path(self):
         self.res_save_dir = os.path.join(os.path.split(self.save_dir)[0], self.__class__.__name__+'_res')
 
@@ -96,110 +99,70 @@ class SubjectPhaseSyncAnalysis(SubjectAnalysisBase, SubjectRamEEGData):
             phase_data = MorletWaveletFilter(self.subject_data[:, elecs_to_use], self.wavelet_freq,
                                              output='phase', width=5, cpus=12,
                                              verbose=False).filter()
+
+            # remove the buffer
+            phase_data = phase_data.remove_buffer(self.buf_ms / 1000.)
         else:
-            # band pass eeg
-            phase_data = ecog_helpers.band_pass_eeg(self.subject_data[:, elecs_to_use], self.hilbert_band_pass_range)
+            # band pass and get phase at each timepoint, with the buffer removed
+            _, phase_data = filter_bank.hilbert_filter_bank(self.subject_data[:, elecs_to_use],
+                                                            [self.hilbert_band_pass_range], self.buf_ms / 1000.)
+            phase_data = phase_data[0]
 
-            # get phase at each timepoint
-            phase_data.data = np.angle(hilbert(phase_data.data, N=phase_data.shape[-1], axis=-1))
+        # unit phasors of every electrode, computed once and shared by all region pairs
+        phasors = np.exp(1j * phase_data.data).astype('complex64')
 
-        # remove the buffer
-        phase_data = phase_data.remove_buffer(self.buf_ms / 1000.)
+        # permutations of the recalled labels, shared by all electrode pairs
+        if self.do_perm_test:
+            perm_labels = make_perm_labels(recalled, self.n_perms, self.perm_seed)
 
         # loop over each pair of ROIs
         for region_pair in combinations(self.roi_list, 2):
             elecs_region_1 = np.where(elec_scheme.ROI.isin(region_pair[0]))[0]
             elecs_region_2 = np.where(elec_scheme.ROI.isin(region_pair[1]))[0]
 
-            elec_label_pairs = []
-            elec_pair_pvals = []
-            elec_pair_zs = []
-            elec_pair_rvls = []
-            elec_pair_pvals_rec = []
-            elec_pair_zs_rec = []
-            elec_pair_rvls_rec = []
-            elec_pair_pvals_nrec = []
-            elec_pair_zs_nrec = []
-            elec_pair_rvls_nrec = []
-            delta_mem_rayleigh_zscores = []
-            delta_mem_rvl_zscores = []
-
-            elec_pair_phase_diffs = []
-
-            # loop over all pairs of electrodes in the ROIs
-            for elec_1 in elecs_region_1:
-                for elec_2 in elecs_region_2:
-                    elec_label_pairs.append([elec_scheme.iloc[elec_1].label, elec_scheme.iloc[elec_2].label])
-
-                    # and take the difference in phase values for this electrode pair
-                    elec_pair_phase_diff = pycircstat.cdiff(phase_data[:, elec_1], phase_data[:, elec_2])
-                    if self.include_phase_diffs_in_res:
-                        elec_pair_phase_diffs.append(elec_pair_phase_diff)
-
-                    # compute the circular stats
-                    elec_pair_stats = calc_circ_stats(elec_pair_phase_diff, recalled, do_perm=False)
-                    elec_pair_pvals.append(elec_pair_stats['elec_pair_pval'])
-                    elec_pair_zs.append(elec_pair_stats['elec_pair_z'])
-                    elec_pair_rvls.append(elec_pair_stats['elec_pair_rvl'])
-                    elec_pair_pvals_rec.append(elec_pair_stats['elec_pair_pval_rec'])
-                    elec_pair_zs_rec.append(elec_pair_stats['elec_pair_z_rec'])
-                    elec_pair_pvals_nrec.append(elec_pair_stats['elec_pair_pval_nrec'])
-                    elec_pair_zs_nrec.append(elec_pair_stats['elec_pair_z_nrec'])
-                    elec_pair_rvls_rec.append(elec_pair_stats['elec_pair_rvl_rec'])
-                    elec_pair_rvls_nrec.append(elec_pair_stats['elec_pair_rvl_nrec'])
-
-                    # compute null distributions for the memory stats
-                    if self.do_perm_test:
-                        delta_mem_rayleigh_zscore, delta_mem_rvl_zscore = self.compute_null_stats(elec_pair_phase_diff,
-                                                                                                  recalled,
-                                                                                                  elec_pair_stats)
-                        delta_mem_rayleigh_zscores.append(delta_mem_rayleigh_zscore)
-                        delta_mem_rvl_zscores.append(delta_mem_rvl_zscore)
+            # all pairs of electrodes in the ROIs, with the region 2 electrode varying fastest
+            elec_label_pairs = [[elec_scheme.iloc[elec_1].label, elec_scheme.iloc[elec_2].label]
+                                for elec_1 in elecs_region_1 for elec_2 in elecs_region_2]
+
+            # compute the circular stats for every pair at once
+            region_pair_stats = pair_phase_sync(phasors[:, elecs_region_1], phasors[:, elecs_region_2], recalled,
+                                                return_phase_diffs=self.include_phase_diffs_in_res,
+                                                max_batch_mb=self.max_batch_mb)
+
+            # compute null distributions for the memory stats
+            if self.do_perm_test:
+                delta_mem_rayleigh_zscores, delta_mem_rvl_zscores = self.compute_null_stats(phasors[:, elecs_region_1],
+                                                                                            phasors[:, elecs_region_2],
+                                                                                            recalled, perm_labels)
+                region_pair_stats['delta_mem_rayleigh_zscores'] = delta_mem_rayleigh_zscores
+                region_pair_stats['delta_mem_rvl_zscores'] = delta_mem_rvl_zscores
 
             region_pair_key = '+'.join(['-'.join(r) for r in region_pair])
-            self.res[region_pair_key] = {}
+            self.res[region_pair_key] = region_pair_stats
             self.res[region_pair_key]['elec_label_pairs'] = elec_label_pairs
-            self.res[region_pair_key]['elec_pair_pvals'] = np.stack(elec_pair_pvals, 0)
-            self.res[region_pair_key]['elec_pair_zs'] = np.stack(elec_pair_zs, 0)
-            self.res[region_pair_key]['elec_pair_rvls'] = np.stack(elec_pair_rvls, 0)
-            self.res[region_pair_key]['elec_pair_pvals_rec'] = np.stack(elec_pair_pvals_rec, 0)
-            self.res[region_pair_key]['elec_pair_zs_rec'] = np.stack(elec_pair_zs_rec, 0)
-            self.res[region_pair_key]['elec_pair_pvals_nrec'] = np.stack(elec_pair_pvals_nrec, 0)
-            self.res[region_pair_key]['elec_pair_zs_nrec'] = np.stack(elec_pair_zs_nrec, 0)
-            self.res[region_pair_key]['elec_pair_rvls_rec'] = np.stack(elec_pair_rvls_rec, 0)
-            self.res[region_pair_key]['elec_pair_rvls_nrec'] = np.stack(elec_pair_rvls_nrec, 0)
-            if self.do_perm_test:
-                self.res[region_pair_key]['delta_mem_rayleigh_zscores'] = np.stack(delta_mem_rayleigh_zscores, 0)
-                self.res[region_pair_key]['delta_mem_rvl_zscores'] = np.stack(delta_mem_rvl_zscores, 0)
-            if self.include_phase_diffs_in_res:
-                self.res[region_pair_key]['elec_pair_phase_diffs'] = np.stack(elec_pair_phase_diffs, -1)
             self.res[region_pair_key]['time'] = phase_data.time.data
             self.res[region_pair_key]['recalled'] = recalled
 
-    def compute_null_stats(self, elec_pair_phase_diff, recalled, elec_pair_stats):
-
-        res = Parallel(n_jobs=12, verbose=5)(delayed(calc_circ_stats)(elec_pair_phase_diff, recalled, True)
-                                             for _ in range(self.n_perms))
-
-        # for the rayleigh z and the resultant vector length, compute the actual difference between good and bad
-        # memory at each timepoint. Then compute a null distribution from shuffled data. Then compute the rank of the
-        # real data compared to the shuffled at each timepoint. Convert rank to z-score and return
-        null_elec_pair_zs_rec = np.stack([x['elec_pair_z_rec'] for x in res], 0)
-        null_elec_pair_zs_nrec = np.stack([x['elec_pair_z_nrec'] for x in res], 0)
-        null_delta_mem_zs = null_elec_pair_zs_rec - null_elec_pair_zs_nrec
-        real_delta_mem_zs = elec_pair_stats['elec_pair_z_rec'] - elec_pair_stats['elec_pair_z_nrec']
-        delta_mem_zs_rank = np.mean(real_delta_mem_zs > null_delta_mem_zs, axis=0)
-        delta_mem_zs_rank[delta_mem_zs_rank == 0] += 1/self.n_perms
-        delta_mem_zs_rank[delta_mem_zs_rank == 1] -= 1 / self.n_perms
-
-        null_elec_pair_rvls_rec = np.stack([x['elec_pair_rvl_rec'] for x in res], 0)
-        null_elec_pair_rvls_nrec = np.stack([x['elec_pair_rvl_nrec'] for x in res], 0)
-        null_delta_mem_rvls = null_elec_pair_rvls_rec - null_elec_pair_rvls_nrec
-        real_delta_mem_rvls = elec_pair_stats['elec_pair_rvl_rec'] - elec_pair_stats['elec_pair_rvl_nrec']
-        delta_mem_rvls_rank = np.mean(real_delta_mem_rvls > null_delta_mem_rvls, axis=0)
-        delta_mem_rvls_rank[delta_mem_rvls_rank == 0] += 1/self.n_perms
-        delta_mem_rvls_rank[delta_mem_rvls_rank == 1] -= 1 / self.n_perms
+    def compute_null_stats(self, phasors_1, phasors_2, recalled, perm_labels):
+        """
+        For the rayleigh z and the resultant vector length, compute the actual difference between good and bad memory
+        at each timepoint for every electrode pair. Then compute a null distribution from shuffled labels, and the rank
+        of the real data compared to the shuffled at each timepoint. Ranks are converted to z-scores.
+
+        Returns
+        -------
+        delta_mem_rayleigh_zscores: numpy.ndarray
+            pair x time
+        delta_mem_rvl_zscores: numpy.ndarray
+            pair x time
+        """
+        delta_mem_zs_rank, delta_mem_rvls_rank = pair_phase_sync_perm_ranks(phasors_1, phasors_2, recalled,
+                                                                            perm_labels, self.max_batch_mb)
 
+        n_perms = perm_labels.shape[0]
+        for rank in [delta_mem_zs_rank, delta_mem_rvls_rank]:
+            rank[rank == 0] += 1 / n_perms
+            rank[rank == 1] -= 1 / n_perms
         return norm.ppf(delta_mem_zs_rank), norm.ppf(delta_mem_rvls_rank)
 
     def bin_eloctrodes_into_rois(self):
@@ -280,30 +243,159 @@ class SubjectPhaseSyncAnalysis(SubjectAnalysisBase, SubjectRamEEGData):
                                                                        self.bipolar)
 
 
-def calc_circ_stats(elec_pair_phase_diff, recalled, do_perm=False):
-    if do_perm:
-        recalled = np.random.permutation(recalled)
+def _rayleigh_from_sums(phasor_sums, n):
+    """
+    Rayleigh test p-value and z, and the resultant vector length, from sums of n unit phasors. Same approximation as
+    pycircstat.rayleigh().
+    """
+    R = np.abs(phasor_sums).astype('float64')
+    z = R ** 2 / n
+    pval = np.exp(np.sqrt(1 + 4 * n + 4 * (n ** 2 - R ** 2)) - (1 + 2 * n))
+    return pval, z, R / n
 
-    # compute rayleigh on the phase difference
-    elec_pair_pval, elec_pair_z = pycircstat.rayleigh(elec_pair_phase_diff, axis=0)
 
-    # compute rvl on the phase difference
-    elec_pair_rvl = pycircstat.resultant_vector_length(elec_pair_phase_diff, axis=0)
+def pair_phase_sync(phasors_1, phasors_2, recalled, return_phase_diffs=False, max_batch_mb=256.):
+    """
+    Phase synchrony statistics for every pair of electrodes between two sets of electrodes.
+
+    The summed phase difference phasors for all pairs at a timepoint are a single (chan 1 x events) @ (events x chan 2)
+    complex matrix product of the phasors of the first set with the conjugate phasors of the second. The recalled sums
+    use the phasors of the recalled events only, and the not recalled sums are the total minus the recalled sums.
+    Timepoints are processed in blocks so that the intermediate arrays stay under max_batch_mb.
+
+    Parameters
+    ----------
+    phasors_1: numpy.ndarray
+        event x chan 1 x time array of unit phasors, exp(1j * phase)
+    phasors_2: numpy.ndarray
+        event x chan 2 x time array of unit phasors
+    recalled: numpy.ndarray
+        Boolean array the same length as the number of events
+    return_phase_diffs: bool
+        Whether to also return the phase differences for every event and pair
+    max_batch_mb: float
+        Approximate memory limit for each block of timepoints
+
+    Returns
+    -------
+    dict
+        Rayleigh p-values and z-scores and resultant vector lengths of the phase differences, for all events and for
+        recalled and not recalled events, as pair x time arrays. Pairs are ordered with the chan 2 electrode varying
+        fastest. If return_phase_diffs, also 'elec_pair_phase_diffs', an event x time x pair array.
+    """
+    recalled = np.asarray(recalled, dtype=bool)
+    n_events, n_chans_1, n_times = phasors_1.shape
+    n_chans_2 = phasors_2.shape[1]
+    n_pairs = n_chans_1 * n_chans_2
+    n_rec = recalled.sum()
+    n_nrec = n_events - n_rec
+
+    # time x chan 1 x event and time x event x chan 2, so each timepoint is a matrix product
+    z_1 = np.ascontiguousarray(phasors_1.transpose(2, 1, 0), dtype='complex64')
+    z_1_rec = z_1 * recalled
+    z_2 = np.ascontiguousarray(np.conj(phasors_2).transpose(2, 0, 1), dtype='complex64')
+
+    # preallocate outputs
+    stat_keys = ['elec_pair_pvals', 'elec_pair_zs', 'elec_pair_rvls',
+                 'elec_pair_pvals_rec', 'elec_pair_zs_rec', 'elec_pair_rvls_rec',
+                 'elec_pair_pvals_nrec', 'elec_pair_zs_nrec', 'elec_pair_rvls_nrec']
+    res = {k: np.empty((n_pairs, n_times)) for k in stat_keys}
+    if return_phase_diffs:
+        res['elec_pair_phase_diffs'] = np.empty((n_events, n_times, n_pairs), dtype='float32')
+
+    # number of timepoints per block
+    per_time_bytes = n_pairs * (8 * 3 + 8 * 9) + (n_events * n_pairs * 12 if return_phase_diffs else 0)
+    block_size = max(1, int(max_batch_mb * 1e6 / per_time_bytes))
+
+    for start in range(0, n_times, block_size):
+        block = slice(start, min(start + block_size, n_times))
+        sums = z_1[block] @ z_2[block]
+        sums_rec = z_1_rec[block] @ z_2[block]
+        for suffix, these_sums, n in zip(['', '_rec', '_nrec'], [sums, sums_rec, sums - sums_rec],
+                                         [n_events, n_rec, n_nrec]):
+            pval, z, rvl = _rayleigh_from_sums(these_sums.reshape(-1, n_pairs).T, n)
+            res['elec_pair_pvals' + suffix][:, block] = pval
+            res['elec_pair_zs' + suffix][:, block] = z
+            res['elec_pair_rvls' + suffix][:, block] = rvl
+
+        if return_phase_diffs:
+            diffs = z_1[block].transpose(2, 0, 1)[:, :, :, np.newaxis] * z_2[block].transpose(1, 0, 2)[:, :, np.newaxis]
+            res['elec_pair_phase_diffs'][:, block] = np.angle(diffs).reshape(n_events, -1, n_pairs)
+    return res
+
+
+def make_perm_labels(recalled, n_perms, seed=None):
+    """
+    n_perms x events array of shuffled recalled labels (1. for recalled, 0. for not recalled).
+    """
+    rng = np.random.RandomState(seed)
+    recalled = np.asarray(recalled, dtype=bool)
+    return np.stack([rng.permutation(recalled) for _ in range(n_perms)]).astype('float32')
 
-    # also compute for recalled and not recalled items
-    elec_pair_pval_rec, elec_pair_z_rec = pycircstat.rayleigh(elec_pair_phase_diff[recalled], axis=0)
-    elec_pair_pval_nrec, elec_pair_z_nrec = pycircstat.rayleigh(elec_pair_phase_diff[~recalled], axis=0)
 
-    # and also compute resultant vector length
-    elec_pair_rvl_rec = pycircstat.resultant_vector_length(elec_pair_phase_diff[recalled], axis=0)
-    elec_pair_rvl_nrec = pycircstat.resultant_vector_length(elec_pair_phase_diff[~recalled], axis=0)
+def pair_phase_sync_perm_ranks(phasors_1, phasors_2, recalled, perm_labels, max_batch_mb=256.):
+    """
+    Rank of the real recalled minus not recalled Rayleigh z and resultant vector length of the phase differences of
+    every electrode pair, compared to null distributions made with shuffled labels.
+
+    Only the recalled and not recalled statistics depend on the labels, so the all events statistics are not
+    recomputed. For a block of electrode pairs, the difference phasors (events x pairs*time) are computed once, and
+    the recalled sums for every permutation are a single (permutations x events) @ (events x pairs*time) matrix
+    product. The not recalled sums are the total minus the recalled sums.
+
+    Parameters
+    ----------
+    phasors_1: numpy.ndarray
+        event x chan 1 x time array of unit phasors, exp(1j * phase)
+    phasors_2: numpy.ndarray
+        event x chan 2 x time array of unit phasors
+    recalled: numpy.ndarray
+        Boolean array the same length as the number of events
+    perm_labels: numpy.ndarray
+        permutations x events array of shuffled labels, from make_perm_labels()
+    max_batch_mb: float
+        Approximate memory limit for each block of pairs
+
+    Returns
+    -------
+    delta_mem_zs_rank: numpy.ndarray
+        pair x time fraction of permutations with a smaller recalled minus not recalled Rayleigh z than the real data
+    delta_mem_rvls_rank: numpy.ndarray
+        pair x time fraction of permutations with a smaller recalled minus not recalled resultant vector length
+    """
+    recalled = np.asarray(recalled, dtype=bool)
+    n_events, n_chans_1, n_times = phasors_1.shape
+    n_chans_2 = phasors_2.shape[1]
+    n_perms = perm_labels.shape[0]
+    n_rec = recalled.sum()
+    n_nrec = n_events - n_rec
+
+    # the real labels go in the first row so that they are treated exactly like the permutations
+    labels = np.concatenate([recalled[np.newaxis].astype('float32'), perm_labels]).astype('complex64')
+
+    # pairs in the same order as pair_phase_sync(), with the chan 2 electrode varying fastest
+    pairs_1, pairs_2 = [x.ravel() for x in np.meshgrid(np.arange(n_chans_1), np.arange(n_chans_2), indexing='ij')]
+    n_pairs = len(pairs_1)
+    delta_mem_zs_rank = np.empty((n_pairs, n_times))
+    delta_mem_rvls_rank = np.empty((n_pairs, n_times))
+
+    # number of pairs per block, based on the size of the permutations x pairs*time sums and derived arrays
+    per_pair_bytes = n_times * (n_events * 8 + (n_perms + 1) * 8 * 4)
+    block_size = max(1, int(max_batch_mb * 1e6 / per_pair_bytes))
+
+    conj_phasors_2 = np.conj(phasors_2)
+    for start in range(0, n_pairs, block_size):
+        block = slice(start, min(start + block_size, n_pairs))
+        diff_phasors = (phasors_1[:, pairs_1[block]] * conj_phasors_2[:, pairs_2[block]]).reshape(n_events, -1)
+        total = diff_phasors.sum(axis=0)
+        rec_sums = labels @ diff_phasors
+        rec_r = np.abs(rec_sums)
+        nrec_r = np.abs(total - rec_sums)
+
+        # rayleigh z is R ** 2 / n and resultant vector length is R / n
+        delta_mem_zs = rec_r ** 2 / n_rec - nrec_r ** 2 / n_nrec
+        delta_mem_rvls = rec_r / n_rec - nrec_r / n_nrec
+        delta_mem_zs_rank[block] = np.mean(delta_mem_zs[0] > delta_mem_zs[1:], axis=0).reshape(-1, n_times)
+        delta_mem_rvls_rank[block] = np.mean(delta_mem_rvls[0] > delta_mem_rvls[1:], axis=0).reshape(-1, n_times)
+    return delta_mem_zs_rank, delta_mem_rvls_rank
 
-    return {'elec_pair_pval': elec_pair_pval,
-            'elec_pair_z': elec_pair_z,
-            'elec_pair_rvl': elec_pair_rvl,
-            'elec_pair_pval_rec': elec_pair_pval_rec,
-            'elec_pair_z_rec': elec_pair_z_rec,
-            'elec_pair_pval_nrec': elec_pair_pval_nrec,
-            'elec_pair_z_nrec': elec_pair_z_nrec,
-            'elec_pair_rvl_rec': elec_pair_rvl_rec,
-            'elec_pair_rvl_nrec': elec_pair_rvl_nrec}
\ No newline at end of file
@@ -2,14 +2,10 @@ import os
 import re
 import numpy as np
 import pycircstat
-import numexpr
 import pandas as pd
 
-from scipy.signal import hilbert
 from scipy.stats import norm
-from scipy.stats import ttest_ind
 from sklearn.decomposition import PCA
-from joblib import Parallel, delayed
 
 # bunch of matplotlib stuff
 import matplotlib.patches as mpatches
@@ -25,6 +21,7 @@ from mpl_toolkits.axes_grid1 import make_axes_locatable
 import nilearn.plotting as ni_plot
 
 from miller_ecog_tools.Utils import ecog_helpers
+from miller_ecog_tools.Utils import filter_bank
 from miller_ecog_tools.SubjectLevel.subject_analysis import SubjectAnalysisBase
 from miller_ecog_tools.SubjectLevel.subject_ram_eeg_data import SubjectRamEEGData
 
@@ -57,6 +54,30 @@ class SubjectTravelingWaveAnalysis(SubjectAnalysisBase, SubjectRamEEGData):
         self.recall_filter_func = None
         self.num_perms = 500
 
+        # number of permutations to compute at once for the resultant vector length null distribution, and the seed
+        # for the random number generator
+        self.perm_batch_size = 100
+        self.perm_seed = None
+
+        # resolution of the (angle, spatial frequency) grid used to fit plane waves. Angles in degrees, spatial
+        # frequencies in degrees per unit distance
+        self.wave_ang_step = 5.
+        self.wave_freq_step = .5
+        self.wave_max_freq = 18.
+
+        # If True, fit waves at each time point with a coarse grid search followed by a local search at full resolution,
+        # instead of an exhaustive search. This is worth it for grids finer than the default. wave_coarse_factor is the
+        # coarse grid step, in full resolution grid points
+        self.wave_coarse_to_fine = False
+        self.wave_coarse_factor = 3
+
+        # approximate memory limit (in MB) for the batches of observations when fitting waves
+        self.wave_max_batch_mb = 256.
+
+        # If True, the single trial (time x event) wave angle, spatial frequency, and r-square of each cluster are
+        # written to a float32 .npy file in the results directory instead of being stored in .res
+        self.single_trial_waves_to_disk = False
+
         # regions within with which to average phase over electrodes for saving to res
         self.rois = [('Frontal', 'left'),
                      ('Frontal', 'right'),
@@ -95,84 +116,78 @@ class SubjectTravelingWaveAnalysis(SubjectAnalysisBase, SubjectRamEEGData):
             theta_r, params = self.compute_grid_parameters()
 
             # compute cluster stats for each cluster
-            with Parallel(n_jobs=12, verbose=5) as parallel:
-                for this_cluster_name in cluster_names:
-                    cluster_res = {}
-
-                    # get the names of the channels in this cluster
-                    cluster_elecs = self.res['clusters'][self.res['clusters'][this_cluster_name].notna()]['label']
-
-                    # for the channels in this cluster, bandpass and then hilbert to get the phase info
-                    phase_data, power_data, cluster_mean_freq = self.compute_hilbert_for_cluster(this_cluster_name)
-
-                    # reduce to only time inverval of interest
-                    time_inds = (phase_data.time >= self.cluster_stat_start_time) & (
-                            phase_data.time <= self.cluster_stat_end_time)
-                    phase_data = phase_data[:, :, time_inds]
-
-                    # get electrode coordinates in 2d
-                    norm_coords = self.compute_2d_elec_coords(this_cluster_name)
-
-                    # run the cluster stats for time-averaged data
-                    mean_rel_phase = pycircstat.mean(phase_data.data, axis=2)
-                    mean_cluster_wave_ang, mean_cluster_wave_freq, mean_cluster_r2_adj = \
-                        circ_lin_regress(mean_rel_phase.T, norm_coords, theta_r, params)
-                    cluster_res['mean_cluster_wave_ang'] = mean_cluster_wave_ang
-                    cluster_res['mean_cluster_wave_freq'] = mean_cluster_wave_freq
-                    cluster_res['mean_cluster_r2_adj'] = mean_cluster_r2_adj
-
-                    # and run it for each time point
-                    num_times = phase_data.shape[-1]
-                    data_as_list = zip(phase_data.T, [norm_coords] * num_times, [theta_r] * num_times, [params] * num_times)
-
-                    res_as_list = parallel(delayed(circ_lin_regress)(x[0].data, x[1], x[2], x[3]) for x in data_as_list)
-                    cluster_res['cluster_wave_ang'] = np.stack([x[0] for x in res_as_list], axis=0).astype('float32')
-                    cluster_res['cluster_wave_freq'] = np.stack([x[1] for x in res_as_list], axis=0).astype('float32')
-                    cluster_res['cluster_r2_adj'] = np.stack([x[2] for x in res_as_list], axis=0).astype('float32')
-                    cluster_res['mean_freq'] = cluster_mean_freq
-                    cluster_res['channels'] = cluster_elecs.values
-                    cluster_res['time'] = phase_data.time.data
-                    cluster_res['phase_data'] = pycircstat.mean(phase_data, axis=1).astype('float32')
-                    cluster_res['phase_rvl'] = pycircstat.resultant_vector_length(phase_data, axis=1).astype('float32')
-
-                    # finally, compute the subsequent memory effect
-                    if hasattr(self, 'recall_filter_func') and callable(self.recall_filter_func):
-                        recalled = self.recall_filter_func(self.subject_data)
-                        cluster_res['recalled'] = recalled
-                        delta_z, ts, ps = self.compute_sme_for_cluster(power_data)
-                        cluster_res['sme_t'] = ts
-                        cluster_res['sme_z'] = delta_z
-                        cluster_res['ps'] = ps
-                        cluster_res['phase_data_recalled'] = pycircstat.mean(phase_data[:, recalled], axis=1).astype(
-                            'float32')
-                        cluster_res['phase_data_not_recalled'] = pycircstat.mean(phase_data[:, ~recalled], axis=1).astype(
-                            'float32')
-
-                        # compute resultant vector length for recalled and not recalled. Then take the difference
-                        # between recalled and not recalled
-                        rec_rvl, not_rec_rvl = compute_rvl_by_memory(recalled, phase_data, False)
-                        rvl_sme = rec_rvl - not_rec_rvl
-
-                        # compute a null distribution of rvl_sme vules
-                        rvl_shuff_list = parallel(delayed(compute_rvl_by_memory)(recalled, phase_data, True) for _ in range(self.num_perms))
-                        rvl_sme_shuff = np.stack([x[0] - x[1] for x in rvl_shuff_list])
-
-                        # get the rank of the real sme values compared to the shuffled data
-                        rvl_sme_shuff_perc = (rvl_sme > rvl_sme_shuff).mean(axis=0)
-                        rvl_sme_shuff_perc[rvl_sme_shuff_perc == 0] += 1 / self.num_perms
-                        rvl_sme_shuff_perc[rvl_sme_shuff_perc == 1] -= 1 / self.num_perms
-
-                        # convert the ranks to a zscore
-                        z = norm.ppf(rvl_sme_shuff_perc)
-
-                        # store in res along with the number of significant electrodes in each direction
-                        cluster_res['rvl_sme_z'] = z.astype('float32')
-                        cluster_res['rvl_sme_sig_pos_n'] = np.sum(rvl_sme_shuff_perc > 0.975, axis=0)
-                        cluster_res['rvl_sme_sig_neg_n'] = np.sum(rvl_sme_shuff_perc < 0.025, axis=0)
-
-                    # finally finally, bin phase by roi
-                    cluster_res['phase_by_roi'] = self.bin_phase_by_region(phase_data, this_cluster_name)
-                    self.res['traveling_waves'][this_cluster_name] = cluster_res
+            for this_cluster_name in cluster_names:
+                cluster_res = {}
+
+                # get the names of the channels in this cluster
+                cluster_elecs = self.res['clusters'][self.res['clusters'][this_cluster_name].notna()]['label']
+
+                # for the channels in this cluster, bandpass and then hilbert to get the phase info
+                phase_data, power_data, cluster_mean_freq = self.compute_hilbert_for_cluster(this_cluster_name)
+
+                # reduce to only time inverval of interest
+                time_inds = (phase_data.time >= self.cluster_stat_start_time) & (
+                        phase_data.time <= self.cluster_stat_end_time)
+                phase_data = phase_data[:, :, time_inds]
+
+                # get electrode coordinates in 2d
+                norm_coords = self.compute_2d_elec_coords(this_cluster_name)
+
+                # run the cluster stats for time-averaged data
+                mean_rel_phase = pycircstat.mean(phase_data.data, axis=2)
+                mean_cluster_wave_ang, mean_cluster_wave_freq, mean_cluster_r2_adj = \
+                    circ_lin_regress(mean_rel_phase.T, norm_coords, theta_r, params)
+                cluster_res['mean_cluster_wave_ang'] = mean_cluster_wave_ang
+                cluster_res['mean_cluster_wave_freq'] = mean_cluster_wave_freq
+                cluster_res['mean_cluster_r2_adj'] = mean_cluster_r2_adj
+
+                # and run it for each time point and event. Results are time x event
+                waves, wave_file = self.compute_single_trial_waves(this_cluster_name, phase_data.data, norm_coords,
+                                                                   theta_r, params)
+                if wave_file is not None:
+                    cluster_res['single_trial_wave_file'] = wave_file
+                else:
+                    cluster_res['cluster_wave_ang'] = waves[0]
+                    cluster_res['cluster_wave_freq'] = waves[1]
+                    cluster_res['cluster_r2_adj'] = waves[2]
+                cluster_res['mean_freq'] = cluster_mean_freq
+                cluster_res['channels'] = cluster_elecs.values
+                cluster_res['time'] = phase_data.time.data
+                cluster_res['phase_data'] = pycircstat.mean(phase_data, axis=1).astype('float32')
+                cluster_res['phase_rvl'] = pycircstat.resultant_vector_length(phase_data, axis=1).astype('float32')
+
+                # finally, compute the subsequent memory effect
+                if hasattr(self, 'recall_filter_func') and callable(self.recall_filter_func):
+                    recalled = self.recall_filter_func(self.subject_data)
+                    cluster_res['recalled'] = recalled
+                    delta_z, ts, ps = self.compute_sme_for_cluster(power_data)
+                    cluster_res['sme_t'] = ts
+                    cluster_res['sme_z'] = delta_z
+                    cluster_res['ps'] = ps
+                    cluster_res['phase_data_recalled'] = pycircstat.mean(phase_data[:, recalled], axis=1).astype(
+                        'float32')
+                    cluster_res['phase_data_not_recalled'] = pycircstat.mean(phase_data[:, ~recalled], axis=1).astype(
+                        'float32')
+
+                    # compute resultant vector length for recalled and not recalled, take the difference
+                    # between recalled and not recalled, and get the rank of the real sme values compared to a
+                    # null distribution of shuffled data
+                    rvl_sme, rvl_sme_shuff_perc = rvl_sme_perm_test(phase_data.data, recalled, self.num_perms,
+                                                                    self.perm_batch_size, self.perm_seed)
+                    rvl_sme_shuff_perc[rvl_sme_shuff_perc == 0] += 1 / self.num_perms
+                    rvl_sme_shuff_perc[rvl_sme_shuff_perc == 1] -= 1 / self.num_perms
+
+                    # convert the ranks to a zscore
+                    z = norm.ppf(rvl_sme_shuff_perc)
+
+                    # store in res along with the number of significant electrodes in each direction
+                    cluster_res['rvl_sme_z'] = z.astype('float32')
+                    cluster_res['rvl_sme_sig_pos_n'] = np.sum(rvl_sme_shuff_perc > 0.975, axis=0)
+                    cluster_res['rvl_sme_sig_neg_n'] = np.sum(rvl_sme_shuff_perc < 0.025, axis=0)
+
+                # finally finally, bin phase by roi
+                cluster_res['phase_by_roi'] = self.bin_phase_by_region(phase_data, this_cluster_name)
+                self.res['traveling_waves'][this_cluster_name] = cluster_res
 
         else:
             print('{}: self.res must have a clusters entry before running.'.format(self.subject))
@@ -180,16 +195,95 @@ class SubjectTravelingWaveAnalysis(SubjectAnalysisBase, SubjectRamEEGData):
 
     def compute_grid_parameters(self):
         """
-        Angle and phase offsets over which to compute the traveling wave statistics. Consider making these
-        modifiable.
+        Angle and phase offsets over which to compute the traveling wave statistics. Set by .wave_ang_step,
+        .wave_freq_step, and .wave_max_freq.
         """
 
-        thetas = np.radians(np.arange(0, 356, 5))
-        rs = np.radians(np.arange(0, 18.1, .5))
+        thetas, rs = self._grid_axes()
         theta_r = np.stack([(x, y) for x in thetas for y in rs])
         params = np.stack([theta_r[:, 1] * np.cos(theta_r[:, 0]), theta_r[:, 1] * np.sin(theta_r[:, 0])], -1)
         return theta_r, params
 
+    def _grid_axes(self):
+        thetas = np.radians(np.arange(0, 360 - self.wave_ang_step / 2., self.wave_ang_step))
+        rs = np.radians(np.arange(0, self.wave_max_freq + self.wave_freq_step / 5., self.wave_freq_step))
+        return thetas, rs
+
+    def fit_waves(self, phases, coords, theta_r, params, shift_table=None):
+        """
+        Fits plane waves to a (potentially large) observations x electrodes array of phases, using either the coarse to
+        fine or the exhaustive grid search. shift_table is an optional precomputed wave_shift_table(coords, params).
+        """
+        if self.wave_coarse_to_fine:
+            thetas, rs = self._grid_axes()
+            return circ_lin_regress_coarse_to_fine(phases, coords, thetas, rs, self.wave_coarse_factor,
+                                                   self.wave_max_batch_mb)
+        return circ_lin_regress(phases, coords, theta_r, params, self.wave_max_batch_mb, shift_table)
+
+    def compute_single_trial_waves(self, cluster_name, phase_data, coords, theta_r, params):
+        """
+        Fits a plane wave to the phases of every event at every time point. Events are processed in chunks sized so that
+        the fitting intermediates stay within .wave_max_batch_mb, and the phase shift lookup table for the cluster's
+        electrodes is computed once and reused for every chunk.
+
+        Parameters
+        ----------
+        cluster_name: str
+            Name of the cluster, used in the file name when .single_trial_waves_to_disk is True
+        phase_data: numpy.ndarray
+            channel x event x time array of relative phases
+        coords: numpy.ndarray
+            channel x 2 array of electrode coordinates
+        theta_r: numpy.ndarray
+            grid of (angle, spatial frequency), from compute_grid_parameters()
+        params: numpy.ndarray
+            grid of x, y wave components, from compute_grid_parameters()
+
+        Returns
+        -------
+        waves: numpy.ndarray
+            3 x time x event float32 array of wave angle, spatial frequency, and r-square. Memory mapped if written to
+            disk.
+        wave_file: str
+            Path to the .npy file holding waves, or None if .single_trial_waves_to_disk is False
+        """
+        num_chans, num_events, num_times = phase_data.shape
+
+        wave_file = None
+        if self.single_trial_waves_to_disk:
+            if self.res_save_dir is None:
+                self._make_res_dir()
+            wave_file = os.path.join(self.res_save_dir, '{}_{}_single_trial_waves.npy'.format(self.subject,
+                                                                                            cluster_name))
+            waves = np.lib.format.open_memmap(wave_file, mode='w+', dtype='float32', shape=(3, num_times, num_events))
+        else:
+            waves = np.empty((3, num_times, num_events), dtype='float32')
+
+        # the lookup table is only used for the exhaustive search
+        shift_table = None if self.wave_coarse_to_fine else wave_shift_table(coords, params)
+
+        # number of events per chunk, based on the observations (time x event) x grid point intermediate
+        ev_chunk = _batch_size(num_times * max(params.shape[0], num_chans), self.wave_max_batch_mb)
+        for start in range(0, num_events, ev_chunk):
+            chunk_phases = phase_data[:, start:start + ev_chunk].T
+            chunk_shape = chunk_phases.shape[:2]
+            chunk_res = self.fit_waves(chunk_phases.reshape(-1, num_chans), coords, theta_r, params, shift_table)
+            waves[:, :, start:start + ev_chunk] = np.stack(chunk_res).reshape((3,) + chunk_shape)
+
+        if wave_file is not None:
+            waves.flush()
+        return waves, wave_file
+
+    def get_single_trial_waves(self, cluster_name):
+        """
+        Returns the time x event wave angle, spatial frequency, and r-square arrays of a cluster, whether they are
+        stored in .res or on disk (in which case they are memory mapped).
+        """
+        cluster_res = self.res['traveling_waves'][cluster_name]
+        if 'single_trial_wave_file' in cluster_res:
+            return np.load(cluster_res['single_trial_wave_file'], mmap_mode='r')
+        return cluster_res['cluster_wave_ang'], cluster_res['cluster_wave_freq'], cluster_res['cluster_r2_adj']
+
     def compute_hilbert_for_cluster(self, this_cluster_name):
 
         # first, get the eeg for just channels in cluster
@@ -202,19 +296,12 @@ class SubjectTravelingWaveAnalysis(SubjectAnalysisBase, SubjectRamEEGData):
         cluster_freq_range = [cluster_mean_freq - self.hilbert_half_range, cluster_mean_freq + self.hilbert_half_range]
         if cluster_freq_range[0] < SubjectTravelingWaveAnalysis.LOWER_MIN_FREQ:
             cluster_freq_range[0] = SubjectTravelingWaveAnalysis.LOWER_MIN_FREQ
-        filtered_eeg = ecog_helpers.band_pass_eeg(cluster_eeg, cluster_freq_range)
-        filtered_eeg = filtered_eeg.transpose('channel', 'event', 'time')
-
-        # run the hilbert transform
-        complex_hilbert_res = hilbert(filtered_eeg.data, N=filtered_eeg.shape[-1], axis=-1)
 
-        # compute the phase of the filtered eeg
-        phase_data = filtered_eeg.copy()
-        phase_data.data = np.unwrap(np.angle(complex_hilbert_res))
-
-        # compute the power
-        power_data = filtered_eeg.copy()
-        power_data.data = np.abs(complex_hilbert_res) ** 2
+        # band pass and hilbert transform to get the phase and power
+        power_data, phase_data = filter_bank.hilbert_filter_bank(cluster_eeg, [cluster_freq_range])
+        power_data = power_data[0].transpose('channel', 'event', 'time')
+        phase_data = phase_data[0].transpose('channel', 'event', 'time')
+        phase_data.data = np.unwrap(phase_data.data)
 
         # compute mean phase and phase difference between ref phase and each electrode phase
         ref_phase = pycircstat.mean(phase_data.data, axis=0)
@@ -237,9 +324,7 @@ class SubjectTravelingWaveAnalysis(SubjectAnalysisBase, SubjectRamEEGData):
 
         # compare the recalled and not recalled items
         recalled = self.recall_filter_func(self.subject_data)
-        delta_z = np.nanmean(z_data[recalled], axis=0) - np.nanmean(z_data[~recalled], axis=0)
-        ts, ps, = ttest_ind(z_data[recalled], z_data[~recalled])
-        return delta_z, ts, ps
+        return ecog_helpers.compute_sme_stats(z_data, recalled)
 
     def bin_phase_by_region(self, phase_data, this_cluster_name):
         """
@@ -315,7 +400,8 @@ class SubjectTravelingWaveAnalysis(SubjectAnalysisBase, SubjectRamEEGData):
         ###############################
         # ROW 1: electrodes and phase #
         ###############################
-        mean_r2 = np.nanmean(self.res['traveling_waves'][cluster_name]['cluster_r2_adj'], axis=1)
+        wave_ang, _, r2_adj = self.get_single_trial_waves(cluster_name)
+        mean_r2 = np.nanmean(r2_adj, axis=1)
         argmax_r2 = np.argmax(mean_r2)
         print(argmax_r2)
         phases = self.res['traveling_waves'][cluster_name]['phase_data'][:, argmax_r2]
@@ -368,14 +454,14 @@ class SubjectTravelingWaveAnalysis(SubjectAnalysisBase, SubjectRamEEGData):
         ############################
         # ROW 3: timecourse of RVL #
         ############################
-        rvl = pycircstat.resultant_vector_length(self.res['traveling_waves'][cluster_name]['cluster_wave_ang'], axis=1)
+        rvl = pycircstat.resultant_vector_length(np.asarray(wave_ang), axis=1)
         ax2.plot(time_axis, rvl, lw=2)
         ax2.set_ylabel('RVL', fontsize=20)
 
         ##################################
         # ROW 4: timecourse of r-squared #
         ##################################
-        ax3.plot(time_axis, np.nanmean(self.res['traveling_waves'][cluster_name]['cluster_r2_adj'], axis=1), lw=2)
+        ax3.plot(time_axis, mean_r2, lw=2)
         ax3.set_xlabel('Time (ms)', fontsize=20)
         ax3.set_ylabel('mean($R^{2}$)', fontsize=20)
 
@@ -566,35 +652,73 @@ class SubjectTravelingWaveAnalysis(SubjectAnalysisBase, SubjectRamEEGData):
         return ax
 
 
-def compute_rvl_by_memory(recalled, data, do_perm=False):
-    if do_perm:
-        recalled = np.random.permutation(recalled)
-    rec_rvl = pycircstat.resultant_vector_length(data[:, recalled], axis=1)
-    nrec_rvl = pycircstat.resultant_vector_length(data[:, ~recalled], axis=1)
-    return rec_rvl, nrec_rvl
+def rvl_sme_perm_test(phase_data, recalled, num_perms, batch_size=100, seed=None):
+    """
+    Difference in resultant vector length between recalled and not recalled events, and its rank in a null
+    distribution made by shuffling the recalled labels.
+
+    The phases are converted to unit vectors once. The summed unit vectors of the recalled events for a batch of
+    permutations are then a single (permutations x events) label matrix times (events x channels*time) matrix product,
+    and the not recalled sums are the total minus the recalled sums.
+
+    Parameters
+    ----------
+    phase_data: numpy.ndarray
+        channel x event x time array of phases
+    recalled: numpy.ndarray
+        Boolean array the same length as the number of events
+    num_perms: int
+        Number of permutations
+    batch_size: int
+        Number of permutations to compute at once
+    seed: int
+        Seed for the random number generator
+
+    Returns
+    -------
+    rvl_sme: numpy.ndarray
+        channel x time array of recalled minus not recalled resultant vector length
+    rvl_sme_shuff_perc: numpy.ndarray
+        channel x time array of the fraction of permutations with a smaller rvl_sme than the real data
+    """
+    recalled = np.asarray(recalled, dtype=bool)
+    num_chans, num_events, num_times = phase_data.shape
+    unit_vecs = np.exp(1j * np.asarray(phase_data).transpose(1, 0, 2).reshape(num_events, -1))
+    total = unit_vecs.sum(axis=0)
+    num_rec = recalled.sum()
+    num_not_rec = num_events - num_rec
+
+    def batch_rvl_sme(labels):
+        rec_sum = labels @ unit_vecs
+        return np.abs(rec_sum) / num_rec - np.abs(total - rec_sum) / num_not_rec
 
+    rvl_sme = batch_rvl_sme(recalled[np.newaxis].astype(float))[0]
 
-def circ_lin_regress(phases, coords, theta_r, params):
-    """
+    rng = np.random.RandomState(seed)
+    num_smaller = np.zeros(rvl_sme.shape)
+    for start in range(0, num_perms, batch_size):
+        this_batch = min(batch_size, num_perms - start)
+        perm_labels = np.stack([rng.permutation(recalled) for _ in range(this_batch)]).astype(float)
+        num_smaller += np.sum(rvl_sme > batch_rvl_sme(perm_labels), axis=0)
 
-    """
+    return rvl_sme.reshape(num_chans, num_times), (num_smaller / num_perms).reshape(num_chans, num_times)
 
-    n = phases.shape[1]
-    pos_x = np.expand_dims(coords[:, 0], 1)
-    pos_y = np.expand_dims(coords[:, 1], 1)
 
-    # compute predicted phases for angle and phase offset
-    x = np.expand_dims(phases, 2) - params[:, 0] * pos_x - params[:, 1] * pos_y
+def _batch_size(per_obs_elems, max_batch_mb):
+    """
+    Number of observations to process at once so that a complex128 intermediate with per_obs_elems elements per
+    observation stays under max_batch_mb megabytes.
+    """
+    return max(1, int(max_batch_mb * 1e6 / (16 * per_obs_elems)))
 
-    # Compute resultant vector length. This is faster than calling pycircstat.resultant_vector_length
-    x1 = numexpr.evaluate('sum(cos(x) / n, axis=1)')
-    x1 = numexpr.evaluate('x1 ** 2')
-    x2 = numexpr.evaluate('sum(sin(x) / n, axis=1)')
-    x2 = numexpr.evaluate('x2 ** 2')
-    Rs = numexpr.evaluate('-sqrt(x1 + x2)')
 
-    # for each time and event, find the parameters with the smallest -R
-    min_vals = theta_r[np.argmin(Rs, axis=1)]
+def _wave_fit_stats(phases, coords, min_vals):
+    """
+    Given the best fitting (angle, spatial frequency) for each observation, compute the phase offset of the plane wave
+    and the circular correlation between the actual and predicted phases.
+    """
+    pos_x = np.expand_dims(coords[:, 0], 1)
+    pos_y = np.expand_dims(coords[:, 1], 1)
 
     sl = min_vals[:, 1] * np.array([np.cos(min_vals[:, 0]), np.sin((min_vals[:, 0]))])
     offs = np.arctan2(np.sum(np.sin(phases.T - sl[0, :] * pos_x - sl[1, :] * pos_y), axis=0),
@@ -606,10 +730,120 @@ def circ_lin_regress(phases, coords, theta_r, params):
 
     # compute adjusted r square
     r2_adj = circ_corr_coef ** 2
+    return min_vals[:, 0], min_vals[:, 1], r2_adj
+
 
-    wave_ang = min_vals[:, 0]
-    wave_freq = min_vals[:, 1]
+def wave_shift_table(coords, params):
+    """
+    Lookup table of the unit vectors of the plane wave phase shifts, electrodes x grid points.
+    """
+    return np.exp(-1j * (coords @ params.T))
 
-    return wave_ang, wave_freq, r2_adj
 
+def circ_lin_regress(phases, coords, theta_r, params, max_batch_mb=256., shift_table=None):
+    """
+    Fits a plane wave to the phases of each observation by searching over every (angle, spatial frequency) in the grid
+    for the one that maximizes the resultant vector length of the residual phases.
+
+    The resultant vector length at every grid point is the magnitude of a complex matrix product of the phases as unit
+    vectors (observations x electrodes) with a lookup table of the plane wave phase shifts (electrodes x grid points),
+    so no observations x electrodes x grid points array is made. Observations are processed in batches.
+
+    Parameters
+    ----------
+    phases: numpy.ndarray
+        observations (ie, events or time points) x electrodes array of phases
+    coords: numpy.ndarray
+        electrodes x 2 array of electrode coordinates
+    theta_r: numpy.ndarray
+        grid points x 2 array of (angle, spatial frequency), as returned by compute_grid_parameters()
+    params: numpy.ndarray
+        grid points x 2 array of the x and y components of each grid point, as returned by compute_grid_parameters()
+    max_batch_mb: float
+        Approximate memory limit for the observations x grid points intermediate of each batch
+    shift_table: numpy.ndarray
+        Optional precomputed wave_shift_table(coords, params), to reuse across calls
+
+    Returns
+    -------
+    wave_ang: numpy.ndarray
+        angle of the best fitting wave for each observation
+    wave_freq: numpy.ndarray
+        spatial frequency of the best fitting wave for each observation
+    r2_adj: numpy.ndarray
+        squared circular correlation between the actual and predicted phases for each observation
+    """
+    phases = np.atleast_2d(phases)
+    if shift_table is None:
+        shift_table = wave_shift_table(coords, params)
 
+    best = np.empty(phases.shape[0], dtype=int)
+    batch_size = _batch_size(params.shape[0], max_batch_mb)
+    for start in range(0, phases.shape[0], batch_size):
+        batch = slice(start, start + batch_size)
+        best[batch] = np.argmax(np.abs(np.exp(1j * phases[batch]) @ shift_table), axis=1)
+
+    return _wave_fit_stats(phases, coords, theta_r[best])
+
+
+def circ_lin_regress_coarse_to_fine(phases, coords, thetas, rs, coarse_factor=3, max_batch_mb=256.):
+    """
+    Faster version of circ_lin_regress(). The resultant vector length is first maximized over a coarse grid made of
+    every coarse_factor-th angle and spatial frequency, and then over the full resolution grid points within one coarse
+    step of the best coarse point. This finds the same solution as the full grid search when the resultant vector length
+    is smooth on the scale of the coarse grid, with roughly coarse_factor ** 2 times fewer evaluations.
+
+    Parameters
+    ----------
+    phases: numpy.ndarray
+        observations (ie, events or time points) x electrodes array of phases
+    coords: numpy.ndarray
+        electrodes x 2 array of electrode coordinates
+    thetas: numpy.ndarray
+        full resolution angles (radians), evenly spaced over the circle
+    rs: numpy.ndarray
+        full resolution spatial frequencies (radians per unit distance), evenly spaced and starting at 0
+    coarse_factor: int
+        Step size of the coarse grid, in full resolution grid points
+    max_batch_mb: float
+        Approximate memory limit for the intermediates of each batch
+
+    Returns
+    -------
+    wave_ang, wave_freq, r2_adj, as in circ_lin_regress()
+    """
+    phases = np.atleast_2d(phases)
+    num_obs, num_elecs = phases.shape
+
+    # coarse search
+    coarse_thetas = np.arange(0, len(thetas), coarse_factor)
+    coarse_rs = np.arange(0, len(rs), coarse_factor)
+    coarse_inds = np.stack([(x, y) for x in coarse_thetas for y in coarse_rs])
+    coarse_params = rs[coarse_inds[:, 1], np.newaxis] * np.stack([np.cos(thetas[coarse_inds[:, 0]]),
+                                                                   np.sin(thetas[coarse_inds[:, 0]])], -1)
+    shift_table = wave_shift_table(coords, coarse_params)
+
+    # local offsets around the best coarse point, in full resolution grid points
+    offsets = np.arange(-coarse_factor + 1, coarse_factor)
+    local_offsets = np.stack([(x, y) for x in offsets for y in offsets])
+
+    best_theta = np.empty(num_obs, dtype=int)
+    best_r = np.empty(num_obs, dtype=int)
+    batch_size = _batch_size(max(coarse_inds.shape[0], local_offsets.shape[0] * num_elecs), max_batch_mb)
+    for start in range(0, num_obs, batch_size):
+        batch = slice(start, start + batch_size)
+        z = np.exp(1j * phases[batch])
+        coarse_best = coarse_inds[np.argmax(np.abs(z @ shift_table), axis=1)]
+
+        # full resolution grid points around the coarse best. Angles wrap around, spatial frequencies are clipped
+        theta_inds = np.mod(coarse_best[:, 0, np.newaxis] + local_offsets[:, 0], len(thetas))
+        r_inds = np.clip(coarse_best[:, 1, np.newaxis] + local_offsets[:, 1], 0, len(rs) - 1)
+        a = rs[r_inds] * np.cos(thetas[theta_inds])
+        b = rs[r_inds] * np.sin(thetas[theta_inds])
+        local_rvl = np.abs(np.einsum('oe,ole->ol', z, np.exp(-1j * (a[:, :, np.newaxis] * coords[:, 0] +
+                                                                    b[:, :, np.newaxis] * coords[:, 1]))))
+        local_best = np.argmax(local_rvl, axis=1)
+        best_theta[batch] = theta_inds[np.arange(len(local_best)), local_best]
+        best_r[batch] = r_inds[np.arange(len(local_best)), local_best]
+
+    return _wave_fit_stats(phases, coords, np.stack([thetas[best_theta], rs[best_r]], -1))
@@ -3,16 +3,17 @@ Needs some cleanup. Intended to be functions that may need to be performed many
 parallelization. Functions should accept only one input.
 """
 import numpy as np
-import statsmodels.api as sm
 import pdb
 import numexpr
-from scipy.signal import argrelmax
 from scipy.stats import ttest_ind
 from xarray import concat
 from ptsa.data.timeseries import TimeSeries
 from ptsa.data.filters import MorletWaveletFilter
 from tqdm import tqdm
 
+from miller_ecog_tools.Utils.robust_reg import batch_robust_reg
+from miller_ecog_tools.Utils.spec_param import local_max_mask
+
 
 def par_find_peaks_by_chan(info):
     """
@@ -36,16 +37,14 @@ def par_find_peaks_by_chan(info):
     frequencies = info[1]
     std_thresh = info[2]
 
-    peaks_all_chans = np.zeros(p_spect_array.shape).astype(bool)
-    for i, chan_data in enumerate(p_spect_array.T):
-        x = sm.tools.tools.add_constant(np.log10(frequencies))
-        model_res = sm.RLM(chan_data, x).fit()
-        peak_inds = argrelmax(model_res.resid)
-        peaks = np.zeros(x.shape[0], dtype=bool)
-        peaks[peak_inds] = True
-        above_thresh = model_res.resid > (np.std(model_res.resid) * std_thresh)
-        peaks_all_chans[:,i] = peaks & above_thresh
-    return peaks_all_chans
+    # fit all channels at once. resids is channels x frequencies
+    _, _, resids, _ = batch_robust_reg(np.asarray(p_spect_array).T, np.log10(frequencies))
+
+    # strict local maxima, as in scipy.signal.argrelmax
+    peaks = np.zeros(resids.shape, dtype=bool)
+    peaks[:, 1:-1] = (resids[:, 1:-1] > resids[:, :-2]) & (resids[:, 1:-1] > resids[:, 2:])
+    above_thresh = resids > (np.std(resids, axis=1, keepdims=True) * std_thresh)
+    return (peaks & above_thresh).T
 
 
 def par_robust_reg(info):
@@ -58,73 +57,23 @@ def par_robust_reg(info):
     """
 
     p_spects = info[0]
-    x = sm.tools.tools.add_constant(info[1])
-
-    # holds slope of fit line
-    slopes = np.empty((p_spects.shape[1]))
-    slopes[:] = np.nan
-
-    # holds residuals
-    resids = np.empty((p_spects.shape[0], p_spects.shape[1]))
-    resids[:] = np.nan
-
-    # holds intercepts
-    intercepts = np.empty((p_spects.shape[1]))
-    intercepts[:] = np.nan
-
-    # holds mean height of fit line
-    bband_power = np.empty((p_spects.shape[1]))
-    bband_power[:] = np.nan
-
-    # loop over every electrode
-    for i, y in enumerate(p_spects.T):
-        model_res = sm.RLM(y, x).fit()
-        intercepts[i] = model_res.params[0]
-        slopes[i] = model_res.params[1]
-        bband_power[i] = model_res.fittedvalues.mean()
-        resids[:, i] = model_res.resid
-
-    return intercepts, slopes, resids, bband_power
+    intercepts, slopes, resids, bband_power = batch_robust_reg(np.asarray(p_spects).T, info[1])
+    return intercepts, slopes, resids.T, bband_power
 
 
 def par_robust_reg_no_low_freqs(info):
     """
     Parallelizable robust regression function
 
-    info: two element list. first element, power spectra: # freqs x # elecs. Second element: log transformed freqs
+    info: three element list. first element, power spectra: # freqs x # elecs. Second element: log transformed freqs.
+    Third element: boolean array of the frequencies to include in the fit. Residuals are computed for all frequencies.
 
     returns intercepts, slopes, resids
     """
 
     p_spects = info[0]
-    x = sm.tools.tools.add_constant(info[1])
-    freq_inds = info[2]
-
-    # holds slope of fit line
-    slopes = np.empty((p_spects.shape[1]))
-    slopes[:] = np.nan
-
-    # holds residuals
-    resids = np.empty((p_spects.shape[0], p_spects.shape[1]))
-    resids[:] = np.nan
-
-    # holds intercepts
-    intercepts = np.empty((p_spects.shape[1]))
-    intercepts[:] = np.nan
-
-    # holds mean height of fit line
-    bband_power = np.empty((p_spects.shape[1]))
-    bband_power[:] = np.nan
-
-    # loop over every electrode
-    for i, y in enumerate(p_spects.T):
-        model_res = sm.RLM(y[freq_inds], x[freq_inds]).fit()
-        intercepts[i] = model_res.params[0]
-        slopes[i] = model_res.params[1]
-        bband_power[i] = model_res.fittedvalues.mean()
-        resids[:, i] = y - ((x[:, 1]*model_res.params[1]) + model_res.params[0])
-
-    return intercepts, slopes, resids, bband_power
+    intercepts, slopes, resids, bband_power = batch_robust_reg(np.asarray(p_spects).T, info[1], freq_inds=info[2])
+    return intercepts, slopes, resids.T, bband_power
 
 
 def my_local_max(arr):
@@ -149,20 +98,11 @@ def par_find_peaks(info):
 
     """
 
-    # def moving_average(a, n=3):
-    #     ret = np.cumsum(a, dtype=float)
-    #     ret[n:] = ret[n:] - ret[:-n]
-    #     return ret[n - 1:] / n
-
-    p_spect = info[0]
-    x = sm.tools.tools.add_constant(info[1])
-    model_res = sm.RLM(p_spect, x).fit()
-    peak_inds = my_local_max(model_res.resid)
-    peaks = np.zeros(x.shape[0], dtype=bool)
-    peaks[peak_inds] = True
-    above_thresh = model_res.resid > np.std(model_res.resid)
-    peaks = peaks & above_thresh
-    return peaks
+    p_spect = np.asarray(info[0])
+    _, _, resid, _ = batch_robust_reg(p_spect[np.newaxis], info[1])
+    resid = resid[0]
+    above_thresh = resid > np.std(resid)
+    return local_max_mask(resid) & above_thresh
 
 
 
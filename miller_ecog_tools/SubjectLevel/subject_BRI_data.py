@@ -3,6 +3,7 @@ import h5py
 import numpy as np
 import pandas as pd
 from tqdm import tqdm
+from joblib import Parallel, delayed
 
 
 from miller_ecog_tools.Utils import neurtex_bri_helpers as bri_helpers
@@ -47,6 +48,16 @@ class SubjectBRIData(SubjectDataBase):
         # specify if we want to load eeg event-locked or spike-locked
         self.do_event_locked = False
 
+        # directory for caching the downsampled, line noise filtered continuous LFP of each channel. If set, each ncs
+        # file is decoded and filtered once, and all event-aligned, spike-aligned and power computations read from the
+        # cache. The cache can be shared across subjects and analyses
+        self.lfp_cache_dir = None
+
+        # number of channels to compute in parallel. If 1, channels are computed one at a time directly into the subject
+        # file. Otherwise, each worker process computes a channel into a temporary file, and the channels are then
+        # copied into the subject file. Each worker decodes a full ncs file, so keep memory in mind
+        self.n_jobs = 1
+
     def compute_data(self):
         """
         Computes spike-aligned or event-aligned eeg data for BRI datasets
@@ -63,41 +74,46 @@ class SubjectBRIData(SubjectDataBase):
         event_keys_dict = {}
 
         # if we are doing event-locked, load the subject's behavioral events
-        if self.do_event_locked:
-            beh_events = bri_helpers.load_subj_events(self.task, self.subject)
+        beh_events = bri_helpers.load_subj_events(self.task, self.subject) if self.do_event_locked else None
+
+        # every channel of every session
+        channels = [(session_id, session_dict, channel_num) for session_id, session_dict in file_dict.items()
+                    for channel_num in session_dict.keys()]
 
-        # list to hold all channel data
         with h5py.File(self.save_file, 'w') as subject_data:
-            for session_id, session_dict in file_dict.items():
-                sess_grp = subject_data.create_group(session_id)
-
-                # if doing event-locked, filter behavioral events to just this session
-                if self.do_event_locked:
-                    sess_beh_events = beh_events[beh_events.expID == session_id].reset_index(drop=True)
-
-                # for each channel, load spike times of good clusters
-                for channel_num in tqdm(session_dict.keys()):
-                    s_times, clust_nums = bri_helpers.load_spikes_cluster_with_qual(session_dict, channel_num,
-                                                                                    quality=self.spike_qual_to_use)
-
-                    # get some extra info: cluster region and hemisphere. Add to dataframe that will be stored in
-                    # the event coord of chan_eeg
-                    region, hemi = bri_helpers.get_localization_by_sess(self.subject, session_id, channel_num,
-                                                                        clust_nums)
-
-                    # if we have spikes for this channel, proceed
-                    if s_times.size > 0:
-
-                        # either load eeg locked to events or locked to spikes
-                        if not self.do_event_locked:
-                            print('{}: Computing spike-aligned EEG for {} sessions.'.format(self.subject, len(file_dict)))
-                            event_keys_dict = self._compute_spike_aligned(s_times, clust_nums, session_id, session_dict,
-                                                                          sess_grp, channel_num, event_keys_dict,
-                                                                          region, hemi)
-                        else:
-                            event_keys_dict = self._compute_event_aligned(s_times, clust_nums, sess_beh_events,
-                                                                          session_dict, sess_grp, channel_num,
-                                                                          event_keys_dict, region, hemi)
+            for session_id in file_dict.keys():
+                subject_data.create_group(session_id)
+
+            # compute each channel directly into the subject file
+            if self.n_jobs == 1:
+                for session_id, session_dict, channel_num in tqdm(channels):
+                    event_keys_dict.update(self._compute_channel(session_id, session_dict, channel_num, beh_events,
+                                                                 subject_data[session_id]))
+
+            # or compute the channels in parallel, each into its own temporary file, and then copy them into the
+            # subject file
+            else:
+                tmp_dir = os.path.join(self.save_dir, 'channel_tmp')
+                if not os.path.exists(tmp_dir):
+                    os.makedirs(tmp_dir)
+                tmp_files = [os.path.join(tmp_dir, '{}_{}.hdf5'.format(session_id, channel_num))
+                             for session_id, _, channel_num in channels]
+
+                # worker processes don't share the master table settings of this one, so pass them along
+                table_settings = bri_helpers.master_table_settings()
+                channel_event_keys = Parallel(n_jobs=self.n_jobs, verbose=5)(
+                    delayed(_compute_channel_to_file)(self, session_id, session_dict, channel_num, beh_events, tmp_file,
+                                                      table_settings)
+                    for (session_id, session_dict, channel_num), tmp_file in zip(channels, tmp_files))
+
+                for (session_id, _, channel_num), tmp_file, channel_keys in zip(channels, tmp_files,
+                                                                                 channel_event_keys):
+                    with h5py.File(tmp_file, 'r') as channel_data:
+                        if str(channel_num) in channel_data[session_id]:
+                            channel_data.copy(channel_data[session_id][str(channel_num)], subject_data[session_id])
+                    os.remove(tmp_file)
+                    event_keys_dict.update(channel_keys)
+                os.rmdir(tmp_dir)
 
         # append all events from all channels to file
         for event_key in event_keys_dict.keys():
@@ -105,6 +121,39 @@ class SubjectBRIData(SubjectDataBase):
 
         return h5py.File(self.save_file, 'r')
 
+    def _compute_channel(self, session_id, session_dict, channel_num, beh_events, sess_grp):
+        """
+        Computes the spike-aligned or event-aligned data for one channel of a session and adds it to sess_grp.
+
+        Returns a dictionary of the hdf5 keys at which to store the event data, and the events.
+        """
+        event_keys_dict = {}
+
+        # load spike times of good clusters
+        s_times, clust_nums = bri_helpers.load_spikes_cluster_with_qual(session_dict, channel_num,
+                                                                        quality=self.spike_qual_to_use)
+
+        # get some extra info: cluster region and hemisphere. Add to dataframe that will be stored in the event coord
+        # of chan_eeg
+        region, hemi = bri_helpers.get_localization_by_sess(self.subject, session_id, channel_num, clust_nums)
+
+        # if we have spikes for this channel, proceed
+        if s_times.size > 0:
+
+            # either load eeg locked to events or locked to spikes
+            if not self.do_event_locked:
+                print('{}: Computing spike-aligned EEG for session {}, channel {}.'.format(self.subject, session_id,
+                                                                                         channel_num))
+                event_keys_dict = self._compute_spike_aligned(s_times, clust_nums, session_id, session_dict,
+                                                              sess_grp, channel_num, event_keys_dict, region, hemi)
+            else:
+
+                # filter behavioral events to just this session
+                sess_beh_events = beh_events[beh_events.expID == session_id].reset_index(drop=True)
+                event_keys_dict = self._compute_event_aligned(s_times, clust_nums, sess_beh_events, session_dict,
+                                                              sess_grp, channel_num, event_keys_dict, region, hemi)
+        return event_keys_dict
+
     def _compute_event_aligned(self, s_times, clust_nums, df, session_dict, sess_grp, channel_num,
                                event_keys_dict, region, hemi):
         """
@@ -124,7 +173,8 @@ class SubjectBRIData(SubjectDataBase):
                                                       self.stop_ms,
                                                       noise_freq=self.noise_freq,
                                                       downsample_freq=self.downsample_rate,
-                                                      resample_freq=self.resample_rate)
+                                                      resample_freq=self.resample_rate,
+                                                      lfp_cache_dir=self.lfp_cache_dir)
 
         # cast to 32 bit for memory issues
         channel_eeg.data = channel_eeg.data.astype('float32')
@@ -135,25 +185,21 @@ class SubjectBRIData(SubjectDataBase):
         chan_grp.attrs['channel'] = str(channel_eeg.channel.data[0])
         chan_grp.attrs['samplerate'] = float(channel_eeg.samplerate.data)
 
-        # also store timestamps of spikes
+        # also store timestamps of spikes. For each cluster, the spike times within each event's time window are stored
+        # in one flat array, along with the offset of each event's spikes into it
+        events = pd.DataFrame.from_records(channel_eeg.event.data)
+        start_times = events.stTime.values + self.start_ms * 1000
+        stop_times = events.stTime.values + self.stop_ms * 1000
         clust_grp_base = chan_grp.create_group('spike_times')
         for this_cluster in np.unique(clust_nums):
             clust_grp = clust_grp_base.create_group('cluster_'+str(this_cluster))
-            this_cluster_times = s_times[clust_nums == this_cluster]
-
-            # for each event, select spike times that fall within our timing winding
-            for index, e in df.iterrows():
-
-                # select the events, careful to convert ms to to microseconds
-                inds = (this_cluster_times > e.stTime + self.start_ms*1000) & (this_cluster_times < e.stTime + self.stop_ms*1000)
-
-                # since hdf5 can't store variable length arrays in a single dataset, I'm saving the spike times for each
-                # event as a seperate dataset. Kind of meh but it works
-                clust_grp.create_dataset(str(index), data=np.array(this_cluster_times[inds]))
+            flat_spike_times, offsets = bri_helpers.event_spike_times_csr(s_times[clust_nums == this_cluster],
+                                                                          start_times, stop_times)
+            bri_helpers.save_event_spike_times(clust_grp, flat_spike_times, offsets)
 
         # store path to where we will append the event data
         this_key = chan_grp.name + '/event'
-        event_keys_dict[this_key] = pd.DataFrame.from_records(channel_eeg.event.data)
+        event_keys_dict[this_key] = events
 
         return event_keys_dict
 
@@ -183,7 +229,8 @@ class SubjectBRIData(SubjectDataBase):
                                                         self.stop_ms,
                                                         noise_freq=self.noise_freq,
                                                         downsample_freq=self.downsample_rate,
-                                                        resample_freq=self.resample_rate)
+                                                        resample_freq=self.resample_rate,
+                                                        lfp_cache_dir=self.lfp_cache_dir)
 
             # cast to 32 bit for memory issues
             clust_eeg.data = clust_eeg.data.astype('float32')
@@ -201,7 +248,7 @@ class SubjectBRIData(SubjectDataBase):
             this_key = clust_grp.name + '/event'
             event_keys_dict[this_key] = pd.DataFrame.from_records(clust_eeg.event.data)
 
-        # also, compute power spectra for channel. Sorry, this reloads the channel data and is
+        # also, compute power spectra for channel. Without the lfp cache, this reloads the channel data and is
         # inefficient
         if self.do_compute_power:
             power_spectra = bri_helpers.power_spectra_from_spike_times(s_times, clust_nums,
@@ -211,7 +258,9 @@ class SubjectBRIData(SubjectDataBase):
                                                                        self.freqs,
                                                                        noise_freq=self.noise_freq,
                                                                        downsample_freq=self.ds_rate_pow,
-                                                                       mean_over_spikes=True)
+                                                                       mean_over_spikes=True,
+                                                                       lfp_cache_dir=self.lfp_cache_dir,
+                                                                       cache_downsample_freq=self.downsample_rate)
 
             # store the power spectra for each cluster seperately in the hdf5 file
             for cluster_key in power_spectra.keys():
@@ -393,3 +442,14 @@ class SubjectBRIData(SubjectDataBase):
                                                                '_'.join(self.spike_qual_to_use),
                                                                self.subject)
             self.save_file = os.path.join(self.save_dir, self.subject + '_data.hdf5')
+
+
+def _compute_channel_to_file(subj, session_id, session_dict, channel_num, beh_events, channel_file, table_settings):
+    """
+    Parallelizable computation of one channel's data into its own hdf5 file, with the same session/channel layout as
+    the subject file.
+    """
+    bri_helpers.apply_master_table_settings(table_settings)
+    with h5py.File(channel_file, 'w') as channel_data:
+        return subj._compute_channel(session_id, session_dict, channel_num, beh_events,
+                                     channel_data.create_group(session_id))
@@ -2,6 +2,7 @@ import os
 import numpy as np
 
 from miller_ecog_tools.Utils import ecog_helpers
+from miller_ecog_tools.Utils import session_norm
 from miller_ecog_tools.subject import SubjectDataBase
 
 
@@ -74,13 +75,17 @@ class SubjectRamPowerData(SubjectDataBase):
         # this will hold the a dataframe of electrode locations/information after load_data() is called
         self.elec_info = None
 
+        # cache of per-session normalization statistics, so they only need to be computed once per loaded data. Cleared
+        # whenever .subject_data is set
+        self._session_stats = {}
+
     def load_data(self):
         """
         Call super's load data, and then additionally cast data to float32 to take up less space.
         """
         super(SubjectRamPowerData, self).load_data()
         if self.subject_data is not None:
-            self.subject_data.data = self.subject_data.data.astype('float32')
+            self.subject_data.data = self.subject_data.data.astype('float32', copy=False)
             self.elec_info = ecog_helpers.load_elec_info(self.subject, self.montage, self.bipolar)
 
     def compute_data(self):
@@ -90,18 +95,8 @@ class SubjectRamPowerData(SubjectDataBase):
         Sets .elec_info and returns subject_data
         """
 
-        # load subject events
-        events = ecog_helpers.load_subj_events(self.task, self.subject, self.montage, as_df=True, remove_no_eeg=True)
-
-        # load electrode info
-        self.elec_info = ecog_helpers.load_elec_info(self.subject, self.montage, self.bipolar)
-
-        # filter events if desired
-        if callable(self.event_type):
-            events_for_computation = self.event_type(events)
-        else:
-            event_type = [self.event_type] if isinstance(self.event_type, str) else self.event_type
-            events_for_computation = events[events['type'].isin(event_type)]
+        # load subject events and electrode info
+        events_for_computation = self._load_events_for_computation()
 
         # compute power with RAM_helper function
         subject_data = ecog_helpers.compute_power(events_for_computation,
@@ -122,40 +117,88 @@ class SubjectRamPowerData(SubjectDataBase):
                                                   loop_over_chans=True)
         return subject_data
 
+    def iter_power_by_channel(self):
+        """
+        Computes power one channel at a time, using the same settings as .compute_data(). Power is not cached to disk.
+        Useful when you only need a summary of each channel and the full power array would be too large. Average
+        referencing needs all channels at once, so .mono_avg_ref is not applied here.
+
+        Sets .elec_info and yields a power timeseries for each channel.
+        """
+        events_for_computation = self._load_events_for_computation()
+        return ecog_helpers.compute_power_by_channel(events_for_computation,
+                                                     self.freqs,
+                                                     self.wave_num,
+                                                     self.start_time,
+                                                     self.end_time,
+                                                     buf_ms=self.buf_ms,
+                                                     log_power=self.log_power,
+                                                     time_bins=self.time_bins,
+                                                     noise_freq=self.noise_freq,
+                                                     elec_scheme=self.elec_info,
+                                                     resample_freq=self.resample_freq,
+                                                     mean_over_time=self.mean_over_time,
+                                                     use_mirror_buf=self.use_mirror_buf)
+
+    def _load_events_for_computation(self):
+        """
+        Loads the subject's events and filters them based on .event_type. Also sets .elec_info.
+        """
+
+        # load subject events
+        events = ecog_helpers.load_subj_events(self.task, self.subject, self.montage, as_df=True, remove_no_eeg=True)
+
+        # load electrode info
+        self.elec_info = ecog_helpers.load_elec_info(self.subject, self.montage, self.bipolar)
+
+        # filter events if desired
+        if callable(self.event_type):
+            events_for_computation = self.event_type(events)
+        else:
+            event_type = [self.event_type] if isinstance(self.event_type, str) else self.event_type
+            events_for_computation = events[events['type'].isin(event_type)]
+        return events_for_computation
+
     ##########################################################################################################
     # ECoG HELPERS - Some useful methods that we commonly perform for this type of data can go here. Now all #
     # subclasses will have access to this functionality                                                      #
     ##########################################################################################################
-    def zscore_data(self):
+    def zscore_data(self, in_place=False):
         """
-        Give all our subclasses easy access to zscoring the data.
-
-        Returns a numpy array the same shape as the data.
+        Give all our subclasses easy access to zscoring the data. Session statistics are computed once and cached.
 
+        Returns a float32 numpy array the same shape as the data. If in_place is True, .subject_data itself is zscored
+        (and returned) instead of making a copy.
         """
-        return ecog_helpers.zscore_by_session(self.subject_data)
+        sessions = self.subject_data.event.data['session']
+        stats = self._get_session_stats('zscore', session_norm.zscore_stats)
+        return self._apply_session_stats(sessions, stats, in_place)
 
-    def normalize_power_spectrum(self, event_dim_str='event'):
+    def normalize_power_spectrum(self, event_dim_str='event', in_place=False):
         """
         Normalized .subject_data power spectra so that the mean power spectrum is centered at zero was an SD of 1, as
-        in Manning et al., 2009
+        in Manning et al., 2009. Session statistics are computed once and cached.
 
-        Returns a numpy array the same shape as the data.
+        Returns a float32 numpy array the same shape as the data. If in_place is True, .subject_data itself is
+        normalized (and returned) instead of making a copy.
         """
-
         sessions = self.subject_data[event_dim_str].data['session']
-        norm_spectra = np.empty(self.subject_data.shape, dtype='float32')
-        uniq_sessions = np.unique(sessions)
-        for sess in uniq_sessions:
-            sess_inds = sessions == sess
+        stats = self._get_session_stats('spectrum', session_norm.spectrum_stats, event_dim_str)
+        return self._apply_session_stats(sessions, stats, in_place)
+
+    def _get_session_stats(self, key, stats_func, event_dim_str='event'):
+        if key not in self._session_stats:
+            sessions = self.subject_data[event_dim_str].data['session']
+            self._session_stats[key] = stats_func(self.subject_data.data, sessions)
+        return self._session_stats[key]
 
-            m = np.mean(self.subject_data[sess_inds], axis=1)
-            m = np.mean(m, axis=0)
-            s = np.std(self.subject_data[sess_inds], axis=1)
-            s = np.mean(s, axis=0)
-            norm_spectra[sess_inds] = (self.subject_data[sess_inds] - m) / s
+    def _apply_session_stats(self, sessions, stats, in_place):
+        norm_data = session_norm.apply_session_stats(self.subject_data.data, sessions, stats, in_place=in_place)
 
-        return norm_spectra
+        # the cached statistics no longer describe the data if we just normalized it
+        if in_place:
+            self._session_stats = {}
+        return norm_data
 
     def bin_electrodes_by_region(self, elec_column1='stein.region', elec_column2='ind.region',
                                  x_coord_column='ind.x', roi_dict=None):
@@ -231,6 +274,16 @@ class SubjectRamPowerData(SubjectDataBase):
 
 
 
+    @property
+    def subject_data(self):
+        return self._subject_data
+
+    @subject_data.setter
+    def subject_data(self, x):
+        # the cached normalization statistics describe the old data, so they must be recomputed
+        self._subject_data = x
+        self._session_stats = {}
+
     ###################################################################################
     # dynamically update the data save location of we change the following attributes #
     ###################################################################################
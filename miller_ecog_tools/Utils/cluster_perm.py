@@ -0,0 +1,183 @@
+"""
+Cluster-based permutation testing for subsequent memory effects. Clusters are contiguous sets of supra-threshold
+t-statistics over frequency and time (and optionally neighboring electrodes). The null distribution of maximum cluster
+mass is built from label permutations that are computed in batches: the recalled/not recalled sums for many
+permutations at once are a matrix product of a permutations x events label matrix with the events x features data, and
+the clusters for the whole batch are found with one connected components pass.
+"""
+
+import numpy as np
+from scipy import sparse
+from scipy.sparse.csgraph import connected_components
+from scipy.spatial.distance import pdist, squareform
+from scipy.stats import t as t_dist
+
+from miller_ecog_tools.Utils.ecog_helpers import ttest_from_sums
+
+
+def make_adjacency_edges(shape, elec_xyz=None, max_elec_dist=None):
+    """
+    Returns the edges of the graph connecting neighboring elements of a frequency x channel (x time) array. Adjacent
+    frequencies and adjacent time points are always neighbors. If elec_xyz and max_elec_dist are given, electrodes
+    closer than max_elec_dist are also neighbors at the same frequency (and time). Otherwise, electrodes are treated
+    independently.
+
+    Parameters
+    ----------
+    shape: tuple
+        Shape of the statistics array, frequency x channel or frequency x channel x time
+    elec_xyz: numpy.ndarray
+        channel x 3 array of electrode coordinates
+    max_elec_dist: float
+        Electrodes closer than this are considered adjacent
+
+    Returns
+    -------
+    numpy.ndarray
+        num edges x 2 array of flat indices into an array of the given shape
+    """
+    node_inds = np.arange(np.prod(shape)).reshape(shape)
+    edges = []
+
+    # neighboring frequencies
+    edges.append(np.stack([node_inds[:-1].ravel(), node_inds[1:].ravel()], -1))
+
+    # neighboring time points
+    if len(shape) == 3:
+        edges.append(np.stack([node_inds[:, :, :-1].ravel(), node_inds[:, :, 1:].ravel()], -1))
+
+    # neighboring electrodes
+    if (elec_xyz is not None) and (max_elec_dist is not None):
+        elec_dists = squareform(pdist(elec_xyz))
+        elec_1, elec_2 = np.where(np.triu((elec_dists < max_elec_dist) & (elec_dists > 0.)))
+        for e1, e2 in zip(elec_1, elec_2):
+            edges.append(np.stack([node_inds[:, e1].ravel(), node_inds[:, e2].ravel()], -1))
+
+    return np.concatenate(edges, axis=0)
+
+
+def find_clusters(stats, thresh, edges):
+    """
+    Finds clusters of supra-threshold statistics for a batch of statistics arrays, seperately for positive and negative
+    values, with a single connected components pass over all of them.
+
+    Parameters
+    ----------
+    stats: numpy.ndarray
+        batch x num nodes array of statistics (ie, t-statistics from many permutations)
+    thresh: float
+        Absolute value that a statistic must exceed to be included in a cluster
+    edges: numpy.ndarray
+        num edges x 2 array of neighboring nodes, as returned by make_adjacency_edges()
+
+    Returns
+    -------
+    labels: numpy.ndarray
+        batch x num nodes array of cluster labels. -1 means not in a cluster. Labels are unique across the batch.
+    masses: numpy.ndarray
+        Signed sum of the statistics within each cluster, indexed by label
+    batch_inds: numpy.ndarray
+        The batch row of each cluster, indexed by label
+    """
+    num_batch, num_nodes = stats.shape
+    sign = np.sign(stats) * (np.abs(stats) > thresh)
+    is_supra = sign != 0
+
+    # keep the edges where both nodes are supra-threshold with the same sign, for every row of the batch at once
+    keep = is_supra[:, edges[:, 0]] & (sign[:, edges[:, 0]] == sign[:, edges[:, 1]])
+    batch_row, edge_ind = np.where(keep)
+    offsets = batch_row * num_nodes
+    graph = sparse.coo_matrix((np.ones(len(edge_ind), dtype=bool),
+                               (edges[edge_ind, 0] + offsets, edges[edge_ind, 1] + offsets)),
+                              shape=(num_batch * num_nodes, num_batch * num_nodes))
+    _, node_labels = connected_components(graph, directed=False)
+
+    # relabel so that only supra-threshold nodes are in clusters and labels are consecutive
+    flat_supra = is_supra.ravel()
+    uniq_labels, cluster_labels = np.unique(node_labels[flat_supra], return_inverse=True)
+    labels = np.full(num_batch * num_nodes, -1, dtype=int)
+    labels[flat_supra] = cluster_labels
+
+    masses = np.bincount(cluster_labels, weights=stats.ravel()[flat_supra], minlength=len(uniq_labels))
+    batch_inds = np.zeros(len(uniq_labels), dtype=int)
+    batch_inds[cluster_labels] = np.where(flat_supra)[0] // num_nodes
+    return labels.reshape(num_batch, num_nodes), masses, batch_inds
+
+
+def cluster_perm_test(data, recalled, n_perms=1000, p_thresh=0.05, equal_var=True, elec_xyz=None,
+                      max_elec_dist=None, batch_size=100, seed=None):
+    """
+    Cluster-mass permutation test of recalled vs not recalled t-statistics.
+
+    Parameters
+    ----------
+    data: numpy.ndarray
+        event x frequency x channel (x time) array, normalized by session. NaNs are ignored, with events counted per
+        cell, as in ecog_helpers.compute_sme_stats().
+    recalled: numpy.ndarray
+        Boolean array the same length as the number of events.
+    n_perms: int
+        Number of label permutations for the null distribution.
+    p_thresh: float
+        Two-sided cell-level p-value used to set the cluster forming t threshold.
+    equal_var: bool
+        If False, use Welch's t-test.
+    elec_xyz: numpy.ndarray
+        channel x 3 array of electrode coordinates. Used with max_elec_dist to connect neighboring electrodes.
+    max_elec_dist: float
+        Electrodes closer than this are considered adjacent.
+    batch_size: int
+        Number of permutations to compute at once.
+    seed: int
+        Seed for the random number generator.
+
+    Returns
+    -------
+    dict
+        'cluster_labels': int array the same shape as the statistics (-1 means not in a cluster)
+        'cluster_masses': signed mass of each observed cluster
+        'cluster_ps': permutation p-value of each observed cluster
+        'cluster_null': maximum absolute cluster mass for each permutation
+        'cluster_t_thresh': t threshold used to form clusters
+    """
+    recalled = np.asarray(recalled, dtype=bool)
+    stat_shape = data.shape[1:]
+    num_events = data.shape[0]
+
+    # events x features, its square, and whether each value is not NaN. NaNs are zeroed so they add nothing to the sums
+    x = data.reshape(num_events, -1).astype('float32')
+    valid = np.isfinite(x).astype('float32')
+    x = np.nan_to_num(x)
+    x_sq = x ** 2
+    total_n = valid.sum(axis=0, dtype='float64')
+    total_s = x.sum(axis=0, dtype='float64')
+    total_ss = x_sq.sum(axis=0, dtype='float64')
+
+    edges = make_adjacency_edges(stat_shape, elec_xyz, max_elec_dist)
+    t_thresh = t_dist.ppf(1 - p_thresh / 2., num_events - 2)
+
+    def batch_ts(labels):
+        n1 = (labels @ valid).astype('float64')
+        s1 = labels @ x
+        ss1 = labels @ x_sq
+        return ttest_from_sums(n1, s1, ss1, total_n - n1, total_s - s1, total_ss - ss1, equal_var=equal_var)[1]
+
+    # observed clusters
+    obs_ts = batch_ts(recalled[np.newaxis].astype('float32'))
+    obs_labels, obs_masses, _ = find_clusters(np.nan_to_num(obs_ts), t_thresh, edges)
+
+    # null distribution of the maximum absolute cluster mass
+    rng = np.random.RandomState(seed)
+    null_dist = np.zeros(n_perms)
+    for start in range(0, n_perms, batch_size):
+        this_batch = min(batch_size, n_perms - start)
+        perm_labels = np.stack([rng.permutation(recalled) for _ in range(this_batch)]).astype('float32')
+        _, masses, batch_inds = find_clusters(np.nan_to_num(batch_ts(perm_labels)), t_thresh, edges)
+        np.maximum.at(null_dist[start:start + this_batch], batch_inds, np.abs(masses))
+
+    cluster_ps = np.array([np.mean(null_dist >= np.abs(m)) for m in obs_masses])
+    return {'cluster_labels': obs_labels.reshape(stat_shape),
+            'cluster_masses': obs_masses,
+            'cluster_ps': cluster_ps,
+            'cluster_null': null_dist,
+            'cluster_t_thresh': t_thresh}
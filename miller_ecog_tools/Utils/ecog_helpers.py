@@ -12,13 +12,15 @@ import xarray as xr
 import bottleneck as bn
 import h5py
 
+from miller_ecog_tools.Utils import session_norm
+
 from ptsa.data.filters import ButterworthFilter
 from ptsa.data.filters import MorletWaveletFilter
 from ptsa.data.filters import ResampleFilter
 from ptsa.data.timeseries import TimeSeries
 
 from cmlreaders import CMLReader, get_data_index
-from scipy.stats.mstats import zscore
+from scipy.special import stdtr
 from scipy.io import loadmat
 from tqdm import tqdm
 from glob import glob
@@ -619,6 +621,33 @@ def compute_power(events, freqs, wave_num, rel_start_ms, rel_stop_ms, buf_ms=100
     return wave_pow
 
 
+def compute_power_by_channel(events, freqs, wave_num, rel_start_ms, rel_stop_ms, buf_ms=1000, elec_scheme=None,
+                             noise_freq=[58., 62.], resample_freq=None, mean_over_time=True, log_power=True,
+                             use_mirror_buf=False, time_bins=None):
+    """
+    Generator version of compute_power() that yields the power for one channel at a time, so that the full power array
+    never has to be held in memory. See compute_power() for a description of the parameters. Average referencing is
+    not supported here, as it requires all channels to be loaded at once.
+
+    Yields
+    ------
+    timeseries object of power values for a single channel, with events as the first dimension
+    """
+
+    # must enter an elec scheme because we are looping over channels
+    if elec_scheme is None:
+        print('elec_scheme must be entered to compute power by channel.')
+        return
+
+    if isinstance(freqs, list):
+        freqs = np.array(freqs)
+
+    for r in tqdm(range(elec_scheme.shape[0])):
+        arg_list = (events, freqs, wave_num, elec_scheme.iloc[r:r + 1], rel_start_ms, rel_stop_ms, buf_ms, noise_freq,
+                    resample_freq, mean_over_time, log_power, use_mirror_buf, time_bins, None)
+        yield make_events_first_dim(_parallel_compute_power(arg_list))
+
+
 def _parallel_compute_power(arg_list):
     """
     Returns a timeseries object of power values. Accepts the inputs of compute_power() as a single list. Probably
@@ -707,10 +736,21 @@ def make_events_first_dim(ts, event_dim_str='event'):
     return ts
 
 
-def zscore_by_session(ts, event_dim_str='event'):
+def zscore_by_session(ts, event_dim_str='event', stats=None, in_place=False):
     """
     Returns a numpy array the same shape as the original timeseries, where all the elements have been zscored by
-    session
+    session. Events must be the first dimension.
+
+    Parameters
+    ----------
+    ts: TimeSeries
+        A PTSA TimeSeries object with events as the first dimension
+    event_dim_str: str
+        the name of the event dimension
+    stats: dict
+        Optional precomputed session statistics from session_norm.zscore_stats(). Computed if not given.
+    in_place: bool
+        If True and the data are float32, the timeseries data will be zscored in place instead of copied.
 
     Returns
     -------
@@ -718,15 +758,90 @@ def zscore_by_session(ts, event_dim_str='event'):
     """
 
     sessions = ts[event_dim_str].data['session']
-    z_pow = np.empty(ts.shape, dtype='float32')
-    uniq_sessions = np.unique(sessions)
-    for sess in uniq_sessions:
-        sess_inds = sessions == sess
-        z_pow[sess_inds] = zscore(ts[sess_inds], axis=ts.get_axis_num('event'))
-    return z_pow
+    if stats is None:
+        stats = session_norm.zscore_stats(ts.data, sessions)
+    return session_norm.apply_session_stats(ts.data, sessions, stats, in_place=in_place)
 
 
+def compute_sme_stats(data, recalled, equal_var=True, chunk_size=256):
+    """
+    Computes the subsequent memory effect (difference in means between recalled and not recalled items), along with a
+    two sample t-test, at every element of the non-event dimensions. This is done in a single pass over the events
+    by accumulating per-group counts, sums, and sums of squares, so no copies of the data are made beyond a small chunk
+    of events at a time. NaNs are ignored.
+
+    Parameters
+    ----------
+    data: numpy.ndarray
+        Array with events as the first dimension. Should already be normalized (ie, zscore_by_session())
+    recalled: numpy.ndarray
+        Boolean array the same length as the number of events.
+    equal_var: bool
+        If True, do a standard independent samples t-test. If False, do Welch's t-test.
+    chunk_size: int
+        Number of events to process at once.
+
+    Returns
+    -------
+    delta_z: numpy.ndarray
+        Mean recalled minus mean not recalled, shape data.shape[1:]
+    ts: numpy.ndarray
+        t-statistics, shape data.shape[1:]
+    ps: numpy.ndarray
+        two sided p-values, shape data.shape[1:]
+    """
+
+    recalled = np.asarray(recalled, dtype=bool)
 
+    # running counts, sums, and sums of squares for the recalled (index 0) and not recalled (index 1) events
+    n = np.zeros((2,) + data.shape[1:], dtype='float64')
+    s = np.zeros((2,) + data.shape[1:], dtype='float64')
+    ss = np.zeros((2,) + data.shape[1:], dtype='float64')
 
+    for start in range(0, data.shape[0], chunk_size):
+        chunk = np.asarray(data[start:start + chunk_size])
+        chunk_recalled = recalled[start:start + chunk_size]
+        for g, group_inds in enumerate([chunk_recalled, ~chunk_recalled]):
+            x = chunk[group_inds]
+            is_good = ~np.isnan(x)
+            x = np.where(is_good, x, 0.)
+            n[g] += is_good.sum(axis=0)
+            s[g] += x.sum(axis=0, dtype='float64')
+            ss[g] += np.einsum('i...,i...->...', x, x, dtype='float64')
 
+    return ttest_from_sums(n[0], s[0], ss[0], n[1], s[1], ss[1], equal_var=equal_var)
+
+
+def ttest_from_sums(n1, s1, ss1, n2, s2, ss2, equal_var=True):
+    """
+    Two sample t-test computed from the count, sum, and sum of squares of each group. All inputs must broadcast
+    together.
+
+    Returns
+    -------
+    delta: numpy.ndarray
+        Mean of group 1 minus mean of group 2
+    ts: numpy.ndarray
+        t-statistics
+    ps: numpy.ndarray
+        two sided p-values
+    """
+    with np.errstate(divide='ignore', invalid='ignore'):
+        m1 = s1 / n1
+        m2 = s2 / n2
+        v1 = np.maximum((ss1 - n1 * m1 ** 2) / (n1 - 1), 0.)
+        v2 = np.maximum((ss2 - n2 * m2 ** 2) / (n2 - 1), 0.)
+        delta = m1 - m2
+
+        if equal_var:
+            dof = n1 + n2 - 2
+            pooled_var = ((n1 - 1) * v1 + (n2 - 1) * v2) / dof
+            ts = delta / np.sqrt(pooled_var * (1. / n1 + 1. / n2))
+        else:
+            vn1 = v1 / n1
+            vn2 = v2 / n2
+            dof = (vn1 + vn2) ** 2 / (vn1 ** 2 / (n1 - 1) + vn2 ** 2 / (n2 - 1))
+            ts = delta / np.sqrt(vn1 + vn2)
+        ps = 2 * stdtr(dof, -np.abs(ts))
 
+    return delta, ts, ps
@@ -0,0 +1,184 @@
+"""
+Band pass filtering and hilbert transform for many frequency bands at once, done entirely in the frequency domain.
+
+Filtering with a butterworth band pass filter forward and backward (filtfilt, as PTSA's ButterworthFilter does)
+multiplies the spectrum of the signal by the squared magnitude response of the filter, and the hilbert transform then
+zeroes the negative frequencies and doubles the positive ones. Both steps are just a mask on the spectrum, so the
+signal is transformed once, each band's combined mask is applied, and one inverse transform per band gives the
+analytic signal, from which phase and power follow. Apart from edge effects, which fall in the buffer, this matches
+band_pass_eeg() followed by scipy.signal.hilbert().
+"""
+
+import numpy as np
+
+from scipy import fft
+from scipy.signal import butter, sosfreqz, sosfilt
+from ptsa.data.timeseries import TimeSeries
+
+
+def analytic_band_masks(n_fft, samplerate, freq_bands, order=4):
+    """
+    Frequency domain masks that band pass filter (forward and backward) and compute the analytic signal.
+
+    Parameters
+    ----------
+    n_fft: int
+        Length of the transform
+    samplerate: float
+        Sampling rate of the signal
+    freq_bands: list
+        List of [low, high] frequency ranges
+    order: int
+        Order of butterworth filter
+
+    Returns
+    -------
+    numpy.ndarray
+        num bands x (n_fft // 2 + 1) array of weights for the non-negative frequencies of np.fft.rfft()
+    """
+    freqs = fft.rfftfreq(n_fft, 1. / samplerate)
+
+    # the negative frequencies are dropped and the positive ones doubled. DC and nyquist are left alone
+    analytic_weight = np.full(len(freqs), 2.)
+    analytic_weight[0] = 1.
+    if n_fft % 2 == 0:
+        analytic_weight[-1] = 1.
+
+    masks = np.empty((len(freq_bands), len(freqs)))
+    for band_num, freq_band in enumerate(freq_bands):
+        sos = butter(order, freq_band, btype='bandpass', fs=samplerate, output='sos')
+        _, h = sosfreqz(sos, worN=freqs, fs=samplerate)
+        masks[band_num] = np.abs(h) ** 2 * analytic_weight
+    return masks
+
+
+def filter_pad_len(samplerate, freq_bands, order=4, max_len=None, tol=1e-6):
+    """
+    Number of samples of zero padding needed so that filtering in the frequency domain does not wrap one end of the
+    signal around into the other. This is the length of the longest impulse response of the band pass filters, taken
+    as the point after which less than tol of its energy remains.
+
+    Parameters
+    ----------
+    samplerate: float
+        Sampling rate of the signal
+    freq_bands: list
+        List of [low, high] frequency ranges
+    order: int
+        Order of butterworth filter
+    max_len: int
+        Longest padding to return. Defaults to ten seconds of samples
+    tol: float
+        Fraction of the impulse response energy allowed past the padding
+
+    Returns
+    -------
+    int
+        Number of samples of padding
+    """
+    if max_len is None:
+        max_len = int(10 * samplerate)
+    impulse = np.zeros(max_len)
+    impulse[0] = 1.
+
+    pad = 0
+    for freq_band in freq_bands:
+        sos = butter(order, freq_band, btype='bandpass', fs=samplerate, output='sos')
+        energy = np.cumsum(sosfilt(sos, impulse) ** 2)
+        pad = max(pad, int(np.searchsorted(energy, (1 - tol) * energy[-1])) + 1)
+    return min(pad, max_len)
+
+
+def analytic_filter_bank(data, samplerate, freq_bands, order=4, buffer_samples=0, axis=-1):
+    """
+    Band passed analytic signal of data for every frequency band.
+
+    Parameters
+    ----------
+    data: numpy.ndarray
+        Array of signals
+    samplerate: float
+        Sampling rate of the signals
+    freq_bands: list
+        List of [low, high] frequency ranges
+    order: int
+        Order of butterworth filter
+    buffer_samples: int
+        Number of samples to remove from each end of the result
+    axis: int
+        The time axis of data
+
+    Returns
+    -------
+    numpy.ndarray
+        complex64 array of shape (num bands,) + data.shape, with time moved to the last axis and buffer_samples
+        removed from each end
+    """
+    data = np.moveaxis(np.asarray(data, dtype='float32'), axis, -1)
+    n_times = data.shape[-1]
+    n_out = n_times - 2 * buffer_samples
+
+    # zero pad by at least the length of the filters, so that the ends of the signal do not wrap around into each
+    # other, and then on to a fast length
+    n_fft = fft.next_fast_len(n_times + filter_pad_len(samplerate, freq_bands, order, max_len=n_times))
+    data_fft = fft.rfft(data, n=n_fft, axis=-1)
+    masks = analytic_band_masks(n_fft, samplerate, freq_bands, order).astype('float32')
+
+    out = np.empty((len(freq_bands),) + data.shape[:-1] + (n_out,), dtype='complex64')
+    band_fft = np.zeros(data.shape[:-1] + (n_fft,), dtype='complex64')
+    for band_num, mask in enumerate(masks):
+        np.multiply(data_fft, mask, out=band_fft[..., :data_fft.shape[-1]])
+        out[band_num] = fft.ifft(band_fft, axis=-1)[..., buffer_samples:buffer_samples + n_out]
+    return out
+
+
+def hilbert_filter_bank(eeg, freq_bands, buffer_len=0., order=4, log_power=False, return_band_eeg=False):
+    """
+    Power and phase of a TimeSeries in every frequency band, from band pass filtering and the hilbert transform.
+
+    Parameters
+    ----------
+    eeg: ptsa.timeseries
+        TimeSeries with a time dimension
+    freq_bands: list
+        List of [low, high] frequency ranges
+    buffer_len: float
+        Length of the buffer, in seconds, to remove from each end of the results
+    order: int
+        Order of butterworth filter
+    log_power: bool
+        Whether to return log10 power
+    return_band_eeg: bool
+        Whether to also return the band passed signal
+
+    Returns
+    -------
+    power_data: ptsa.timeseries
+        float32 power, with a leading 'frequency' dimension (the mean of each band) followed by the dimensions of eeg
+    phase_data: ptsa.timeseries
+        float32 phase, same shape as power_data
+    band_eeg: ptsa.timeseries
+        float32 band passed signal, if return_band_eeg
+    """
+    samplerate = float(eeg['samplerate'])
+    time_axis = eeg.get_axis_num('time')
+    buffer_samples = int(np.ceil(buffer_len * samplerate))
+    analytic = analytic_filter_bank(eeg.data, samplerate, freq_bands, order, buffer_samples, axis=time_axis)
+
+    # put time back where it was in eeg
+    analytic = np.moveaxis(analytic, -1, time_axis + 1)
+
+    # coordinates of the result, with the buffer removed from time and a coordinate for each band
+    time = eeg['time'].data[buffer_samples:eeg.shape[time_axis] - buffer_samples]
+    coords = {x: (eeg.coords[x] if x != 'time' else time) for x in eeg.coords.keys()}
+    coords['frequency'] = np.mean(freq_bands, axis=1)
+    dims = ('frequency',) + eeg.dims
+
+    power = np.abs(analytic) ** 2
+    if log_power:
+        np.log10(power, out=power)
+    power_data = TimeSeries(data=power, coords=coords, dims=dims)
+    phase_data = TimeSeries(data=np.angle(analytic), coords=coords, dims=dims)
+    if return_band_eeg:
+        return power_data, phase_data, TimeSeries(data=analytic.real.copy(), coords=coords, dims=dims)
+    return power_data, phase_data
@@ -7,24 +7,35 @@ Built for use with data from the continuous recognition (CRM) paradigm.
 
 import re
 import os
+import hashlib
 import numexpr
 import numpy as np
 import pandas as pd
+from numpy.lib.stride_tricks import sliding_window_view
 
 from ptsa.data.filters import ButterworthFilter
 from ptsa.data.filters import MorletWaveletFilter
 from ptsa.data.filters import ResampleFilter
 from ptsa.data.timeseries import TimeSeries
-from scipy.signal import resample, filtfilt, butter
+from scipy.signal import resample, butter, sosfiltfilt, firwin, upfirdn
 from glob import glob
 
 # file constants
 HEADER_SIZE = 16 * 1024
 BLOCK_SIZE = 512
 
-# behavioral data is all in one big table. Defined at module scope for caching purposes. Also define path subject dirs
+# version of the cached LFP. Increment whenever _my_downsample() or the cache format changes, so that old entries are
+# not reused
+LFP_CACHE_VERSION = 2
+
+# behavioral data is all in one big table. Defined at module scope for caching purposes. Also define path subject dirs.
+# The clusters of the master table, with channel and cluster numbers parsed from clustId, are also indexed by subject,
+# session and channel. If master_table_cache_dir is set, the parsed tables are cached there.
 my_globals = {'master_table_path': '/scratch/josh/BniData/BniData/Analysis/CRM/masterPseudoZ_r5.txt',
               'master_table_data': None,
+              'cluster_table_data': None,
+              'cluster_index': None,
+              'master_table_cache_dir': None,
               'subject_dir': '/scratch/josh/BniData/BniData/Subjects'}
 
 
@@ -40,19 +51,125 @@ def set_master_table(filepath):
     """
     my_globals['master_table_path'] = filepath
     my_globals['master_table_data'] = None
+    my_globals['cluster_table_data'] = None
+    my_globals['cluster_index'] = None
+
+
+def set_master_table_cache_dir(dirpath):
+    """
+    Set a directory in which to cache the parsed master table. Loading the same master table file again, in this or
+    any other process, then skips reading and parsing the text file.
+
+    Parameters
+    ----------
+    dirpath: str
+        The path to the directory, or None to not cache.
+
+    """
+    my_globals['master_table_cache_dir'] = dirpath
+
+
+def master_table_settings():
+    """
+    The paths in my_globals, without any loaded data. Worker processes don't share this module's state, so this can be
+    passed to them and given to apply_master_table_settings().
+    """
+    return {x: my_globals[x] for x in ['master_table_path', 'master_table_cache_dir', 'subject_dir']}
+
+
+def apply_master_table_settings(settings):
+    """
+    Sets the paths returned by master_table_settings(), unloading the master data if the master table changed.
+    """
+    if settings['master_table_path'] != my_globals['master_table_path']:
+        set_master_table(settings['master_table_path'])
+    my_globals['master_table_cache_dir'] = settings['master_table_cache_dir']
+    my_globals['subject_dir'] = settings['subject_dir']
+
+
+def _master_table_cache_file():
+    """
+    Path of the cached, parsed master table. The name includes a hash of the path, size and modification time of the
+    master table file, so an edited table is parsed again.
+    """
+    if my_globals['master_table_cache_dir'] is None:
+        return None
+    table_path = os.path.abspath(my_globals['master_table_path'])
+    st = os.stat(table_path)
+    key = hashlib.md5('{}_{}_{}'.format(table_path, st.st_size, st.st_mtime_ns).encode()).hexdigest()
+    return os.path.join(my_globals['master_table_cache_dir'], 'master_table_{}.pkl'.format(key))
+
+
+def _parse_cluster_table(master_table):
+    """
+    Unique clusters of the master table, with integer channel and cluster columns parsed from the clustId strings.
+    """
+    cluster_table = master_table[['subject', 'expID', 'clustId', 'quality', 'side', 'area']].drop_duplicates()
+    chan_clust = cluster_table.clustId.str.extract(r'(\d+)\D+(\d+)').astype(int)
+    cluster_table = cluster_table.assign(channel=chan_clust[0].values, cluster=chan_clust[1].values)
+    return cluster_table.reset_index(drop=True)
 
 
 def load_master_table():
     """
     Loads master data table and stores it in module variable my_globals['master_table_data']. We are caching it
-    because it'll be faster than having to load this over and over.
+    because it'll be faster than having to load this over and over. Also parses and indexes the clusters of the table.
     """
 
-    # read table
-    my_globals['master_table_data'] = pd.read_table(my_globals['master_table_path'])
+    # read the parsed tables from the cache if possible
+    cache_file = _master_table_cache_file()
+    if (cache_file is not None) and os.path.exists(cache_file):
+        master_table, cluster_table = pd.read_pickle(cache_file)
+
+    else:
+
+        # read table
+        master_table = pd.read_table(my_globals['master_table_path'])
+
+        # also make a new column with a unique subject identifier
+        master_table['subject'] = master_table.expID.str.split('e').str[0]
+
+        # and parse the channel and cluster numbers of each cluster
+        cluster_table = _parse_cluster_table(master_table)
+
+        # write to a temporary file and rename, so that concurrent jobs never see a partially written file
+        if cache_file is not None:
+            os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+            tmp_file = '{}.{}.tmp'.format(cache_file, os.getpid())
+            pd.to_pickle((master_table, cluster_table), tmp_file)
+            os.replace(tmp_file, cache_file)
+
+    my_globals['master_table_data'] = master_table
+    my_globals['cluster_table_data'] = cluster_table
+    my_globals['cluster_index'] = {key: rows for key, rows in cluster_table.groupby(['subject', 'expID', 'channel'])}
+
+
+def get_channel_clusters(subject, session, channel_num):
+    """
+    Clusters of a channel in the master table.
+
+    Parameters
+    ----------
+    subject: str
+        subject string
+    session: str
+        session string
+    channel_num: int
+        channel number of the data file
+
+    Returns
+    -------
+    pandas.DataFrame
+        The rows of the cluster table for this channel, with columns clustId, quality, side, area, channel and cluster.
+        Empty if the channel has no clusters.
+    """
+
+    # load master data if not cached already
+    if my_globals['master_table_data'] is None:
+        load_master_table()
 
-    # also make a new column with a unique subject identifier
-    my_globals['master_table_data']['subject'] = my_globals['master_table_data'].expID.apply(lambda x: x.split('e')[0])
+    rows = my_globals['cluster_index'].get((subject, session, int(channel_num)))
+    return rows if rows is not None else my_globals['cluster_table_data'].iloc[:0]
 
 
 def get_subjs(task='crm'):
@@ -156,13 +273,8 @@ def get_localization_by_sess(subject, session, channel_num, clusters):
         Character arrays (same length as input clusters) with corresponding region and hemisphere labels
 
     """
-    # reduce master data table to just this subject and session
-    df = my_globals['master_table_data']
-    cluster_qual_df = df[(df.subject == subject) & (df.expID == session)][['clustId', 'side', 'area']].drop_duplicates()
-
-    # pull out the channel number and cluster number from the clustId string
-    chan_clust = cluster_qual_df.clustId.apply(lambda x: np.array([int(y) for y in re.findall(r'\d+', x)]))
-    channels, cluster_ids = np.stack(chan_clust.values).T
+    # clusters of this channel
+    chan_clusters = get_channel_clusters(subject, session, channel_num)
 
     # will hold region and hemisphere for each cluster entry
     region = np.chararray(clusters.shape, 2, unicode=True)
@@ -170,10 +282,10 @@ def get_localization_by_sess(subject, session, channel_num, clusters):
 
     # loop over each cluster
     for this_cluster in np.unique(clusters):
-        ind_df = (channels == channel_num) & (cluster_ids == this_cluster)
+        loc = chan_clusters[chan_clusters.cluster == this_cluster][['side', 'area']].drop_duplicates()
         ind_clusters = clusters == this_cluster
-        region[ind_clusters] = cluster_qual_df[ind_df].area
-        hemisphere[ind_clusters] = cluster_qual_df[ind_df].side
+        region[ind_clusters] = loc.area.values
+        hemisphere[ind_clusters] = loc.side.values
 
     return region, hemisphere
 
@@ -258,56 +370,76 @@ def stat_ncs(channel_file):
     return info
 
 
-def load_ncs(channel_file):
+def load_ncs(channel_file, return_int16=False):
     """
+    Decodes a neuralynx continuous (ncs) file. The file is memory mapped and the samples and per-block headers are read
+    as array views of the records, so there is no per-block python loop. Only the first nb_valid samples of each
+    512 sample block are kept, and the timestamps of each block start from that block's own timestamp, so partial
+    blocks and gaps in the recording are handled.
 
     Parameters
     ----------
     channel_file: str
         Path to an ncs neuralynx file
+    return_int16: bool
+        If True, return the raw int16 samples along with the microvolts per bit scale, instead of float32 microvolts.
+        This uses half the memory, and the scaling can be done later (or fused with other operations)
 
     Returns
     -------
     signals: np.ndarry
-        The eeg data for this channel, length is the number of samples
+        The eeg data for this channel, length is the number of samples. float32 microvolts, or int16 if return_int16
     timestamps: np.ndarry
         The timestamp (in microseconds) corresponding to each sample
     sr: float
         the sampleing rate of the data
-
+    uv_per_bit: float
+        If return_int16, the factor that converts signals to microvolts
     """
 
     # load header info
     info = stat_ncs(channel_file)
+    uv_per_bit = info['ADBitVolts'] * 1e6
 
     # define datatype for memmap
     ncs_dtype = [('timestamp', 'uint64'), ('channel', 'uint32'), ('sample_rate', 'uint32'),
                  ('nb_valid', 'uint32'), ('samples', 'int16', (BLOCK_SIZE,))]
 
-    # load it all at once... sorry.
+    # memory map the file. The fields are views into the records, nothing is read yet
     data = np.memmap(channel_file, dtype=ncs_dtype, mode='r', offset=HEADER_SIZE)
+    block_ts = data['timestamp'].astype('float64')
+    nb_valid = data['nb_valid'].astype(int)
+    samples = data['samples']
+
+    # timestamps for every sample of every block at once
+    sample_inds = np.arange(BLOCK_SIZE)
+    timestamps = block_ts[:, np.newaxis] + sample_inds * (1e6 / data['sample_rate'].astype('float64'))[:, np.newaxis]
+
+    # keep only the valid samples of each block. If every block is full, which is typical, no mask is needed
+    if np.all(nb_valid == BLOCK_SIZE):
+        timestamps = timestamps.ravel()
+        if return_int16:
+            signals = samples.reshape(-1)
+        else:
+            signals = np.empty(timestamps.shape, dtype='float32')
+            np.multiply(samples, uv_per_bit, out=signals.reshape(samples.shape), casting='unsafe')
+    else:
+        valid = sample_inds < nb_valid[:, np.newaxis]
+        timestamps = timestamps[valid]
+        signals = samples[valid]
+        if not return_int16:
+            signals = np.multiply(signals, uv_per_bit, dtype='float32')
+
+    # sampling rate from the spacing of the block timestamps, ignoring gaps in the recording and empty blocks
+    ok = nb_valid[:-1] > 0
+    if np.any(ok):
+        sample_diffs = np.diff(block_ts)[ok] / nb_valid[:-1][ok]
+        actual_samplerate = 1e6 / np.mean(sample_diffs[sample_diffs < 1.5 * np.median(sample_diffs)])
+    else:
+        actual_samplerate = info['SamplingFrequency']
 
-    # loop over each block and create timestamps for each sample
-    signals = []
-    timestamps = []
-    for this_block in data:
-        # extend our list of the data
-        signals.extend(this_block[4])
-
-        # create timestamps for each sample in this block
-        timestamps_block = np.linspace(this_block[0], this_block[0] + (1e6 / this_block[2] * (BLOCK_SIZE - 1)),
-                                       BLOCK_SIZE)
-        timestamps.append(timestamps_block)
-
-    # get our final arrays
-    timestamps = np.concatenate(timestamps)
-    signals = np.array(signals)
-
-    # convert to microvolts
-    signals = signals * info['ADBitVolts'] * 1e6
-
-    actual_samplerate = 1e6 / (np.mean(np.diff([x[0] for x in data]))/BLOCK_SIZE)
-    #info['SamplingFrequency']
+    if return_int16:
+        return signals, timestamps, actual_samplerate, uv_per_bit
     return signals, timestamps, actual_samplerate
 
 
@@ -336,33 +468,38 @@ def load_spikes_cluster_with_qual(session_file_dict, chan_num, quality=list(['SP
     channel_file = session_file_dict[chan_num]['nse']
     cluster_file = session_file_dict[chan_num]['clusters']
 
-    # reduce master data table to just this subject and session
-    df = my_globals['master_table_data']
-    cluster_qual_df = df[(df.subject == subject) & (df.expID == session)][['clustId', 'quality']].drop_duplicates()
-
-    # pull out the channel number and cluster number from the clustId string
-    chan_clust = cluster_qual_df.clustId.apply(lambda x: np.array([int(y) for y in re.findall(r'\d+', x)]))
-    channels, cluster_ids = np.stack(chan_clust.values).T
-
     # get non-noise clusters ids of requested quality for this channel
-    good_clusts = cluster_ids[(channels == chan_num) & cluster_qual_df.quality.isin(quality)]
+    chan_clusters = get_channel_clusters(subject, session, chan_num)
+    chan_clusters = chan_clusters[['cluster', 'quality']].drop_duplicates()
+    good_clusts = chan_clusters.cluster.values[chan_clusters.quality.isin(quality).values]
 
     # if we have good clusters, load the data
     if good_clusts.size > 0:
-        spikes = load_nse(channel_file, return_waveforms=False)
         clusters = load_cluster_ids(cluster_file)
-        if len(spikes) != len(clusters):
+        if len(_nse_memmap(channel_file)) != len(clusters):
             print('Something wrong, number of spikes and cluster ids not equal.')
             return
 
-        # do the filtering to the good clusters
-        good_spikes = np.in1d(clusters, good_clusts)
-        return spikes[good_spikes], clusters[good_spikes]
+        # only read the spikes of the good clusters
+        good_spikes = cluster_spike_inds(make_cluster_index(clusters), good_clusts)
+        return load_nse(channel_file, return_waveforms=False, spike_inds=good_spikes), clusters[good_spikes]
     else:
         return np.array([]), np.array([])
 
 
-def load_nse(channel_file, return_waveforms=False):
+def _nse_memmap(channel_file):
+    """
+    Memory maps the records of an nse file. Nothing is read until the records are accessed.
+    """
+
+    # nse dtype
+    dtype = [('timestamp', 'uint64'), ('channel', 'uint32'), ('unit_id', 'uint32')]
+    dtype += [('params', 'uint32', (8,))]
+    dtype += [('samples', 'uint16', (32,))]
+    return np.memmap(channel_file, dtype=dtype, mode='r', offset=HEADER_SIZE)
+
+
+def load_nse(channel_file, return_waveforms=False, spike_inds=None):
     """
 
     Parameters
@@ -371,6 +508,9 @@ def load_nse(channel_file, return_waveforms=False):
         Path to an nse neuralynx file (NOTE: not ncs file)
     return_waveforms: bool
         Whether to return as a second output the spike waveforms
+    spike_inds: numpy.ndarray
+        Optional indices of the spikes to read, for example from cluster_spike_inds(). If not given, all spikes are
+        returned as views into the memory mapped file, without reading them.
 
     Returns
     -------
@@ -380,25 +520,81 @@ def load_nse(channel_file, return_waveforms=False):
         If return_waveforms, num spikes x 32 array
     """
 
-    # nse dtype
-    dtype = [('timestamp', 'uint64'), ('channel', 'uint32'), ('unit_id', 'uint32')]
-    dtype += [('params', 'uint32', (8,))]
-    dtype += [('samples', 'uint16', (32,))]
-
     # load spiking data
-    data = np.memmap(channel_file, dtype=dtype, mode='r', offset=HEADER_SIZE)
+    data = _nse_memmap(channel_file)
+    if spike_inds is not None:
+        data = data[spike_inds]
 
     # get timestamps
-    timestamps = np.array([x[0] for x in data])
+    timestamps = data['timestamp']
 
     # get spike waveforms
     if return_waveforms:
-        spike_waveforms = np.array([x[4] for x in data])
+        spike_waveforms = data['samples']
         return timestamps, spike_waveforms
     else:
         return timestamps
 
 
+def iter_nse(channel_file, spikes_per_block=100000, spike_inds=None):
+    """
+    Yields the timestamps and waveforms of an nse file in blocks of spikes, so that sessions with millions of spikes
+    can be processed without holding all the waveforms in memory.
+
+    Parameters
+    ----------
+    channel_file: str
+        Path to an nse neuralynx file
+    spikes_per_block: int
+        Number of spikes in each block
+    spike_inds: numpy.ndarray
+        Optional sorted indices of the spikes to read, for example from cluster_spike_inds()
+
+    Yields
+    ------
+    timestamps: numpy.ndarray
+        Timestamps of the spikes in the block
+    spike_waveforms: numpy.ndarray
+        num spikes in the block x 32 array
+    """
+    data = _nse_memmap(channel_file)
+    n_spikes = len(data) if spike_inds is None else len(spike_inds)
+    for start in range(0, n_spikes, spikes_per_block):
+        if spike_inds is None:
+            block = np.array(data[start:start + spikes_per_block])
+        else:
+            block = data[spike_inds[start:start + spikes_per_block]]
+        yield block['timestamp'], block['samples']
+
+
+def make_cluster_index(cluster_ids):
+    """
+    Groups the spikes of a channel by cluster, so that the spikes of any set of clusters can be looked up without
+    scanning every spike's cluster ID again.
+
+    Parameters
+    ----------
+    cluster_ids: numpy.ndarray
+        Cluster ID of each spike, from load_cluster_ids()
+
+    Returns
+    -------
+    dict
+        Keys are cluster IDs, values are sorted arrays of the indices of the spikes in that cluster
+    """
+    order = np.argsort(cluster_ids, kind='stable')
+    ids, starts = np.unique(cluster_ids[order], return_index=True)
+    return dict(zip(ids, np.split(order, starts[1:])))
+
+
+def cluster_spike_inds(cluster_index, clusters):
+    """
+    Sorted indices of the spikes belonging to any of the given clusters, from a make_cluster_index() dict.
+    """
+    inds = [cluster_index[x] for x in clusters if x in cluster_index]
+    return np.sort(np.concatenate(inds)) if inds else np.array([], dtype=int)
+
+
 def load_cluster_ids(cluster_file):
     """
 
@@ -418,8 +614,173 @@ def load_cluster_ids(cluster_file):
     return np.fromfile(cluster_file, dtype=int, sep='\n')[1:]
 
 
+def lfp_cache_paths(channel_file, cache_dir, downsample_freq=1000, noise_freq=[58., 62.]):
+    """
+    Paths of the cached signals, timestamps, and sampling rate for a channel file at a given downsample rate and line
+    noise filter. Channel file names repeat across sessions, so the directory name includes a hash of the full path.
+    The hash also includes the size and modification time of the file and LFP_CACHE_VERSION, so a replaced file or a
+    change to the downsampling is computed again.
+
+    Returns
+    -------
+    dict
+        Paths to the 'signals', 'timestamps', and 'samplerate' .npy files
+    """
+    abs_path = os.path.abspath(channel_file)
+    stem = os.path.splitext(os.path.basename(abs_path))[0]
+    st = os.stat(abs_path)
+    path_hash = hashlib.md5('{}_{}_{}_v{}'.format(abs_path, st.st_size, st.st_mtime_ns,
+                                                  LFP_CACHE_VERSION).encode('utf-8')).hexdigest()[:12]
+    if noise_freq is not None and isinstance(noise_freq[0], float):
+        noise_freq = [noise_freq]
+    noise_str = '_'.join(['-'.join([str(x) for x in f]) for f in noise_freq]) if noise_freq else 'no_filt'
+    chan_dir = os.path.join(cache_dir, '{}_{}'.format(stem, path_hash), '{}_ds_{}_noise'.format(downsample_freq,
+                                                                                                 noise_str))
+    return {x: os.path.join(chan_dir, x + '.npy') for x in ['signals', 'timestamps', 'samplerate']}
+
+
+def load_cached_lfp(channel_file, cache_dir, downsample_freq=1000, noise_freq=[58., 62.]):
+    """
+    Returns the continuous, downsampled and line noise filtered LFP of a channel, memory mapped from a per channel
+    cache. The first time a channel is requested, the ncs file is decoded, downsampled, filtered, and saved to the
+    cache, so each raw file is only processed once no matter how many events, spikes, or clusters are later epoched
+    from it.
+
+    Parameters
+    ----------
+    channel_file: str
+        Path to Ncs file
+    cache_dir: str
+        Directory holding the cache
+    downsample_freq: int or float
+        Frequency to downsample the data (see _my_downsample)
+    noise_freq: list
+        Stop filter will be applied to the given range(s). None to not filter.
+
+    Returns
+    -------
+    signals: numpy.memmap
+        float32 LFP
+    timestamps: numpy.memmap
+        The timestamp (in microseconds) of each sample
+    sr: float
+        The sampling rate of the LFP
+    """
+    paths = lfp_cache_paths(channel_file, cache_dir, downsample_freq, noise_freq)
+
+    if not all([os.path.exists(x) for x in paths.values()]):
+        signals, timestamps, sr = load_ncs(channel_file)
+        signals, timestamps, sr = _my_downsample(signals, timestamps, sr, downsample_freq)
+
+        # filter line noise on the continuous data
+        if noise_freq is not None:
+            if isinstance(noise_freq[0], float):
+                noise_freq = [noise_freq]
+            for this_noise_freq in noise_freq:
+                sos = butter(4, this_noise_freq, btype='bandstop', fs=sr, output='sos')
+                signals = sosfiltfilt(sos, signals)
+
+        # write to temporary files and rename, so that concurrent jobs never see partially written files. The
+        # samplerate goes last, since its presence marks a complete cache entry
+        os.makedirs(os.path.dirname(paths['signals']), exist_ok=True)
+        for key, arr in [('signals', signals.astype('float32')), ('timestamps', timestamps.astype('float64')),
+                         ('samplerate', np.array(sr))]:
+            tmp_file = '{}.{}.tmp.npy'.format(paths[key][:-4], os.getpid())
+            np.save(tmp_file, arr)
+            os.replace(tmp_file, paths[key])
+
+    signals = np.load(paths['signals'], mmap_mode='r')
+    timestamps = np.load(paths['timestamps'], mmap_mode='r')
+    sr = float(np.load(paths['samplerate']))
+    return signals, timestamps, sr
+
+
+def event_spike_times_csr(spike_times, start_times, stop_times):
+    """
+    Spike times falling within each event's time window, in a ragged (CSR style) layout: one flat array with the
+    spikes of every event, one after the other, and an array of offsets such that the spikes of event i are
+    flat[offsets[i]:offsets[i + 1]].
+
+    Parameters
+    ----------
+    spike_times: numpy.ndarray
+        Timestamps of all the spikes of a cluster
+    start_times: numpy.ndarray
+        Start timestamp of each event window (exclusive)
+    stop_times: numpy.ndarray
+        Stop timestamp of each event window (exclusive)
+
+    Returns
+    -------
+    flat_spike_times: numpy.ndarray
+        Concatenated spike times of all events
+    offsets: numpy.ndarray
+        num events + 1 array of offsets into flat_spike_times
+    """
+    spike_times = np.sort(np.asarray(spike_times))
+    first = np.searchsorted(spike_times, start_times, side='right')
+    last = np.searchsorted(spike_times, stop_times, side='left')
+    counts = np.maximum(last - first, 0)
+    offsets = np.concatenate([[0], np.cumsum(counts)]).astype('int64')
+    return spike_times[_csr_gather_inds(first, counts, offsets)], offsets
+
+
+def _csr_gather_inds(starts, counts, offsets):
+    """
+    Indices that gather counts[i] consecutive elements beginning at starts[i], for every i, into one flat array.
+    """
+    return np.repeat(starts - offsets[:-1], counts) + np.arange(offsets[-1])
+
+
+def save_event_spike_times(grp, flat_spike_times, offsets):
+    """
+    Stores the ragged event spike times from event_spike_times_csr() in an hdf5 group as two datasets.
+    """
+    grp.create_dataset('spike_times', data=flat_spike_times)
+    grp.create_dataset('event_offsets', data=offsets)
+
+
+def load_event_spike_times(cluster_grp, event_inds=None):
+    """
+    Reads the spike times of every event of a cluster from a BRI subject data hdf5 file with one read.
+
+    Parameters
+    ----------
+    cluster_grp: h5py.Group
+        The group of a cluster within a channel's 'spike_times' group
+    event_inds: numpy.ndarray
+        Optional indices of the events to return, in order. All events if not given.
+
+    Returns
+    -------
+    flat_spike_times: numpy.ndarray
+        Concatenated spike times of the events
+    offsets: numpy.ndarray
+        num events + 1 array of offsets into flat_spike_times, so that the spikes of the ith returned event are
+        flat_spike_times[offsets[i]:offsets[i + 1]]
+    """
+
+    # files written before the ragged layout have one dataset per event
+    if 'event_offsets' not in cluster_grp:
+        keys = sorted(cluster_grp.keys(), key=int) if event_inds is None else [str(x) for x in event_inds]
+        spikes_by_event = [np.array(cluster_grp[x]) for x in keys]
+        offsets = np.concatenate([[0], np.cumsum([len(x) for x in spikes_by_event])]).astype('int64')
+        flat = np.concatenate(spikes_by_event) if len(spikes_by_event) else np.array([])
+        return flat, offsets
+
+    flat = cluster_grp['spike_times'][()]
+    offsets = cluster_grp['event_offsets'][()]
+    if event_inds is not None:
+        event_inds = np.asarray(event_inds)
+        counts = offsets[event_inds + 1] - offsets[event_inds]
+        new_offsets = np.concatenate([[0], np.cumsum(counts)]).astype('int64')
+        flat = flat[_csr_gather_inds(offsets[event_inds], counts, new_offsets)]
+        offsets = new_offsets
+    return flat, offsets
+
+
 def load_eeg_from_times(df, channel_file, rel_start_ms, rel_stop_ms, buf_ms=0, noise_freq=[58., 62.],
-                        downsample_freq=1000, resample_freq=None, pass_band=None):
+                        downsample_freq=1000, resample_freq=None, pass_band=None, lfp_cache_dir=None):
     """
 
     Parameters
@@ -439,6 +800,9 @@ def load_eeg_from_times(df, channel_file, rel_start_ms, rel_stop_ms, buf_ms=0, n
     downsample_freq
     resample_freq
     pass_band
+    lfp_cache_dir: str
+        If given, epochs are taken from the cached, continuous, line noise filtered LFP (see load_cached_lfp()) instead
+        of decoding and filtering the ncs file again
 
     Returns
     -------
@@ -449,10 +813,12 @@ def load_eeg_from_times(df, channel_file, rel_start_ms, rel_stop_ms, buf_ms=0, n
     # events = pd.DataFrame(data=np.stack([s_times, clust_nums], -1), columns=['stTime', 'cluster_num'])
 
     # load eeg for this channel
-    eeg = _load_eeg_timeseries(df, rel_start_ms, rel_stop_ms, [channel_file], buf_ms, downsample_freq, resample_freq)
+    use_cache = (lfp_cache_dir is not None) and (downsample_freq is not None)
+    eeg = _load_eeg_timeseries(df, rel_start_ms, rel_stop_ms, [channel_file], buf_ms, downsample_freq, resample_freq,
+                               lfp_cache_dir=lfp_cache_dir if use_cache else None, noise_freq=noise_freq)
 
-    # filter line noise
-    if noise_freq is not None:
+    # filter line noise, unless already done on the cached continuous data
+    if (noise_freq is not None) and not use_cache:
         if isinstance(noise_freq[0], float):
             noise_freq = [noise_freq]
         for this_noise_freq in noise_freq:
@@ -470,7 +836,8 @@ def load_eeg_from_times(df, channel_file, rel_start_ms, rel_stop_ms, buf_ms=0, n
 
 
 def power_spectra_from_spike_times(s_times, clust_nums, channel_file, rel_start_ms, rel_stop_ms, freqs,
-                                           noise_freq=[58., 62.], downsample_freq=250, mean_over_spikes=True):
+                                           noise_freq=[58., 62.], downsample_freq=250, mean_over_spikes=True,
+                                           lfp_cache_dir=None, cache_downsample_freq=1000):
     """
     Function to compute power relative to spike times. This computes power at given frequencies for the ENTIRE session
     and then bins it relative to spike times. You WILL run out of memory if you don't let it downsample first. Default
@@ -497,6 +864,11 @@ def power_spectra_from_spike_times(s_times, clust_nums, channel_file, rel_start_
         Frequency to downsample the data. Use decimate, so we will likely not reach the exact frequency.
     mean_over_spikes: bool
         After computing the spike x frequency array, do we mean over spikes and return only the mean power spectra
+    lfp_cache_dir: str
+        If given, start from the cached, line noise filtered LFP at cache_downsample_freq (see load_cached_lfp())
+        instead of decoding the ncs file again
+    cache_downsample_freq: int or float
+        Downsample rate of the cached LFP to use
 
     Returns
     -------
@@ -508,12 +880,17 @@ def power_spectra_from_spike_times(s_times, clust_nums, channel_file, rel_start_
     # make a df with 'stTime' column for epoching
     events = pd.DataFrame(data=np.stack([s_times, clust_nums], -1), columns=['stTime', 'cluster_num'])
 
-    # load channel data
-    signals, timestamps, sr = load_ncs(channel_file)
+    # load channel data, either raw or already downsampled and filtered from the cache
+    use_cache = lfp_cache_dir is not None
+    if use_cache:
+        signals, timestamps, sr = load_cached_lfp(channel_file, lfp_cache_dir, cache_downsample_freq, noise_freq)
+    else:
+        signals, timestamps, sr = load_ncs(channel_file)
 
     # downsample the session
     if downsample_freq is not None:
-        signals, timestamps, sr = _my_downsample(signals, timestamps, sr, downsample_freq)
+        if downsample_freq < sr:
+            signals, timestamps, sr = _my_downsample(signals, timestamps, sr, downsample_freq)
     else:
         print('I HIGHLY recommend you downsample the data before computing power across the whole session...')
         print('You will probably run out of memory.')
@@ -521,8 +898,8 @@ def power_spectra_from_spike_times(s_times, clust_nums, channel_file, rel_start_
     # make into timeseries
     eeg = TimeSeries.create(signals, samplerate=sr, dims=['time'], coords={'time': timestamps / 1e6})
 
-    # filter line noise
-    if noise_freq is not None:
+    # filter line noise, unless already done on the cached data
+    if (noise_freq is not None) and not use_cache:
         if isinstance(noise_freq[0], float):
             noise_freq = [noise_freq]
         for this_noise_freq in noise_freq:
@@ -558,7 +935,8 @@ def power_spectra_from_spike_times(s_times, clust_nums, channel_file, rel_start_
 
 def load_eeg_from_event_times(events, rel_start_ms, rel_stop_ms, channel_list, buf_ms=0, noise_freq=[58., 62.],
                               downsample_freq=1000,
-                              resample_freq=None, pass_band=None, demean=False, do_average_ref=False):
+                              resample_freq=None, pass_band=None, demean=False, do_average_ref=False,
+                              lfp_cache_dir=None):
     """
     Returns an EEG TimeSeries object.
 
@@ -584,6 +962,9 @@ def load_eeg_from_event_times(events, rel_start_ms, rel_stop_ms, channel_list, b
         If True, will subject the mean voltage between rel_start_ms and rel_stop_ms from each channel
     do_average_ref: bool
         If True, will compute the average reference based on the mean voltage across channels
+    lfp_cache_dir: str
+        If given, epochs are taken from the cached, continuous, line noise filtered LFP (see load_cached_lfp()) instead
+        of decoding and filtering the ncs files again
 
     Returns
     -------
@@ -593,7 +974,9 @@ def load_eeg_from_event_times(events, rel_start_ms, rel_stop_ms, channel_list, b
     """
 
     # eeg is a PTSA timeseries
-    eeg = _load_eeg_timeseries(events, rel_start_ms, rel_stop_ms, channel_list, buf_ms, downsample_freq)
+    use_cache = (lfp_cache_dir is not None) and (downsample_freq is not None)
+    eeg = _load_eeg_timeseries(events, rel_start_ms, rel_stop_ms, channel_list, buf_ms, downsample_freq,
+                               lfp_cache_dir=lfp_cache_dir if use_cache else None, noise_freq=noise_freq)
 
     # compute average reference by subracting the mean across channels
     if do_average_ref:
@@ -603,8 +986,8 @@ def load_eeg_from_event_times(events, rel_start_ms, rel_stop_ms, channel_list, b
     if demean:
         eeg = eeg.baseline_corrected([rel_start_ms, rel_stop_ms])
 
-    # filter line noise
-    if noise_freq is not None:
+    # filter line noise, unless already done on the cached continuous data
+    if (noise_freq is not None) and not use_cache:
         if isinstance(noise_freq[0], float):
             noise_freq = [noise_freq]
         for this_noise_freq in noise_freq:
@@ -645,7 +1028,7 @@ def band_pass_eeg(eeg, freq_range, order=4):
 
 
 def _load_eeg_timeseries(events, rel_start_ms, rel_stop_ms, channel_list, buf_ms=0, downsample_freq=1000,
-                         resample_freq=None):
+                         resample_freq=None, lfp_cache_dir=None, noise_freq=None):
     """
 
     Parameters
@@ -664,6 +1047,10 @@ def _load_eeg_timeseries(events, rel_start_ms, rel_stop_ms, channel_list, buf_ms
         sample rate to downsample sample initial data immediately after loading the full file
     resample_freq: int
         Resample eeg to this value. Done after epoching.
+    lfp_cache_dir: str
+        If given, read the downsampled, line noise filtered continuous LFP from this cache (see load_cached_lfp())
+    noise_freq: list
+        Line noise filter of the cached LFP. Only used with lfp_cache_dir
 
     Returns
     -------
@@ -678,10 +1065,13 @@ def _load_eeg_timeseries(events, rel_start_ms, rel_stop_ms, channel_list, buf_ms
     for channel in channel_list:
 
         # load channel data
-        signals, timestamps, sr = load_ncs(channel)
+        if lfp_cache_dir is not None:
+            signals, timestamps, sr = load_cached_lfp(channel, lfp_cache_dir, downsample_freq, noise_freq)
+        else:
+            signals, timestamps, sr = load_ncs(channel)
 
-        if downsample_freq is not None:
-            signals, timestamps, sr = _my_downsample(signals, timestamps, sr, downsample_freq)
+            if downsample_freq is not None:
+                signals, timestamps, sr = _my_downsample(signals, timestamps, sr, downsample_freq)
 
         # get start and stop samples (only once)
         # assumes all channels have the same timestamps..
@@ -700,7 +1090,7 @@ def _load_eeg_timeseries(events, rel_start_ms, rel_stop_ms, channel_list, buf_ms
     # create timeseries
     dims = ('event', 'time', 'channel')
     coords = {'event': events.to_records(),
-              'time': (new_time[0] - events.stTime.values[0])/1e6,
+              'time': (new_time - events.stTime.values[0])/1e6,
               'channel': channel_list}
     sr_for_ptsa = resample_freq if resample_freq is not None else sr
     eeg_all_chans = TimeSeries.create(np.stack(eeg_list, -1), samplerate=sr_for_ptsa, dims=dims, coords=coords)
@@ -712,94 +1102,126 @@ def _compute_epochs(events, rel_start_ms, rel_stop_ms, timestamps, sr):
     convert timestamps into start and start sample offsets
     """
 
-    # THIS IS SO MUCH FASTER THAN NP.WHERE, CRAZY
-    offsets = events.stTime.apply(lambda x: np.searchsorted(timestamps, x))
-    # offsets = events.stTime.apply(lambda x: np.where(timestamps >= x)[0][0])
+    # sample of each event, all at once
+    offsets = np.searchsorted(timestamps, events.stTime.values)
     rel_start_micro = int(rel_start_ms * sr / 1e3)
     rel_stop_micro = int(rel_stop_ms * sr / 1e3)
-    epochs = np.array([(offset + rel_start_micro, offset + rel_stop_micro) for offset in offsets])
+    epochs = np.stack([offsets + rel_start_micro, offsets + rel_stop_micro], -1)
     return epochs
 
 
 def _segment_eeg_single_channel(signals, epochs, sr, timestamps, resample_freq):
     """
-    Chunk eeg signal and timestamps by epochs. Also resample if desired
+    Chunk eeg signal by epochs. Also resample if desired. Every epoch has the same number of samples, so all are
+    gathered at once from a strided view of the signal with one window starting at each sample.
+
+    Returns the event x time eeg and the timestamps of the first epoch. The epochs are aligned to the sample of each
+    event, so the timestamps of the first epoch give the time coordinate relative to the event for all of them.
     """
-    eeg = np.stack([signals[x[0]:x[1]] for x in epochs])
-    time_data = np.stack([timestamps[x[0]:x[1]] for x in epochs])
+    epoch_len = epochs[0, 1] - epochs[0, 0]
+    eeg = sliding_window_view(signals, epoch_len)[epochs[:, 0]]
+    time_data = np.asarray(timestamps[epochs[0, 0]:epochs[0, 1]], dtype='float64')
 
     if resample_freq is not None:
         new_length = int(np.round(eeg.shape[1] * resample_freq / sr))
-        resampled_eeg = []
-        resampled_t = []
-
-        # looping because otherwise I get a value error that doesn't make
-        # and that I should probably try to figure out...
-        for i in range(eeg.shape[0]):
-            e, t = resample(eeg[i], new_length, t=time_data[i], axis=0)
-            resampled_eeg.append(e)
-            resampled_t.append(t)
-        return np.array(resampled_eeg), np.array(resampled_t)
+
+        # the resampled timestamps are evenly spaced from the first one, as scipy.signal.resample() computes them
+        new_time = np.arange(new_length) * (time_data[1] - time_data[0]) * epoch_len / float(new_length) + time_data[0]
+        return resample(eeg, new_length, axis=1), new_time
     else:
         return eeg, time_data
 
 
-def _my_downsample(signal, timestamps, sr, desired_downsample_rate):
+def _decimate_factor(timestamps, desired_downsample_rate):
     """
-    Downsample using a decimate style. Not using scipy because I also want to return
-    the new timestamps. scipy.resample is super slow for large arrays.
+    Integer decimation factor that gets as close as possible to (but not below) the desired rate, and the resulting
+    new sampling rate.
     """
-
-    # figure out our decimate factor. Must be int, so we'll try to get as close
-    # as possible to the desired rate. Will not be exactly.
-    ts_diff_sec = np.mean(np.diff(timestamps)) / 1e6
-    dec_factor = np.floor(1. / (desired_downsample_rate * ts_diff_sec))
-
-    # new sampling rate
-    ts_diff_down = dec_factor * ts_diff_sec
-    new_sr = 1. / ts_diff_down
-
-    # apply a low pass filter before decimating
-    low_pass_freq = new_sr / 2.
-    [b, a] = butter(4, low_pass_freq / (sr / 2), 'lowpass')
-    signals_low_pass = filtfilt(b, a, signal, axis=0)
-
-    # now decimate
-    inds = np.arange(0, len(signals_low_pass), dec_factor, dtype=int)
-    new_sigals = signals_low_pass[inds]
-    new_ts = timestamps[inds]
-    return new_sigals, new_ts, new_sr
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
+    ts_diff_sec = (timestamps[-1] - timestamps[0]) / (len(timestamps) - 1) / 1e6
+    dec_factor = int(np.floor(1. / (desired_downsample_rate * ts_diff_sec)))
+    return dec_factor, 1. / (dec_factor * ts_diff_sec)
 
 
+def iter_decimate(signal, timestamps, dec_factor, chunk_size=2 ** 20):
+    """
+    Low pass filters and decimates a signal in chunks, yielding the decimated samples and their timestamps as they are
+    computed. The low pass filter is a linear phase FIR filter (the same as scipy.signal.decimate's), applied only at
+    the kept samples with a polyphase implementation, so it is zero phase like filtfilt. Consecutive chunks overlap by
+    the filter length, so the result does not depend on the chunk size. The ends of the signal are padded with an odd
+    reflection, as filtfilt does. Everything is float32, and memory use is bounded by the chunk size regardless of the
+    length of the recording.
 
+    Parameters
+    ----------
+    signal: numpy.ndarray
+        The signal (can be a memmap, of any numeric dtype)
+    timestamps: numpy.ndarray
+        Timestamp of each sample
+    dec_factor: int
+        Decimation factor
+    chunk_size: int
+        Approximate number of input samples to process at a time
+
+    Yields
+    ------
+    signals: numpy.ndarray
+        float32 decimated samples
+    timestamps: numpy.ndarray
+        Their timestamps
+    """
+    n_samples = len(signal)
+    n_out = int(np.ceil(n_samples / dec_factor))
+    half_len = 10 * dec_factor
+    h = firwin(2 * half_len + 1, 1. / dec_factor, window='hamming').astype('float32')
+    out_per_chunk = max(1, chunk_size // dec_factor)
+
+    for out_start in range(0, n_out, out_per_chunk):
+        out_stop = min(out_start + out_per_chunk, n_out)
+
+        # input samples needed for these outputs, including the filter half length on each side
+        in_start = out_start * dec_factor - half_len
+        in_stop = (out_stop - 1) * dec_factor + half_len + 1
+        window = np.asarray(signal[max(in_start, 0):min(in_stop, n_samples)], dtype='float32')
+
+        # odd reflection past the ends of the signal
+        if in_start < 0:
+            pre_inds = np.clip(np.arange(-in_start, 0, -1), 0, n_samples - 1)
+            pre = 2 * np.float32(signal[0]) - np.asarray(signal[pre_inds], dtype='float32')
+            window = np.concatenate([pre, window])
+        if in_stop > n_samples:
+            post_inds = np.clip(np.arange(n_samples - 2, 2 * n_samples - 2 - in_stop, -1), 0, n_samples - 1)
+            post = 2 * np.float32(signal[n_samples - 1]) - np.asarray(signal[post_inds], dtype='float32')
+            window = np.concatenate([window, post])
+
+        # output m of this chunk is centered on window sample half_len + m * dec_factor, which is full convolution
+        # sample 2 * half_len + m * dec_factor, or decimated sample 20 + m
+        filtered = upfirdn(h, window, down=dec_factor)[20:20 + out_stop - out_start]
+        ts_chunk = np.asarray(timestamps[out_start * dec_factor:out_stop * dec_factor:dec_factor])
+        yield filtered.astype('float32'), ts_chunk
+
+
+def _my_downsample(signal, timestamps, sr, desired_downsample_rate, chunk_size=2 ** 20):
+    """
+    Downsample using a decimate style. Not using scipy because I also want to return
+    the new timestamps. scipy.resample is super slow for large arrays.
 
+    The signal is low pass filtered and decimated in chunks with iter_decimate(), so peak memory does not grow with
+    the length of the recording beyond the decimated output.
+    """
 
+    # figure out our decimate factor. Must be int, so we'll try to get as close
+    # as possible to the desired rate. Will not be exactly.
+    dec_factor, new_sr = _decimate_factor(timestamps, desired_downsample_rate)
+    if dec_factor <= 1:
+        return np.asarray(signal, dtype='float32'), np.asarray(timestamps), sr
+
+    # fill preallocated outputs chunk by chunk
+    n_out = int(np.ceil(len(signal) / dec_factor))
+    new_signals = np.empty(n_out, dtype='float32')
+    new_ts = np.empty(n_out, dtype=np.asarray(timestamps[:1]).dtype)
+    start = 0
+    for signal_chunk, ts_chunk in iter_decimate(signal, timestamps, dec_factor, chunk_size):
+        new_signals[start:start + len(signal_chunk)] = signal_chunk
+        new_ts[start:start + len(ts_chunk)] = ts_chunk
+        start += len(signal_chunk)
+    return new_signals, new_ts, new_sr
@@ -0,0 +1,74 @@
+"""
+Helpers for dispatching work to joblib workers without copying large arrays to each task. Read-only inputs are dumped
+once to a memory mapped file, and outputs are preallocated memory mapped arrays that workers write into directly, so
+neither the inputs nor the results are pickled per task.
+
+Usage:
+
+    with SharedArrays() as shared:
+        x = shared.share(big_array)
+        out = shared.empty(big_array.shape)
+        Parallel(n_jobs=n_jobs)(delayed(func)(x, out, inds) for inds in chunk_slices(len(x), n_jobs))
+        out = np.array(out)
+"""
+
+import os
+import shutil
+import tempfile
+import joblib
+import numpy as np
+
+
+class SharedArrays(object):
+    """
+    Context manager that owns a temporary folder of memory mapped arrays. The folder is removed on exit, so copy any
+    outputs you want to keep into regular arrays (np.array(out)) before leaving the with block.
+    """
+
+    def __init__(self, temp_folder=None):
+
+        # parent folder for the memmaps. Defaults to the system temp folder. /dev/shm is a good choice on linux
+        self.temp_folder = temp_folder
+
+        # folder holding the memmaps for this context
+        self.folder = None
+
+        # counter for unique file names
+        self._n = 0
+
+    def __enter__(self):
+        self.folder = tempfile.mkdtemp(prefix='miller_ecog_tools_', dir=self.temp_folder)
+        return self
+
+    def __exit__(self, *args):
+        shutil.rmtree(self.folder, ignore_errors=True)
+        self.folder = None
+
+    def _next_path(self, ext):
+        self._n += 1
+        return os.path.join(self.folder, 'arr_{}.{}'.format(self._n, ext))
+
+    def share(self, arr):
+        """
+        Returns a read-only memory mapped copy of arr that can be passed to workers by reference.
+        """
+        path = self._next_path('pkl')
+        joblib.dump(np.ascontiguousarray(arr), path)
+        return joblib.load(path, mmap_mode='r')
+
+    def empty(self, shape, dtype='float32', fill_value=np.nan):
+        """
+        Returns a writable memory mapped array, filled with fill_value, that workers can write their results into.
+        """
+        out = np.memmap(self._next_path('mmap'), dtype=dtype, mode='w+', shape=shape)
+        if fill_value is not None:
+            out[:] = fill_value
+        return out
+
+
+def chunk_slices(n, n_chunks):
+    """
+    Splits range(n) into at most n_chunks contiguous slices of nearly equal size.
+    """
+    bounds = np.linspace(0, n, min(max(n_chunks, 1), max(n, 1)) + 1).astype(int).tolist()
+    return [slice(start, stop) for start, stop in zip(bounds[:-1], bounds[1:]) if stop > start]
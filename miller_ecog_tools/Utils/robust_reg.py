@@ -0,0 +1,136 @@
+"""
+Batched robust linear regression of power spectra against log frequency. Every spectrum shares the same design matrix
+(a constant plus log10(frequency)), so the weighted least squares solution for each one is closed form and many
+thousands of spectra can be fit at once with array operations. This follows the same iteratively reweighted least
+squares (IRLS) procedure as statsmodels.RLM with its defaults: an OLS start, median absolute deviation scale, and
+convergence on the deviance.
+"""
+
+import numpy as np
+
+# MAD normalization constant, scipy.stats.norm.ppf(3/4.)
+MAD_CONST = 0.6744897501960817
+
+
+def _huber_weights(z, t=1.345):
+    abs_z = np.abs(z)
+    with np.errstate(divide='ignore'):
+        return np.where(abs_z <= t, 1., t / abs_z)
+
+
+def _huber_rho(z, t=1.345):
+    abs_z = np.abs(z)
+    return np.where(abs_z <= t, 0.5 * z ** 2, t * abs_z - 0.5 * t ** 2)
+
+
+def _tukey_weights(z, c=4.685):
+    return np.where(np.abs(z) <= c, (1 - (z / c) ** 2) ** 2, 0.)
+
+
+def _tukey_rho(z, c=4.685):
+    return np.where(np.abs(z) <= c, c ** 2 / 6. * (1 - (1 - (z / c) ** 2) ** 3), c ** 2 / 6.)
+
+
+NORMS = {'huber': (_huber_weights, _huber_rho),
+         'tukey': (_tukey_weights, _tukey_rho)}
+
+
+def _wls(x, y, w):
+    """
+    Weighted least squares of each row of y on [1, x] with the weights in each row of w. Returns intercepts, slopes.
+    """
+    sw = w.sum(axis=1)
+    swx = w @ x
+    swxx = w @ (x ** 2)
+    swy = (w * y).sum(axis=1)
+    swxy = (w * y) @ x
+    with np.errstate(divide='ignore', invalid='ignore'):
+        slopes = (sw * swxy - swx * swy) / (sw * swxx - swx ** 2)
+        intercepts = (swy - slopes * swx) / sw
+    return intercepts, slopes
+
+
+def batch_robust_reg(y, x, norm='huber', maxiter=50, tol=1e-8, freq_inds=None):
+    """
+    Fits y = intercept + slope * x for every row of y at once.
+
+    Parameters
+    ----------
+    y: numpy.ndarray
+        num spectra x num frequencies array of (log) power
+    x: numpy.ndarray
+        The independent variable, usually log10 of the frequencies. NOT including a constant column.
+    norm: str
+        'huber' (statsmodels default), 'tukey', or 'ols' for ordinary least squares
+    maxiter: int
+        Maximum number of IRLS iterations
+    tol: float
+        Convergence tolerance on the change in deviance
+    freq_inds: numpy.ndarray
+        Optional boolean array. If given, only these frequencies are used in the fit, but residuals are still returned
+        for all frequencies.
+
+    Returns
+    -------
+    intercepts: numpy.ndarray
+        num spectra
+    slopes: numpy.ndarray
+        num spectra
+    resids: numpy.ndarray
+        num spectra x num frequencies
+    bband_power: numpy.ndarray
+        num spectra, the mean of the fit line over the frequencies used in the fit
+    """
+    y = np.asarray(y, dtype='float64')
+    x = np.asarray(x, dtype='float64')
+    y_full = y
+    x_full = x
+    if freq_inds is not None:
+        y = y[:, freq_inds]
+        x = x[freq_inds]
+    n_obs = x.shape[0]
+    df_resid = n_obs - 2
+
+    # start with ordinary least squares
+    weights = np.ones_like(y)
+    intercepts, slopes = _wls(x, y, weights)
+
+    if norm != 'ols':
+        weight_func, rho_func = NORMS[norm]
+
+        resid = y - (intercepts[:, np.newaxis] + slopes[:, np.newaxis] * x)
+        scale = np.median(np.abs(resid), axis=1) / MAD_CONST
+        deviance = rho_func(resid / np.sqrt((resid ** 2).sum(axis=1) / df_resid)[:, np.newaxis]).sum(axis=1)
+
+        # only keep iterating the spectra that have not converged
+        active = scale > 0
+        for iteration in range(2, maxiter + 1):
+            if not np.any(active):
+                break
+            a_y = y[active]
+            a_resid = resid[active]
+            a_weights = weight_func(a_resid / scale[active, np.newaxis])
+            a_int, a_slope = _wls(x, a_y, a_weights)
+            a_resid = a_y - (a_int[:, np.newaxis] + a_slope[:, np.newaxis] * x)
+
+            # deviance is computed with the scale of the weighted fit, as in statsmodels
+            wls_scale = np.sqrt((a_weights * a_resid ** 2).sum(axis=1) / df_resid)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                a_deviance = rho_func(a_resid / wls_scale[:, np.newaxis]).sum(axis=1)
+
+            intercepts[active] = a_int
+            slopes[active] = a_slope
+            resid[active] = a_resid
+            scale[active] = np.median(np.abs(a_resid), axis=1) / MAD_CONST
+            converged = np.abs(a_deviance - deviance[active]) <= tol
+            deviance[active] = a_deviance
+
+            # stop iterating the converged spectra, and those with a perfect fit
+            still_active = np.where(active)[0][~converged]
+            active[:] = False
+            active[still_active] = True
+            active &= scale > 0
+
+    bband_power = intercepts + slopes * x.mean()
+    resids = y_full - (intercepts[:, np.newaxis] + slopes[:, np.newaxis] * x_full)
+    return intercepts, slopes, resids, bband_power
@@ -0,0 +1,120 @@
+"""
+Per-session normalization of event x ... arrays. Session statistics are computed once in float32 (accumulating in
+float64 over small chunks of events), so they can be cached and re-applied. Normalization is applied in place when
+possible, so no full size temporaries are made.
+"""
+
+import numpy as np
+
+
+def session_indices(sessions):
+    """
+    Returns a dictionary mapping each unique session to an index into the events. If a session's events are contiguous
+    (the usual case), the index is a slice, so that indexing returns a view instead of a copy. Otherwise it is a boolean
+    array.
+    """
+    sessions = np.asarray(sessions)
+    inds = {}
+    for sess in np.unique(sessions):
+        sess_bool = sessions == sess
+        where = np.where(sess_bool)[0]
+        if where[-1] - where[0] + 1 == len(where):
+            inds[sess] = slice(where[0], where[-1] + 1)
+        else:
+            inds[sess] = sess_bool
+    return inds
+
+
+def zscore_stats(data, sessions, chunk_size=256):
+    """
+    Computes the mean and standard deviation over events (the first dimension) of data, separately for each session.
+
+    Parameters
+    ----------
+    data: numpy.ndarray
+        Array with events as the first dimension
+    sessions: numpy.ndarray
+        Session of each event
+    chunk_size: int
+        Number of events to process at once
+
+    Returns
+    -------
+    dict
+        Keys are sessions, values are (mean, std) tuples of float32 arrays with shape data.shape[1:]
+    """
+    stats = {}
+    for sess, sess_inds in session_indices(sessions).items():
+        sess_data = data[sess_inds]
+        s = np.zeros(data.shape[1:], dtype='float64')
+        ss = np.zeros(data.shape[1:], dtype='float64')
+        for start in range(0, sess_data.shape[0], chunk_size):
+            chunk = sess_data[start:start + chunk_size]
+            s += chunk.sum(axis=0, dtype='float64')
+            ss += np.einsum('i...,i...->...', chunk, chunk, dtype='float64')
+        n = sess_data.shape[0]
+        m = s / n
+        stats[sess] = (m.astype('float32'), np.sqrt(np.maximum(ss / n - m ** 2, 0.)).astype('float32'))
+    return stats
+
+
+def spectrum_stats(data, sessions, chunk_size=256):
+    """
+    Computes statistics for normalizing power spectra as in Manning et al., 2009. For each session, the mean is the
+    average power over events and frequencies (the second dimension), and the standard deviation is the standard
+    deviation over frequencies, averaged over events.
+
+    Returns
+    -------
+    dict
+        Keys are sessions, values are (mean, std) tuples of float32 arrays with shape data.shape[2:]
+    """
+    stats = {}
+    for sess, sess_inds in session_indices(sessions).items():
+        sess_data = data[sess_inds]
+        m = np.zeros(data.shape[2:], dtype='float64')
+        s = np.zeros(data.shape[2:], dtype='float64')
+        for start in range(0, sess_data.shape[0], chunk_size):
+            chunk = sess_data[start:start + chunk_size]
+            m += chunk.mean(axis=1, dtype='float64').sum(axis=0)
+            s += chunk.std(axis=1, dtype='float64').sum(axis=0)
+        n = sess_data.shape[0]
+        stats[sess] = ((m / n).astype('float32'), (s / n).astype('float32'))
+    return stats
+
+
+def apply_session_stats(data, sessions, stats, in_place=False):
+    """
+    Normalizes data by session, subtracting each session's mean and dividing by its standard deviation. The statistics
+    broadcast against the trailing dimensions of each session's data.
+
+    Parameters
+    ----------
+    data: numpy.ndarray
+        Array with events as the first dimension
+    sessions: numpy.ndarray
+        Session of each event
+    stats: dict
+        As returned by zscore_stats() or spectrum_stats()
+    in_place: bool
+        If True and data is float32, data is normalized in place and returned. Otherwise a single float32 copy is
+        made and normalized in place.
+
+    Returns
+    -------
+    numpy.ndarray
+        Normalized float32 array, the same shape as data
+    """
+    if not (in_place and data.dtype == np.float32):
+        data = np.array(data, dtype='float32')
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for sess, sess_inds in session_indices(sessions).items():
+            m, s = stats[sess]
+            if isinstance(sess_inds, slice):
+                sess_data = data[sess_inds]
+                sess_data -= m
+                sess_data /= s
+            else:
+                data[sess_inds] = (data[sess_inds] - m) / s
+    return data
@@ -0,0 +1,206 @@
+"""
+Fast parameterization of power spectra into an aperiodic (1/f) component and Gaussian peaks, in the spirit of FOOOF
+(https://github.com/voytekresearch/fooof), but operating on many spectra at once so that every event and electrode can
+be fit:
+
+    1. The aperiodic component is fit to all spectra at once with a batched robust regression in log-log space.
+    2. Peaks are found on the flattened (aperiodic removed) spectra with vectorized local maxima detection. Gaussians
+       are estimated from the peak height and half-width and subtracted, iteratively, for all spectra together.
+    3. Only spectra that have peaks get a joint least squares refinement of their Gaussians, which is done for all of
+       them together with a batched Levenberg-Marquardt fit.
+    4. The aperiodic component is refit to the spectra with the peaks removed.
+"""
+
+import numpy as np
+
+from miller_ecog_tools.Utils.robust_reg import batch_robust_reg
+
+# converts full width at half maximum to gaussian standard deviation
+FWHM_TO_STD = 1. / (2 * np.sqrt(2 * np.log(2)))
+
+
+def local_max_mask(arr):
+    """
+    Local maxima along the last axis, with the same semantics as par_funcs.my_local_max().
+    """
+    mask = np.zeros(arr.shape, dtype=bool)
+    mask[..., 1:-1] = (arr[..., :-2] <= arr[..., 1:-1]) & (arr[..., 1:-1] > arr[..., 2:])
+    mask[..., 0] = arr[..., 0] > arr[..., 1]
+    mask[..., -1] = arr[..., -1] > arr[..., -2]
+    return mask
+
+
+def gaussians(freqs, params):
+    """
+    Sum of gaussians at freqs for each spectrum.
+
+    Parameters
+    ----------
+    freqs: numpy.ndarray
+        Frequencies
+    params: numpy.ndarray
+        num spectra x num peaks x 3 (center frequency, height, standard deviation). NaN rows are ignored.
+
+    Returns
+    -------
+    numpy.ndarray
+        num spectra x num frequencies
+    """
+    cf, height, std = [params[:, :, i:i + 1] for i in range(3)]
+    g = height * np.exp(-(freqs - cf) ** 2 / (2 * std ** 2))
+    return np.nansum(g, axis=1)
+
+
+def _refine_gaussians(freqs, flat, params, std_limits, n_iter=25):
+    """
+    Jointly refines the gaussian parameters of every spectrum with a batched Levenberg-Marquardt least squares fit to
+    the flattened spectra. Center frequencies stay within two standard deviations of their initial estimates, heights
+    stay between 0 and 1.5 times their initial estimates, and standard deviations stay within std_limits.
+    """
+    # peaks are filled in order, so only the columns up to the most peaks in any spectrum need to be fit
+    refined = params.copy()
+    num_peaks = np.sum(~np.isnan(params[:, :, 0]), axis=1).max()
+    params = params[:, :num_peaks]
+    valid = ~np.isnan(params[:, :, 0])
+    num_spectra = valid.shape[0]
+    num_params = num_peaks * 3
+    guess = np.where(valid[:, :, np.newaxis], params, [0., 0., 1.])
+    cf_guess, height_guess, std_guess = guess[:, :, 0], guess[:, :, 1], guess[:, :, 2]
+    lower = np.stack([cf_guess - 2 * std_guess, np.zeros(valid.shape), np.full(valid.shape, std_limits[0])], -1)
+    upper = np.stack([cf_guess + 2 * std_guess, 1.5 * height_guess, np.full(valid.shape, std_limits[1])], -1)
+    free = np.repeat(valid, 3, axis=1)
+
+    def model_and_jac(p):
+        cf, height, std = [p[:, :, i:i + 1] for i in range(3)]
+        d = freqs - cf
+        e = np.exp(-d ** 2 / (2 * std ** 2)) * valid[:, :, np.newaxis]
+        g = height * e
+        jac = np.stack([g * d / std ** 2, e, g * d ** 2 / std ** 3], -1)
+        return g.sum(axis=1), jac.transpose(0, 2, 1, 3).reshape(num_spectra, len(freqs), num_params)
+
+    p = np.clip(guess, lower, upper)
+    model, jac = model_and_jac(p)
+    resid = flat - model
+    cost = np.sum(resid ** 2, axis=1)
+    lam = np.full(num_spectra, 1e-3)
+    for _ in range(n_iter):
+        jtj = jac.transpose(0, 2, 1) @ jac
+        jtr = (jac.transpose(0, 2, 1) @ resid[:, :, np.newaxis])[:, :, 0]
+
+        # marquardt damping. Unused peaks get an identity row so that their (zero) steps are well defined
+        diag = np.where(free, np.diagonal(jtj, axis1=1, axis2=2) * (1 + lam[:, np.newaxis]) + 1e-12, 1.)
+        jtj[:, np.arange(num_params), np.arange(num_params)] = diag
+        step = np.linalg.solve(jtj, jtr[:, :, np.newaxis])[:, :, 0].reshape(p.shape)
+        new_p = np.clip(p + step, lower, upper)
+
+        new_model, new_jac = model_and_jac(new_p)
+        new_resid = flat - new_model
+        new_cost = np.sum(new_resid ** 2, axis=1)
+
+        # accept the steps that lowered the error and relax the damping for those spectra, otherwise increase it
+        better = new_cost < cost
+        p[better] = new_p[better]
+        jac[better] = new_jac[better]
+        resid[better] = new_resid[better]
+        cost[better] = new_cost[better]
+        lam = np.where(better, lam * 0.3, lam * 10.)
+
+    refined[:, :num_peaks] = np.where(valid[:, :, np.newaxis], p, np.nan)
+    return refined
+
+
+def fit_spectra(freqs, log_power, peak_width_limits=(1., 8.), max_n_peaks=6, peak_threshold=2., min_peak_height=0.,
+                refit_peaks=True, norm='huber'):
+    """
+    Parameterizes every power spectrum in log_power.
+
+    Parameters
+    ----------
+    freqs: numpy.ndarray
+        Frequencies of the power spectra (need not be linearly spaced)
+    log_power: numpy.ndarray
+        num spectra x num frequencies array of log10 power
+    peak_width_limits: tuple
+        Minimum and maximum peak bandwidth (2 * gaussian standard deviation), in Hz
+    max_n_peaks: int
+        Maximum number of peaks to fit in each spectrum
+    peak_threshold: float
+        Peaks must be this many standard deviations of the flattened spectrum above zero
+    min_peak_height: float
+        Peaks must also be at least this high, in log10 power
+    refit_peaks: bool
+        If True, jointly refine the gaussian parameters of each spectrum that has peaks with nonlinear least squares
+    norm: str
+        Robust norm for the aperiodic fit ('huber', 'tukey', or 'ols')
+
+    Returns
+    -------
+    dict
+        'offsets': aperiodic offset of each spectrum
+        'exponents': aperiodic exponent of each spectrum (the negative of the log-log slope)
+        'peak_params': num spectra x max_n_peaks x 3 array of (center frequency, height, std). NaN where no peak
+        'peak_fit': num spectra x num frequencies array of the summed gaussians
+        'aperiodic_fit': num spectra x num frequencies array of the aperiodic fit
+        'r_squared': r squared of the full model fit to each spectrum
+    """
+    freqs = np.asarray(freqs, dtype='float64')
+    log_power = np.asarray(log_power, dtype='float64')
+    log_freqs = np.log10(freqs)
+    num_spectra, num_freqs = log_power.shape
+    std_limits = np.array(peak_width_limits) / 2.
+    rows = np.arange(num_spectra)
+    freq_inds = np.arange(num_freqs)
+
+    # 1. initial aperiodic fit for every spectrum at once
+    _, _, flat, _ = batch_robust_reg(log_power, log_freqs, norm=norm)
+
+    # 2. iteratively find the largest peak in every spectrum, estimate a gaussian, and remove it
+    peak_params = np.full((num_spectra, max_n_peaks, 3), np.nan)
+    flat_iter = flat.copy()
+    active = np.ones(num_spectra, dtype=bool)
+    for peak_num in range(max_n_peaks):
+        cand = np.where(local_max_mask(flat_iter), flat_iter, -np.inf)
+        peak_ind = np.argmax(cand, axis=1)
+        height = cand[rows, peak_ind]
+        active &= (height > peak_threshold * np.std(flat_iter, axis=1)) & (height > min_peak_height)
+        if not np.any(active):
+            break
+
+        # nearest points on either side that fall below half the peak height
+        below_half = flat_iter <= (height / 2.)[:, np.newaxis]
+        left = np.where(below_half & (freq_inds < peak_ind[:, np.newaxis]), freq_inds, -1).max(axis=1)
+        right = np.where(below_half & (freq_inds > peak_ind[:, np.newaxis]), freq_inds, num_freqs).min(axis=1)
+
+        # half width from the shorter side, in Hz
+        cf = freqs[peak_ind]
+        left_hw = np.where(left >= 0, cf - freqs[np.maximum(left, 0)], np.inf)
+        right_hw = np.where(right < num_freqs, freqs[np.minimum(right, num_freqs - 1)] - cf, np.inf)
+        half_width = np.minimum(left_hw, right_hw)
+        std = np.clip(2 * half_width * FWHM_TO_STD, *std_limits)
+
+        these_params = np.stack([cf, height, std], -1)
+        these_params[~active] = np.nan
+        peak_params[:, peak_num] = these_params
+        flat_iter[active] -= gaussians(freqs, these_params[active, np.newaxis])
+
+    # 3. jointly refine the gaussians of the spectra that have peaks
+    has_peaks = ~np.isnan(peak_params[:, 0, 0])
+    if refit_peaks and np.any(has_peaks):
+        peak_params[has_peaks] = _refine_gaussians(freqs, flat[has_peaks], peak_params[has_peaks], std_limits)
+
+    # 4. refit the aperiodic component with the peaks removed
+    peak_fit = gaussians(freqs, peak_params)
+    offsets, slopes, _, _ = batch_robust_reg(log_power - peak_fit, log_freqs, norm=norm)
+    aperiodic_fit = offsets[:, np.newaxis] + slopes[:, np.newaxis] * log_freqs
+
+    ss_res = np.sum((log_power - aperiodic_fit - peak_fit) ** 2, axis=1)
+    ss_tot = np.sum((log_power - log_power.mean(axis=1, keepdims=True)) ** 2, axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        r_squared = 1 - ss_res / ss_tot
+
+    return {'offsets': offsets,
+            'exponents': -slopes,
+            'peak_params': peak_params,
+            'peak_fit': peak_fit,
+            'aperiodic_fit': aperiodic_fit,
+            'r_squared': r_squared}
@@ -0,0 +1,132 @@
+"""
+Binning of event aligned spike times into an events x time bins count matrix, for all events of a cluster at once, and
+lookup of the phase at every spike.
+
+The spike times of every event come in one flat array with an array of offsets (as returned by
+neurtex_bri_helpers.load_event_spike_times()), so that the spikes of event i are flat[offsets[i]:offsets[i + 1]]. Once
+binned, spikes are kept flat as well, as the bin index of every spike along with its event index.
+"""
+
+import numpy as np
+
+
+def event_time_grid(start_times, stop_times, n):
+    """
+    num events x n array of the timestamps of each event, np.linspace(start, stop, n) for every event.
+    """
+    return np.linspace(np.asarray(start_times, dtype='float64'), np.asarray(stop_times, dtype='float64'), n,
+                       endpoint=True, axis=-1)
+
+
+def bin_event_spikes(flat_spike_times, offsets, start_times, stop_times, n):
+    """
+    Counts the spikes of every event in n time bins spanning each event's time window.
+
+    Each spike is assigned to the first timestamp of its event's np.linspace(start, stop, n) grid that is not before
+    it (np.searchsorted()), and the bins are then counted like np.histogram(spike_bins, np.arange(n + 1)), so the
+    last bin also holds any spikes past the end of the grid.
+
+    Parameters
+    ----------
+    flat_spike_times: numpy.ndarray
+        Concatenated spike times of all events
+    offsets: numpy.ndarray
+        num events + 1 array of offsets into flat_spike_times
+    start_times: numpy.ndarray
+        Start timestamp of each event's time window
+    stop_times: numpy.ndarray
+        Stop timestamp of each event's time window
+    n: int
+        Number of time bins
+
+    Returns
+    -------
+    spike_counts: numpy.ndarray
+        num events x n array of spike counts
+    spike_bins: numpy.ndarray
+        Bin index of each spike in flat_spike_times
+    """
+    flat_spike_times = np.asarray(flat_spike_times, dtype='float64')
+    n_events = len(offsets) - 1
+    event_inds = np.repeat(np.arange(n_events), np.diff(offsets))
+
+    # pad each event's grid with -inf and inf so that the bin on either side of any spike can be looked up
+    grid = event_time_grid(start_times, stop_times, n)
+    padded_grid = np.empty((n_events, n + 2))
+    padded_grid[:, 0] = -np.inf
+    padded_grid[:, 1:-1] = grid
+    padded_grid[:, -1] = np.inf
+
+    # the grid is evenly spaced, so the bin of each spike follows from its distance to the start of its event. Rounding
+    # can put that off by one right at a timestamp, so it is corrected by comparing with the grid itself
+    start = grid[:, 0][event_inds]
+    step = ((grid[:, -1] - grid[:, 0]) / max(n - 1, 1))[event_inds]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        spike_bins = np.ceil((flat_spike_times - start) / step)
+    spike_bins = np.clip(np.nan_to_num(spike_bins), 0, n).astype('int64')
+    spike_bins -= padded_grid[event_inds, spike_bins] >= flat_spike_times
+    spike_bins += padded_grid[event_inds, spike_bins + 1] < flat_spike_times
+
+    # count all events at once. Like np.histogram, the last bin is closed and includes spikes with bin index n
+    flat_bins = event_inds * n + np.minimum(spike_bins, n - 1)
+    spike_counts = np.bincount(flat_bins, minlength=n_events * n).reshape(n_events, n)
+    return spike_counts, spike_bins
+
+
+def reassign_event_spikes(spike_bins, spike_events, source_events):
+    """
+    Moves spikes between events, so that event i gets the spikes of event source_events[i]. Used for shuffling
+    spikes across events. The spikes stay ordered by event.
+
+    Parameters
+    ----------
+    spike_bins: numpy.ndarray
+        Bin index of every spike
+    spike_events: numpy.ndarray
+        Event index of every spike
+    source_events: numpy.ndarray
+        A permutation of the event indices
+
+    Returns
+    -------
+    spike_bins: numpy.ndarray
+        Bin index of every spike, ordered by their new events
+    spike_events: numpy.ndarray
+        New event index of every spike
+    """
+    new_event_of = np.empty(len(source_events), dtype='int64')
+    new_event_of[source_events] = np.arange(len(source_events))
+    new_events = new_event_of[spike_events]
+    order = np.argsort(new_events, kind='stable')
+    return spike_bins[order], new_events[order]
+
+
+def event_spike_phases(spike_bins, spike_events, phase_data, valid_samples, valid_events=None):
+    """
+    Phase at every frequency of every spike, looked up with one fancy index into an events x time x frequency array.
+
+    Parameters
+    ----------
+    spike_bins: numpy.ndarray
+        Time sample of every spike within its event. Spikes past the last sample are dropped
+    spike_events: numpy.ndarray
+        Event index of every spike
+    phase_data: numpy.ndarray or ptsa.timeseries
+        num events x num time x num frequencies phase
+    valid_samples: numpy.ndarray
+        Boolean of the time samples at which to include spikes
+    valid_events: numpy.ndarray
+        Optional boolean of the events from which to include spikes
+
+    Returns
+    -------
+    phases: numpy.ndarray
+        num included spikes x num frequencies phases, in the order of spike_bins
+    phase_events: numpy.ndarray
+        Event index of each row of phases
+    """
+    keep = np.append(np.asarray(valid_samples, dtype=bool), False)[np.minimum(spike_bins, len(valid_samples))]
+    if valid_events is not None:
+        keep &= np.asarray(valid_events, dtype=bool)[spike_events]
+    phase_events = spike_events[keep]
+    return np.asarray(phase_data)[phase_events, spike_bins[keep]], phase_events